@@ -1,35 +1,116 @@
 # -*- coding: utf-8 -*-
 # (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List
+from typing import BinaryIO, List, Optional
 
+from postroj.bundle import BundleLoader, BundleStats, BundleWriter
+from postroj.exceptions import InvalidPhysicalImage
 from postroj.image import ImageProvider
-from postroj.registry import find_distribution
+from postroj.registry import find_distribution, resolve_distribution
+from postroj.util import stdout_to_stderr
 
 logger = logging.getLogger(__name__)
 
 
-def pull_single_image(name: str):
+def pull_single_image(name: str, update: bool = False):
     """
     Resolve image label and pull artefacts from network.
+
+    By default, the image is acquired from scratch. With `update`, only
+    changes from upstream are acquired and applied incrementally.
+    """
+    distribution = find_distribution(name)
+    return ImageProvider(distribution=distribution, force=not update, update=update)
+
+
+def rollback_image(name: str):
+    """
+    Resolve image label, and activate the previous version of the image.
     """
     distribution = find_distribution(name)
-    return ImageProvider(distribution=distribution, force=True)
+    return ImageProvider(distribution=distribution, autosetup=False).rollback()
+
+
+def save_image(name: str, target: BinaryIO, compression: Optional[str] = "zstd") -> BundleStats:
+    """
+    Resolve image label or container image name, and write the image as a bundle to `target`.
+    """
+    distribution = resolve_distribution(name)
+    provider = ImageProvider(distribution=distribution, autosetup=False)
+    return BundleWriter(compression=compression).write(provider, target)
+
+
+def load_image(source: BinaryIO, tag: Optional[str] = None, digest: Optional[str] = None) -> ImageProvider:
+    """
+    Load an image bundle, or a `docker save` archive, from `source`, and activate the image.
+    """
+    return BundleLoader().load(source, tag=tag, digest=digest)
+
+
+def publish_image(name: str) -> BundleStats:
+    """
+    Resolve image label or container image name, and publish its provisioning layer to the substituter.
+    """
+    distribution = resolve_distribution(name)
+    provider = ImageProvider(distribution=distribution, autosetup=False)
+    substituter = provider.substituter()
+    if substituter is None:
+        raise ValueError("Unable to publish image. Reason: No substituter configured")
+    if not provider.layer_path.exists():
+        raise InvalidPhysicalImage(f"Unable to publish image {name}. Reason: Image has not been provisioned")
+    try:
+        key = provider.layer_path.resolve().name
+        return substituter.publish(key, provider.provisioning_cache, name=distribution.fullname)
+    finally:
+        substituter.close()
 
 
-def pull_multiple_images(names: List[str]):
+def pull_multiple_images(names: List[str], jobs: int = 1, update: bool = False):
     """
     Pull multiple images from network.
+
+    Up to `jobs` images are pulled concurrently, so that downloading, extracting
+    and provisioning of different distributions overlap. When pulling an image
+    fails, the error is reported, and the other images will still be pulled.
     """
-    providers: List[ImageProvider] = []
-    for name in names:
-        try:
-            provider = pull_single_image(name)
-            providers.append(provider)
-        except Exception as ex:
-            logger.error(f"Failed pulling image {name}. Reason: {ex}")
-    return providers
+    jobs = max(1, min(jobs, len(names) or 1))
+    total = len(names)
+    logger.info(f"Pulling {total} images using {jobs} workers")
+
+    def pull(name: str):
+        logger.info(f"Pulling image {name}")
+        start = time.monotonic()
+        provider = pull_single_image(name, update=update)
+        return provider, time.monotonic() - start
+
+    results = {}
+    failed: List[str] = []
+
+    # Redirecting stdout is not thread-safe, so do it once for all workers.
+    with stdout_to_stderr():
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="postroj-pull") as executor:
+            futures = {executor.submit(pull, name): name for name in names}
+            for number, future in enumerate(as_completed(futures), start=1):
+                name = futures[future]
+                status = f"[{number:>{len(str(total))}}/{total}] {name}"
+                try:
+                    provider, duration = future.result()
+                    results[name] = provider
+                    logger.info(f"{status}: Pulled image in {duration:.1f}s")
+                except Exception as ex:
+                    failed.append(name)
+                    logger.error(f"{status}: Failed pulling image {name}. Reason: {ex}")
+
+    if failed:
+        logger.warning(f"Pulled {len(results)} of {total} images. Failed: {', '.join(failed)}")
+    else:
+        logger.info(f"Pulled {len(results)} of {total} images")
+
+    # Report providers in the same order as requested.
+    return [results[name] for name in names if name in results]
 
 
 def pull_curated_image(image: str) -> Path:
@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 # (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
 from pathlib import Path
-from typing import Union
+from typing import Dict, Optional, Union
 
 import subprocess_tee
 
 from postroj.container import PostrojContainer
+from postroj.overlay import OverlayMount, find_layers
+from postroj.pkgcache import PackageCache
+from postroj.pkgproxy import get_package_proxy, is_package_command
 from postroj.util import LongRunningProcess, _SysExcInfoType, cmd, hcmd, logger
 
 
@@ -17,6 +20,9 @@ class NspawnBackend:
     def __init__(self, container: PostrojContainer):
         self.container = container
         self.launcher = NspawnLauncher(container=self.container)
+        self.overlay: Optional[OverlayMount] = None
+        self.package_cache: Optional[PackageCache] = None
+        self.environment: Dict[str, str] = {}
 
     def launch(self):
         """
@@ -30,13 +36,34 @@ class NspawnBackend:
         TODO: What about `--notify-ready=true`?
         """
         cache_directory = self.container.settings.cache_directory
+
+        # Stack the provisioning layer over the pristine base image, read-only.
+        rootfs = self.container.rootfs
+        layers = find_layers(self.container.image_path)
+        if layers:
+            self.overlay = OverlayMount(
+                lower=layers + [rootfs], target=self.container.settings.mount_directory / self.container.machine
+            )
+            rootfs = self.overlay.mount()
+            logger.info(f"Using provisioning layer {layers[0]} over base image {self.container.rootfs}")
+
+        # Bind the package cache of the distribution to the cache directory of its package manager.
+        self.package_cache = PackageCache.for_rootfs(self.container.image_path.name, rootfs)
+        options = self.package_cache.attach() if self.package_cache else []
+
+        # Route package downloads of package managers run on the container through the package proxy.
+        package_proxy = get_package_proxy()
+        if package_proxy is not None:
+            self.environment = package_proxy.environment
+            options += package_proxy.bind_options(rootfs)
+
         command = f"""
             /usr/bin/systemd-nspawn \
             --quiet --boot --link-journal=try-guest \
             --volatile=overlay \
             --bind-ro=/etc/resolv.conf:/etc/resolv.conf \
-            --bind={cache_directory}:{cache_directory} \
-            --directory={self.container.rootfs} \
+            --bind={cache_directory}:{cache_directory} {' '.join(options)} \
+            --directory={rootfs} \
             --machine={self.container.machine}
         """.strip()
         logger.info(f"Launch command is: {command}")
@@ -49,17 +76,22 @@ class NspawnBackend:
         """
         return hcmd(f"/bin/machinectl terminate {self.container.machine}")
 
-    def run(self, *args, **kwargs):
+    def run(self, machine: str, command: str, **kwargs):
         """
-        Run a command inside a container.
+        Run a command inside a container. Package managers use the package proxy, if any.
         """
-        return ccmd(*args, **kwargs)
+        environment = self.environment if is_package_command(command) else None
+        return ccmd(machine, command, environment=environment, **kwargs)
 
     def shutdown(self):
         """
         Shutdown container wrapper.
         """
         self.launcher.stop()
+        if self.overlay is not None:
+            self.overlay.unmount(lazy=True)
+        if self.package_cache is not None:
+            self.package_cache.detach()
 
 
 class NspawnLauncher(LongRunningProcess):
@@ -90,27 +122,50 @@ class NspawnLauncher(LongRunningProcess):
         return exc_info
 
 
-def scmd(directory: Union[Path, str], command: str, passthrough: bool = True, capture: bool = False):
+def scmd(
+    directory: Union[Path, str],
+    command: str,
+    passthrough: bool = True,
+    capture: bool = False,
+    package_cache: Optional[PackageCache] = None,
+):
     """
-    Run command within root filesystem.
+    Run command within root filesystem, optionally attaching a package cache, and using the package proxy.
     """
     logger.info(f"Running command within rootfs at {directory}: {command}")
-    return cmd(
-        f"systemd-nspawn --directory={directory} --bind-ro=/etc/resolv.conf:/etc/resolv.conf --pipe {command}",
-        passthrough=passthrough,
-        capture=capture,
-    )
-
-
-def ccmd(machine: str, command: str, use_pty: bool = False, capture: bool = False):
+    options = ["--bind-ro=/etc/resolv.conf:/etc/resolv.conf"]
+    package_proxy = get_package_proxy()
+    if package_proxy is not None:
+        options += package_proxy.options(directory)
+    if package_cache is not None:
+        options += package_cache.attach()
+    try:
+        return cmd(
+            f"systemd-nspawn --directory={directory} {' '.join(options)} --pipe {command}",
+            passthrough=passthrough,
+            capture=capture,
+        )
+    finally:
+        if package_cache is not None:
+            package_cache.detach()
+
+
+def ccmd(
+    machine: str,
+    command: str,
+    use_pty: bool = False,
+    capture: bool = False,
+    environment: Optional[Dict[str, str]] = None,
+):
     """
-    Run command on spawned container.
+    Run command on spawned container, optionally setting environment variables.
     """
     logger.info(f"Running command on container machine {machine}: {command}")
     pty = ""
     if use_pty:
         pty = "--pty"
+    setenv = "".join(f" --setenv={name}={value}" for name, value in (environment or {}).items())
     # TODO: Maybe add `--collect`?
-    command = f"systemd-run --machine={machine} --wait --pipe --quiet {pty} {command}"
+    command = f"systemd-run --machine={machine} --wait --pipe --quiet{setenv} {pty} {command}"
     logger.debug(f"Effective command is: {command}")
     return cmd(command, capture=capture, use_pty=use_pty)
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import dataclasses
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from postroj.dedupe import read_xattrs
+from postroj.download import MB, ArchiveExtractor, close_quietly, detect_compression, hash_chunks, read_chunks
+from postroj.exceptions import DigestMismatch, InvalidPhysicalImage
+from postroj.image import ImageProvider
+from postroj.model import ConfigurationOptions, LinuxDistribution
+from postroj.oci.client import ANNOTATION_SOURCE_NAME, OCI_CONFIG, OCI_MANIFEST, write_layout
+from postroj.oci.store import BlobStore
+from postroj.registry import find_distribution, resolve_distribution
+from postroj.settings import get_appsettings
+from postroj.util import is_dir_empty, resolve_in_root
+
+logger = logging.getLogger(__name__)
+
+
+# Identify the format of image bundles, in order to reject incompatible ones.
+BUNDLE_FORMAT = "postroj-bundle"
+BUNDLE_VERSION = 1
+
+# Members of an image bundle.
+METADATA_FILE = "bundle.json"
+IMAGE_DIRECTORY = "image"
+LAYER_DIRECTORY = "layer"
+
+# `docker save` archives describe their images within this file.
+DOCKER_MANIFEST_FILE = "manifest.json"
+
+# Programs for compressing bundles, in order of preference.
+COMPRESSORS = {
+    "zstd": [
+        ["zstd", "--threads=0", "--stdout"],
+    ],
+    "gzip": [
+        ["pigz", "--stdout"],
+        ["gzip", "--stdout"],
+    ],
+    "xz": [
+        ["xz", "--threads=0", "--stdout"],
+    ],
+}
+
+# Extended attributes which are specific to the host, and not included into bundles.
+EXCLUDED_XATTRS = ["security.selinux"]
+
+# Retain ownership and extended attributes when extracting bundles. Within provisioning
+# layers, extended attributes designate opaque directories of the overlay filesystem.
+EXTRACT_OPTIONS = ["--numeric-owner", "--xattrs", "--xattrs-include=*", "--warning=no-unknown-keyword"]
+
+# Media types of uncompressed and compressed layers, by compression format.
+LAYER_MEDIA_TYPES = {
+    None: "application/vnd.oci.image.layer.v1.tar",
+    "gzip": "application/vnd.oci.image.layer.v1.tar+gzip",
+    "zstd": "application/vnd.oci.image.layer.v1.tar+zstd",
+}
+
+
+@dataclasses.dataclass
+class BundleStats:
+    """
+    Capture information about writing an image bundle.
+    """
+
+    name: str
+    compression: Optional[str] = None
+    size: int = 0
+    digest: Optional[str] = None
+    seconds: float = 0.0
+
+    def __str__(self):
+        seconds = self.seconds or 1e-9
+        return (
+            f"Wrote bundle of image {self.name} with {self.size} bytes in {self.seconds:.2f}s "
+            f"({self.size / seconds / MB:.1f} MB/s {self.compression or 'uncompressed'}), digest {self.digest}"
+        )
+
+
+class BundleWriter:
+    """
+    Write a provisioned image as a single bundle, in order to roll it out to
+    other hosts, without acquiring and provisioning it again on each of them.
+
+    A bundle is a tar archive, optionally compressed, containing the metadata
+    of the image at ``bundle.json``, the current version of the image at
+    ``image``, and its provisioning layer at ``layer``. It is written in a
+    single pass, without staging it on disk, so it can be piped to another
+    host, for example using ssh. Ownership, hardlinks, device nodes, and
+    extended attributes are retained.
+
+    While writing, the bundle is hashed, in order to verify it when loading
+    it, see `BundleLoader`.
+    """
+
+    def __init__(self, compression: Optional[str] = "zstd"):
+        self.compression = compression
+
+    def write(self, provider: ImageProvider, target: BinaryIO) -> BundleStats:
+        """
+        Write the current version of the image to `target`.
+        """
+        name = provider.distribution.fullname
+        version = provider.image_staging.resolve()
+        if not version.is_dir() or is_dir_empty(version):
+            raise InvalidPhysicalImage(f"Unable to save image {name}. Reason: Image has not been acquired")
+        layer = provider.layer_path.resolve() if provider.layer_path.exists() else None
+        metadata = self.metadata(provider, layer)
+        trees = [(version, IMAGE_DIRECTORY)]
+        if layer is not None:
+            trees.append((layer, LAYER_DIRECTORY))
+        logger.info(f"Saving image {name} from {version}")
+        return self.write_trees(name, metadata, trees, target)
+
+    def write_trees(self, name: str, metadata: dict, trees: List[Tuple[Path, str]], target: BinaryIO) -> BundleStats:
+        """
+        Write a bundle with the given metadata, and directory trees, designated by their names within the bundle.
+        """
+        stats = BundleStats(name=name, compression=self.compression)
+        start = time.monotonic()
+        command = compressor_command(self.compression) if self.compression else None
+        output = BundleOutput(target, command=command)
+        try:
+            with tarfile.open(fileobj=output, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                add_bytes(tar, METADATA_FILE, json.dumps(metadata, indent=2).encode())
+                for root, arcname in trees:
+                    add_tree(tar, root, arcname)
+        except BaseException:
+            output.abort()
+            raise
+        output.close()
+
+        stats.size = output.size
+        stats.digest = output.digest
+        stats.seconds = time.monotonic() - start
+        logger.info(stats)
+        return stats
+
+    @staticmethod
+    def metadata(provider: ImageProvider, layer: Optional[Path]) -> dict:
+        """
+        Describe the image, its origin, and its provisioning layer.
+        """
+        record = provider.index.get(provider.distribution.fullname)
+        metadata = {
+            "format": BUNDLE_FORMAT,
+            "version": BUNDLE_VERSION,
+            "name": provider.distribution.fullname,
+            "source": provider.distribution.image,
+            "digest": record and record.digest,
+            "size": record and record.size,
+            "os_release": record and record.os_release,
+            "created": time.time(),
+            "layer": None,
+        }
+        if layer is not None:
+            layer_metadata = provider.provisioning_cache.metadata(layer.name) or {}
+            metadata["layer"] = {"key": layer.name, "components": layer_metadata.get("components", {})}
+        return metadata
+
+
+class BundleOutput:
+    """
+    A file-like object writing to `target`, optionally through a compression
+    program, while hashing the outcome.
+    """
+
+    def __init__(self, target: BinaryIO, command: Optional[List[str]] = None):
+        self.target = target
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.error: Optional[BaseException] = None
+        self.compressor: Optional[subprocess.Popen] = None
+        self.relay: Optional[threading.Thread] = None
+        if command is not None:
+            logger.info(f"Compressing bundle using `{' '.join(command)}`")
+            self.compressor = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.relay = threading.Thread(target=self.forward, name="postroj-compress", daemon=True)
+            self.relay.start()
+
+    @property
+    def digest(self) -> str:
+        return f"sha256:{self.hasher.hexdigest()}"
+
+    def write(self, data: bytes) -> int:
+        if self.compressor is None:
+            self.emit(data)
+        else:
+            try:
+                self.compressor.stdin.write(data)
+            except BrokenPipeError:
+                # The compressor has been terminated, because writing to the target failed.
+                self.relay.join()
+                if self.error is not None:
+                    raise self.error
+                raise
+        return len(data)
+
+    def emit(self, data: bytes):
+        self.target.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+
+    def forward(self):
+        """
+        Relay compressed data to the target.
+        """
+        try:
+            for chunk in read_chunks(self.compressor.stdout):
+                self.emit(chunk)
+        except BaseException as ex:
+            self.error = ex
+            self.compressor.kill()
+
+    def close(self):
+        """
+        Signal the end of the bundle, wait for the compression program, and check its exit code.
+        """
+        if self.compressor is not None:
+            close_quietly(self.compressor.stdin)
+            self.relay.join()
+            returncode = self.compressor.wait()
+            if self.error is not None:
+                raise self.error
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, self.compressor.args)
+        self.target.flush()
+
+    def abort(self):
+        if self.compressor is not None:
+            self.compressor.kill()
+            close_quietly(self.compressor.stdin)
+            self.relay.join()
+            self.compressor.wait()
+
+
+class BundleLoader:
+    """
+    Load an image bundle written by `BundleWriter`, or a ``docker save``
+    archive, into the archive directory, and activate it, without contacting
+    any registry.
+
+    The archive is read in a single pass, and extracted while it is being
+    received, so it can be piped from another host, for example using ssh.
+    It is extracted into a staging directory within the archive directory,
+    from where its parts are moved into place.
+
+    Images from ``docker save`` archives are imported into the blob store,
+    and unpacked like images pulled from a registry. They are named by
+    their tag, like ``debian:bookworm-slim``, so ``racker run`` will use them.
+    """
+
+    def __init__(self, settings: Optional[ConfigurationOptions] = None):
+        self.settings = settings or get_appsettings()
+        self.blob_store = BlobStore(self.settings.blob_directory)
+
+    def load(self, source: BinaryIO, tag: Optional[str] = None, digest: Optional[str] = None) -> ImageProvider:
+        """
+        Load image from `source`, and return its provider.
+
+        When loading a `docker save` archive with multiple images, `tag` selects
+        one of them. When the image is untagged, `tag` names it. When `digest`
+        is given, the archive is verified against it before activating the image.
+        """
+        staging = self.settings.archive_directory / f"load-{os.getpid()}-{time.time_ns()}.partial"
+        staging.mkdir(parents=True)
+        try:
+            hasher = hashlib.sha256()
+            stats = ArchiveExtractor.untar(hash_chunks(read_chunks(source), hasher), staging, options=EXTRACT_OPTIONS)
+            logger.info(stats)
+            actual = f"sha256:{hasher.hexdigest()}"
+            if digest is not None and digest != actual:
+                raise DigestMismatch(f"Digest mismatch for bundle: Expected {digest}, got {actual}")
+            logger.info(f"Received archive with digest {actual}")
+
+            if (staging / METADATA_FILE).exists():
+                provider = self.load_bundle(staging)
+            elif (staging / DOCKER_MANIFEST_FILE).exists():
+                provider = self.load_docker_archive(staging, tag=tag)
+            else:
+                raise InvalidPhysicalImage(
+                    "Unable to load image. Reason: Archive is neither an image bundle, nor a `docker save` archive"
+                )
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        logger.info(f"Loaded image {provider.distribution.fullname}")
+        return provider
+
+    def load_bundle(self, staging: Path) -> ImageProvider:
+        """
+        Move the image version and provisioning layer of an extracted image bundle into place.
+        """
+        metadata = json.loads((staging / METADATA_FILE).read_text())
+        if metadata.get("format") != BUNDLE_FORMAT or metadata.get("version") != BUNDLE_VERSION:
+            raise InvalidPhysicalImage(
+                f"Unable to load image. Reason: Unsupported bundle format "
+                f"{metadata.get('format')} version {metadata.get('version')}"
+            )
+        distribution = bundle_distribution(metadata)
+        provider = ImageProvider(distribution=distribution, autosetup=False)
+        provider.load_bundle(staging, metadata)
+        return provider
+
+    def load_docker_archive(self, staging: Path, tag: Optional[str] = None) -> ImageProvider:
+        """
+        Import an image from an extracted `docker save` archive into the blob store,
+        and unpack it from an OCI image layout referencing its blobs.
+
+        Both the legacy layout, and the OCI image layout written by Docker 25 and
+        newer, describe their images within `manifest.json`.
+        """
+        entries = json.loads((staging / DOCKER_MANIFEST_FILE).read_text())
+        entry, tag = select_docker_image(entries, tag)
+        logger.info(f"Importing image {tag} from `docker save` archive")
+
+        descriptors: Dict[Path, dict] = {}
+
+        def adopt(name: str, media_type: Optional[str] = None) -> dict:
+            path = resolve_in_root(staging, name)
+            if path not in descriptors:
+                with open(path, "rb") as f:
+                    compression = detect_compression(f.read(8))
+                if media_type is None:
+                    if compression not in LAYER_MEDIA_TYPES:
+                        raise InvalidPhysicalImage(
+                            f"Unable to load image. Reason: Unsupported layer compression {compression}"
+                        )
+                    media_type = LAYER_MEDIA_TYPES[compression]
+                size = path.stat().st_size
+                digest = self.blob_store.adopt(path)
+                descriptors[path] = {"mediaType": media_type, "digest": digest, "size": size}
+            return descriptors[path]
+
+        self.blob_store.setup()
+        layout = staging / "layout"
+        with self.blob_store.lock():
+            manifest = {
+                "schemaVersion": 2,
+                "mediaType": OCI_MANIFEST,
+                "config": adopt(entry["Config"], media_type=OCI_CONFIG),
+                "layers": [adopt(name) for name in entry["Layers"]],
+            }
+            write_layout(
+                self.blob_store,
+                layout,
+                json.dumps(manifest, indent=2).encode(),
+                tag="default",
+                annotations={ANNOTATION_SOURCE_NAME: tag},
+            )
+
+        provider = ImageProvider(distribution=resolve_distribution(tag), autosetup=False)
+        provider.load_layout(layout)
+        return provider
+
+
+def bundle_distribution(metadata: dict) -> LinuxDistribution:
+    """
+    Resolve the distribution of an image bundle, either a curated one, or a container image.
+    """
+    try:
+        distribution = find_distribution(metadata["name"])
+    except ValueError:
+        distribution = resolve_distribution(metadata["source"])
+    if distribution.fullname != metadata["name"]:
+        raise InvalidPhysicalImage(f"Unable to load image. Reason: Unknown image {metadata['name']}")
+    return distribution
+
+
+def select_docker_image(entries: List[dict], tag: Optional[str] = None) -> Tuple[dict, str]:
+    """
+    Select an image from the manifest of a `docker save` archive, and return it together with its tag.
+    """
+    if tag is not None:
+        for entry in entries:
+            if tag in (entry.get("RepoTags") or []):
+                return entry, tag
+        if len(entries) == 1:
+            return entries[0], tag
+        raise InvalidPhysicalImage(f"Unable to load image. Reason: Archive does not contain image {tag}")
+    if len(entries) != 1:
+        tags = [tag for entry in entries for tag in entry.get("RepoTags") or []]
+        raise InvalidPhysicalImage(
+            f"Unable to load image. Reason: Archive contains {len(entries)} images, "
+            f"select one of them using `--tag`: {', '.join(tags)}"
+        )
+    tags = entries[0].get("RepoTags") or []
+    if not tags:
+        raise InvalidPhysicalImage("Unable to load image. Reason: Image is untagged, name it using `--tag`")
+    return entries[0], tags[0]
+
+
+def add_bytes(tar: tarfile.TarFile, name: str, data: bytes):
+    """
+    Add a file with the given content to the archive.
+    """
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tarinfo.mode = 0o644
+    tarinfo.mtime = int(time.time())
+    tar.addfile(tarinfo, io.BytesIO(data))
+
+
+def add_tree(tar: tarfile.TarFile, root: Path, arcname: str):
+    """
+    Add a directory tree to the archive, recording extended attributes
+    within PAX headers, like GNU tar does.
+    """
+
+    def attach_xattrs(tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
+        path = root / os.path.relpath(tarinfo.name, arcname)
+        for name, value in read_xattrs(path).items():
+            if name not in EXCLUDED_XATTRS:
+                tarinfo.pax_headers[f"SCHILY.xattr.{name}"] = value.decode("utf-8", "surrogateescape")
+        return tarinfo
+
+    tar.add(str(root), arcname=arcname, filter=attach_xattrs)
+
+
+def compressor_command(compression: str) -> List[str]:
+    """
+    Select the most capable compression program available for the given compression format.
+    """
+    if compression not in COMPRESSORS:
+        raise ValueError(f"Unsupported compression format: {compression}")
+    candidates = COMPRESSORS[compression]
+    for command in candidates:
+        if shutil.which(command[0]):
+            return command
+    raise InvalidPhysicalImage(f"Unable to save image. Reason: {compression} compression needs `{candidates[-1][0]}`")
@@ -1,53 +1,279 @@
 # -*- coding: utf-8 -*-
 # (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import dataclasses
 import json
 
 import click
 
 from postroj import pkgprobe, runner, selftest, winrunner
-from postroj.api import pull_multiple_images, pull_single_image
+from postroj.api import (
+    load_image,
+    publish_image,
+    pull_multiple_images,
+    pull_single_image,
+    rollback_image,
+    save_image,
+)
+from postroj.bundle import COMPRESSORS
+from postroj.dedupe import Deduplicator
+from postroj.index import ImageIndex
+from postroj.packing import PACK_FORMATS
+from postroj.pkgproxy import PackageProxy
+from postroj.prune import Pruner, parse_size
 from postroj.registry import list_images
-from postroj.util import boot
+from postroj.settings import get_appsettings
+from postroj.util import boot, configure_storage, storage_options
 
 
 @click.group()
 @click.version_option(package_name="racker")
 @click.option("--verbose", is_flag=True, required=False)
 @click.option("--debug", is_flag=True, required=False)
+@storage_options
 @click.pass_context
-def cli(ctx: click.Context, verbose: bool, debug: bool):
+def cli(ctx: click.Context, verbose: bool, debug: bool, **storage):
+    configure_storage(**storage)
     return boot(ctx, verbose, debug)
 
 
 @click.command()
+@click.option("--details", is_flag=True, required=False, help="List images present on disk, with details")
 @click.pass_context
-def cli_list_images(ctx: click.Context):
+def cli_list_images(ctx: click.Context, details: bool = False):
     """
     List all available filesystem images
     """
-    print(json.dumps(list_images(), indent=2))
+    if details:
+        records = ImageIndex(get_appsettings().index_path).all()
+        print(json.dumps([dataclasses.asdict(record) for record in records], indent=2))
+    else:
+        print(json.dumps(list_images(), indent=2))
+
+
+def size_option(ctx: click.Context, param: click.Parameter, value: str):
+    if value is None:
+        return None
+    try:
+        return parse_size(value)
+    except ValueError as ex:
+        raise click.BadParameter(str(ex))
 
 
 @click.command()
 @click.argument("name", type=str, required=False)
 @click.option("--all", "pull_all", is_flag=True, required=False)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of images to pull concurrently, overlapping their downloads, extraction, and provisioning. "
+    "Defaults to one after another, because concurrent pulls interleave their log output, "
+    "and boot several containers for provisioning at the same time",
+)
+@click.option("--update", is_flag=True, required=False, help="Only acquire and apply changes from upstream")
+@click.option("--keep-downloads", is_flag=True, required=False, help="Retain downloaded archives for reuse")
+@click.option(
+    "--pack",
+    "pack_format",
+    type=click.Choice(list(PACK_FORMATS)),
+    envvar="POSTROJ_PACK_FORMAT",
+    help="Pack images into a compressed read-only image, and activate that",
+)
+@click.option(
+    "--substituter",
+    envvar="POSTROJ_SUBSTITUTER",
+    help="Directory or HTTP endpoint of a binary cache for provisioned images",
+)
+@click.option(
+    "--publish",
+    is_flag=True,
+    required=False,
+    envvar="POSTROJ_PUBLISH",
+    help="Publish images provisioned locally to the substituter",
+)
+@click.option(
+    "--lock-timeout",
+    type=float,
+    envvar="POSTROJ_LOCK_TIMEOUT",
+    help="Maximum time in seconds to wait for another process pulling the same image",
+)
+@click.option(
+    "--prune-budget",
+    envvar="POSTROJ_PRUNE_BUDGET",
+    callback=size_option,
+    help="Afterwards, prune least recently used artefacts until disk usage fits into this size, like `20G`",
+)
 @click.pass_context
-def cli_pull(ctx: click.Context, name: str, pull_all: bool = False):
+def cli_pull(
+    ctx: click.Context,
+    name: str,
+    pull_all: bool = False,
+    jobs: int = 1,
+    update: bool = False,
+    keep_downloads: bool = False,
+    pack_format: str = None,
+    substituter: str = None,
+    publish: bool = False,
+    lock_timeout: float = None,
+    prune_budget: int = None,
+):
     """
     Pull curated rootfs images from suitable locations.
     """
     if not name and not pull_all:
         raise click.BadOptionUsage(option_name="name", message="Need image name or `--all`")
 
+    if keep_downloads:
+        get_appsettings().keep_downloads = True
+    if pack_format:
+        get_appsettings().pack_format = pack_format
+    if substituter:
+        get_appsettings().substituter = substituter
+    if publish:
+        get_appsettings().publish = True
+    if lock_timeout is not None:
+        get_appsettings().lock_timeout = lock_timeout
+
     if pull_all:
         names = list_images()
-        pull_multiple_images(names)
+        pull_multiple_images(names, jobs=jobs, update=update)
     else:
-        pull_single_image(name)
+        pull_single_image(name, update=update)
+
+    if prune_budget is not None:
+        Pruner().prune(budget=prune_budget)
+
+
+@click.command()
+@click.argument("name", type=str, required=True)
+@click.pass_context
+def cli_rollback(ctx: click.Context, name: str):
+    """
+    Activate the previous version of an image.
+    """
+    version = rollback_image(name)
+    print(version)
+
+
+@click.command()
+@click.argument("name", type=str, required=True)
+@click.option(
+    "--substituter",
+    envvar="POSTROJ_SUBSTITUTER",
+    required=True,
+    help="Directory or HTTP endpoint of a binary cache for provisioned images",
+)
+@click.pass_context
+def cli_publish(ctx: click.Context, name: str, substituter: str):
+    """
+    Publish the provisioning layer of an image to a substituter
+    """
+    get_appsettings().substituter = substituter
+    stats = publish_image(name)
+    print(json.dumps(dataclasses.asdict(stats), indent=2))
+
+
+@click.command()
+@click.argument("name", type=str, required=True)
+@click.option("--output", "-o", type=click.File("wb"), default="-", help="Write bundle to file instead of stdout")
+@click.option(
+    "--compression",
+    type=click.Choice(list(COMPRESSORS) + ["none"]),
+    default="zstd",
+    show_default=True,
+    envvar="POSTROJ_BUNDLE_COMPRESSION",
+    help="Compression format of the bundle",
+)
+@click.pass_context
+def cli_save(ctx: click.Context, name: str, output, compression: str = "zstd"):
+    """
+    Write a provisioned image as a bundle, to be loaded on other hosts
+    """
+    if output.isatty():
+        raise click.UsageError("Refusing to write bundle to a terminal, use `--output` or redirect stdout")
+    save_image(name, output, compression=None if compression == "none" else compression)
+
+
+@click.command()
+@click.argument("input", type=click.File("rb"), default="-")
+@click.option("--tag", type=str, required=False, help="Select or name the image, when loading a `docker save` archive")
+@click.option("--digest", type=str, required=False, help="Verify the bundle against this digest, like `sha256:...`")
+@click.pass_context
+def cli_load(ctx: click.Context, input, tag: str = None, digest: str = None):
+    """
+    Load and activate an image bundle, or a `docker save` archive
+    """
+    provider = load_image(input, tag=tag, digest=digest)
+    print(provider.distribution.fullname)
+
+
+@click.command()
+@click.option(
+    "--budget",
+    envvar="POSTROJ_PRUNE_BUDGET",
+    callback=size_option,
+    help="Only prune least recently used artefacts until disk usage fits into this size, like `20G`",
+)
+@click.option("--dry-run", is_flag=True, required=False, help="Only report what would be pruned")
+@click.pass_context
+def cli_prune(ctx: click.Context, budget: int = None, dry_run: bool = False):
+    """
+    Remove images not activated, unused provisioning layers, downloads, and leftovers
+    """
+    report = Pruner().prune(budget=budget, dry_run=dry_run)
+    print(json.dumps(report.to_dict(), indent=2))
+
+
+@click.command()
+@click.option("--jobs", type=int, required=False, help="Number of files to hash concurrently")
+@click.option(
+    "--method",
+    type=click.Choice(["auto", "reflink", "hardlink"]),
+    default="auto",
+    help="Share files using reflinks or hardlinks. `auto` uses reflinks when supported",
+)
+@click.option("--ignore-time", is_flag=True, required=False, help="Hardlink files with different modification times")
+@click.option("--dry-run", is_flag=True, required=False, help="Only report what would be deduplicated")
+@click.pass_context
+def cli_dedupe(
+    ctx: click.Context, jobs: int = None, method: str = "auto", ignore_time: bool = False, dry_run: bool = False
+):
+    """
+    Share the storage of identical files across images within the archive
+    """
+    deduplicator = Deduplicator(max_workers=jobs, method=method, ignore_time=ignore_time)
+    report = deduplicator.run(dry_run=dry_run)
+    print(json.dumps(dataclasses.asdict(report), indent=2))
+
+
+@click.command()
+@click.option(
+    "--listen", type=str, default="127.0.0.1", help="Address to listen on, use `0.0.0.0` to serve other hosts"
+)
+@click.option("--port", type=int, default=3142, help="Port to listen on")
+@click.option("--offline", is_flag=True, required=False, help="Serve responses from the cache only")
+@click.pass_context
+def cli_package_proxy(ctx: click.Context, listen: str, port: int, offline: bool = False):
+    """
+    Run the caching package proxy in the foreground, for serving other hosts
+    """
+    settings = get_appsettings()
+    offline = offline or settings.package_proxy_offline
+    proxy = PackageProxy(settings.package_proxy_directory, host=listen, port=port, offline=offline)
+    proxy.serve_forever()
 
 
 cli.add_command(cmd=cli_list_images, name="list-images")
 cli.add_command(cmd=cli_pull, name="pull")
+cli.add_command(cmd=cli_rollback, name="rollback")
+cli.add_command(cmd=cli_publish, name="publish")
+cli.add_command(cmd=cli_save, name="save")
+cli.add_command(cmd=cli_load, name="load")
+cli.add_command(cmd=cli_prune, name="prune")
+cli.add_command(cmd=cli_dedupe, name="dedupe")
+cli.add_command(cmd=cli_package_proxy, name="package-proxy")
 cli.add_command(cmd=runner.invoke, name="invoke")
 cli.add_command(cmd=pkgprobe.main, name="pkgprobe")
 cli.add_command(cmd=selftest.selftest_main, name="selftest")
@@ -7,6 +7,7 @@ import time
 from pathlib import Path
 from typing import Optional, Tuple, Union
 
+from postroj.packing import LoopMount, is_packed_image
 from postroj.settings import get_appsettings
 from postroj.util import find_rootfs, fix_tty, hcmd, mask_logging, noop, print_header
 
@@ -29,6 +30,9 @@ class PostrojContainer:
         self.image_path: Path = Path(image_path)
         self.rootfs: Optional[Path] = None
 
+        # The loop mount of a packed image.
+        self.image_mount: Optional[LoopMount] = None
+
         self.settings = get_appsettings()
 
         # Augment the machine name.
@@ -62,8 +66,18 @@ class PostrojContainer:
 
         print_header(f"Spawning container {self.machine} with filesystem at {self.image_path}")
 
+        # Pin the version of the image, in case another one is activated meanwhile.
+        root_path = self.image_path.resolve()
+
+        # Packed images are booted from a read-only loop mount.
+        if is_packed_image(root_path):
+            mount_path = self.settings.mount_directory / f"{self.machine}.image"
+            self.image_mount = LoopMount(image=root_path, target=mount_path)
+            root_path = self.image_mount.mount()
+            logger.info(f"Mounted packed image {self.image_mount.image} at {root_path}")
+
         # Check if rootfs is nested.
-        self.rootfs = find_rootfs(self.image_path)
+        self.rootfs = find_rootfs(root_path)
 
         """
         if not self.is_down():
@@ -245,3 +259,6 @@ class PostrojContainer:
 
         if self.backend:
             self.backend.shutdown()
+
+        if self.image_mount is not None:
+            self.image_mount.unmount(lazy=True)
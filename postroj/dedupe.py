@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import dataclasses
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import sqlite3
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Generator, List, Optional, Tuple
+
+from postroj.download import CHUNK_SIZE
+from postroj.exceptions import LockTimeout
+from postroj.lock import FileLock
+from postroj.model import ConfigurationOptions
+from postroj.settings import get_appsettings
+from postroj.store import INCOMING_PREFIX
+
+logger = logging.getLogger(__name__)
+
+
+# `ioctl` request for cloning a file, sharing its extents. See `ioctl_ficlone(2)`.
+FICLONE = 0x40049409
+
+# Entries within the archive directory which are not deduplicated. OCI blobs are
+# already shared by hardlinking, and the link count is their reference count.
+EXCLUDE_NAMES = ["blobs", "index.sqlite", "index.sqlite-wal", "index.sqlite-shm"]
+
+# Entries at any depth which are not deduplicated, because they are being built or
+# mounted, like provisioning layers, staging directories, and their overlay mounts.
+EXCLUDE_SUFFIXES = [".oci", ".partial", ".previous", ".work", ".mnt", ".tmp", ".staging", ".lock"]
+EXCLUDE_PREFIXES = [INCOMING_PREFIX]
+
+# Suffix of temporary files, while replacing files.
+TEMPORARY_SUFFIX = ".dedupe"
+
+# Errors signalling that the filesystem does not support cloning files.
+REFLINK_UNSUPPORTED = [errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS]
+
+HASH_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    device INTEGER,
+    inode INTEGER,
+    size INTEGER,
+    mtime INTEGER,
+    digest TEXT,
+    PRIMARY KEY (device, inode)
+)
+"""
+
+Inode = Tuple[int, int]
+
+
+@dataclasses.dataclass
+class DedupeReport:
+    files: int = 0
+    inodes: int = 0
+    hashed: int = 0
+    cached: int = 0
+    reflinked: int = 0
+    hardlinked: int = 0
+    skipped: int = 0
+    saved: int = 0
+    seconds: float = 0
+
+    def __str__(self):
+        return (
+            f"Scanned {self.files} files with {self.inodes} distinct inodes, hashed {self.hashed}, "
+            f"{self.cached} hashes from cache. Reflinked {self.reflinked} and hardlinked {self.hardlinked} "
+            f"files, saving {self.saved} bytes in {self.seconds:.2f}s"
+        )
+
+
+@dataclasses.dataclass
+class FileEntry:
+    """
+    A file within the archive, with all of its paths, when hardlinked.
+    """
+
+    paths: List[Path]
+    info: os.stat_result
+    digest: Optional[str] = None
+
+    @property
+    def inode(self) -> Inode:
+        return self.info.st_dev, self.info.st_ino
+
+
+class HashCache:
+    """
+    Remember digests of files across runs, keyed by inode. Entries are only
+    valid as long as size and modification time of the file did not change.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    @contextmanager
+    def connect(self) -> Generator[sqlite3.Connection, None, None]:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                connection.execute(HASH_CACHE_SCHEMA)
+                yield connection
+        finally:
+            connection.close()
+
+    def load(self) -> Dict[Inode, Tuple[int, int, str]]:
+        with self.connect() as connection:
+            rows = connection.execute("SELECT device, inode, size, mtime, digest FROM hashes").fetchall()
+        return {(device, inode): (size, mtime, digest) for device, inode, size, mtime, digest in rows}
+
+    def save(self, entries: List[FileEntry]):
+        rows = [
+            (entry.info.st_dev, entry.info.st_ino, entry.info.st_size, entry.info.st_mtime_ns, entry.digest)
+            for entry in entries
+            if entry.digest is not None
+        ]
+        with self.connect() as connection:
+            connection.execute("DELETE FROM hashes")
+            connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", rows)
+
+
+class Deduplicator:
+    """
+    Find identical files within the archive directory, and share their storage.
+
+    Closely related images, like subsequent releases of a distribution, have
+    many files in common. Identical files are replaced by reflinks, sharing
+    their extents on filesystems supporting it, like Btrfs or XFS. Otherwise,
+    they are replaced by hardlinks, but only when their metadata is identical
+    as well, because hardlinked files share it. Besides saving disk space,
+    shared files improve page cache hit rates when booting sibling images.
+
+    Files are only hashed when another file has the same size. Hashing runs
+    concurrently, and digests are remembered within a hash cache, so
+    subsequent runs only hash new or changed files.
+
+    Sharing files between images is safe, because images are never modified
+    in place. Containers are booted using ``--volatile=overlay``, provisioning
+    writes into a separate layer, and acquiring images again replaces files
+    instead of writing into them. Trees still being built, and mount points,
+    are skipped. Images locked by other processes, for example while acquiring
+    them, are skipped as well, and all other images stay locked while running.
+    """
+
+    def __init__(
+        self,
+        settings: Optional[ConfigurationOptions] = None,
+        max_workers: Optional[int] = None,
+        method: str = "auto",
+        ignore_time: bool = False,
+        min_size: int = 1,
+    ):
+        if method not in ["auto", "reflink", "hardlink"]:
+            raise ValueError(f"Unknown deduplication method: {method}")
+        self.settings = settings or get_appsettings()
+        self.max_workers = max_workers or min(8, os.cpu_count() or 1)
+        self.method = method
+        self.ignore_time = ignore_time
+        self.min_size = min_size
+        self.hash_cache = HashCache(self.settings.cache_directory / "dedupe.sqlite")
+        # Whether cloning files is supported, per device.
+        self.reflink_support: Dict[int, bool] = {}
+        # Names of images locked by other processes.
+        self.busy: List[str] = []
+
+    def run(self, dry_run: bool = False) -> DedupeReport:
+        start = time.monotonic()
+        report = DedupeReport()
+        locks = self.lock_images()
+        try:
+            entries = self.scan(report)
+            self.hash(entries, report)
+
+            groups: Dict[Tuple[int, int, str], List[FileEntry]] = {}
+            for entry in entries:
+                if entry.digest is not None:
+                    groups.setdefault((entry.info.st_dev, entry.info.st_size, entry.digest), []).append(entry)
+            for group in groups.values():
+                if len(group) > 1:
+                    self.share(group, report, dry_run=dry_run)
+        finally:
+            for lock in locks:
+                lock.release()
+
+        if not dry_run:
+            self.hash_cache.save([entry for entry in entries if entry.digest is not None])
+        report.seconds = time.monotonic() - start
+        logger.info(str(report))
+        return report
+
+    def lock_images(self) -> List[FileLock]:
+        """
+        Acquire the locks of all images within the archive directory, without waiting.
+        Images locked by other processes are recorded as busy, in order to skip them.
+        """
+        self.busy = []
+        locks = []
+        for path in sorted(self.settings.archive_directory.glob("*.lock")):
+            lock = FileLock(path, timeout=0)
+            try:
+                locks.append(lock.acquire())
+            except LockTimeout:
+                logger.info(f"Image {path.stem} is in use, skipping it")
+                self.busy.append(path.stem)
+        return locks
+
+    def scan(self, report: DedupeReport) -> List[FileEntry]:
+        """
+        Collect all regular files within the archive directory, grouping hardlinked paths.
+        """
+        entries: Dict[Inode, FileEntry] = {}
+        for directory, dirnames, filenames in os.walk(self.settings.archive_directory):
+            if Path(directory) == self.settings.archive_directory:
+                dirnames[:] = [name for name in dirnames if name not in EXCLUDE_NAMES and not self.is_busy(name)]
+                filenames = [name for name in filenames if name not in EXCLUDE_NAMES and not self.is_busy(name)]
+            dirnames[:] = [
+                name
+                for name in dirnames
+                if not self.is_excluded(name) and not os.path.ismount(os.path.join(directory, name))
+            ]
+            for name in filenames:
+                if name.endswith(TEMPORARY_SUFFIX) or self.is_excluded(name):
+                    continue
+                path = Path(directory) / name
+                info = os.lstat(path)
+                if not stat.S_ISREG(info.st_mode) or info.st_size < self.min_size:
+                    continue
+                report.files += 1
+                inode = (info.st_dev, info.st_ino)
+                if inode in entries:
+                    entries[inode].paths.append(path)
+                else:
+                    entries[inode] = FileEntry(paths=[path], info=info)
+        report.inodes = len(entries)
+        return list(entries.values())
+
+    @staticmethod
+    def is_excluded(name: str) -> bool:
+        return name.endswith(tuple(EXCLUDE_SUFFIXES)) or name.startswith(tuple(EXCLUDE_PREFIXES))
+
+    def is_busy(self, name: str) -> bool:
+        """
+        Whether an entry of the archive directory belongs to an image locked by another process.
+        """
+        return any(name.startswith(f"{image}.") for image in self.busy)
+
+    def hash(self, entries: List[FileEntry], report: DedupeReport):
+        """
+        Compute digests of all files having the same size as another one, using the hash cache.
+        """
+        sizes: Dict[Tuple[int, int], int] = {}
+        for entry in entries:
+            key = (entry.info.st_dev, entry.info.st_size)
+            sizes[key] = sizes.get(key, 0) + 1
+
+        cache = self.hash_cache.load()
+        pending = []
+        for entry in entries:
+            if sizes[(entry.info.st_dev, entry.info.st_size)] < 2:
+                continue
+            cached = cache.get(entry.inode)
+            if cached is not None and cached[:2] == (entry.info.st_size, entry.info.st_mtime_ns):
+                entry.digest = cached[2]
+                report.cached += 1
+            else:
+                pending.append(entry)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="postroj-dedupe") as executor:
+            for entry, digest in zip(pending, executor.map(hash_file, [entry.paths[0] for entry in pending])):
+                entry.digest = digest
+        report.hashed += len(pending)
+
+    def share(self, group: List[FileEntry], report: DedupeReport, dry_run: bool = False):
+        """
+        Share the storage of identical files, keeping the file with the most links.
+        """
+        group = sorted(group, key=lambda entry: entry.info.st_nlink, reverse=True)
+        canonical = group[0]
+        for entry in group[1:]:
+            if not is_unchanged(entry):
+                report.skipped += 1
+                continue
+            try:
+                method = self.link(canonical, entry, dry_run=dry_run)
+            except OSError as ex:
+                if ex.errno == errno.EMLINK:
+                    # The canonical file has reached the maximum number of links, continue with this one.
+                    canonical = entry
+                    continue
+                logger.warning(f"Unable to deduplicate {entry.paths[0]}: {ex}")
+                method = None
+            if method is None:
+                report.skipped += 1
+                continue
+            setattr(report, method, getattr(report, method) + len(entry.paths))
+            report.saved += entry.info.st_blocks * 512
+
+    def link(self, canonical: FileEntry, entry: FileEntry, dry_run: bool = False) -> Optional[str]:
+        """
+        Share the storage of a file with the canonical file, preferring reflinks.
+        Return the name of the method used, or `None`, when the files can not be shared.
+        """
+        if self.use_reflink(canonical):
+            if dry_run or self.reflink(canonical, entry):
+                return "reflinked"
+            self.reflink_support[entry.info.st_dev] = False
+        if self.method == "reflink" or not self.is_compatible(canonical, entry):
+            return None
+        if not dry_run:
+            self.hardlink(canonical, entry)
+        return "hardlinked"
+
+    def use_reflink(self, canonical: FileEntry) -> bool:
+        """
+        Whether to use reflinks, probing the filesystem once per device.
+        """
+        if self.method == "hardlink":
+            return False
+        device = canonical.info.st_dev
+        if device not in self.reflink_support:
+            self.reflink_support[device] = probe_reflink(canonical.paths[0])
+            if not self.reflink_support[device]:
+                logger.info(f"Filesystem of {canonical.paths[0]} does not support reflinks")
+        return self.reflink_support[device]
+
+    def is_compatible(self, canonical: FileEntry, entry: FileEntry) -> bool:
+        """
+        Whether files can be hardlinked, which needs their metadata to be identical.
+        """
+        fields = ["st_mode", "st_uid", "st_gid"]
+        if not self.ignore_time:
+            fields.append("st_mtime_ns")
+        for field in fields:
+            if getattr(canonical.info, field) != getattr(entry.info, field):
+                return False
+        return read_xattrs(canonical.paths[0]) == read_xattrs(entry.paths[0])
+
+    @staticmethod
+    def reflink(canonical: FileEntry, entry: FileEntry) -> bool:
+        """
+        Replace a file by a clone of the canonical file, retaining its metadata.
+        Return `False` when the filesystem does not support cloning files.
+        """
+        target = entry.paths[0]
+        temporary = target.with_name(f".{target.name}{TEMPORARY_SUFFIX}")
+        with open(canonical.paths[0], "rb") as source, open(temporary, "wb") as clone:
+            try:
+                fcntl.ioctl(clone.fileno(), FICLONE, source.fileno())
+            except OSError as ex:
+                if ex.errno in REFLINK_UNSUPPORTED:
+                    os.unlink(temporary)
+                    return False
+                raise
+        try:
+            os.chown(temporary, entry.info.st_uid, entry.info.st_gid)
+            os.chmod(temporary, stat.S_IMODE(entry.info.st_mode))
+            for name, value in read_xattrs(target).items():
+                os.setxattr(temporary, name, value)
+            os.utime(temporary, ns=(entry.info.st_atime_ns, entry.info.st_mtime_ns))
+            os.replace(temporary, target)
+        except OSError:
+            os.unlink(temporary)
+            raise
+        for path in entry.paths[1:]:
+            replace_by_link(target, path)
+        entry.info = os.lstat(target)
+        return True
+
+    @staticmethod
+    def hardlink(canonical: FileEntry, entry: FileEntry):
+        for path in entry.paths:
+            replace_by_link(canonical.paths[0], path)
+        canonical.paths += entry.paths
+        # The inode of the file is gone now, so do not remember its digest.
+        entry.digest = None
+
+
+def replace_by_link(source: Path, target: Path):
+    """
+    Atomically replace a file by a hardlink to another one.
+    """
+    temporary = target.with_name(f".{target.name}{TEMPORARY_SUFFIX}")
+    os.link(source, temporary)
+    try:
+        os.replace(temporary, target)
+    except OSError:
+        os.unlink(temporary)
+        raise
+
+
+def probe_reflink(path: Path) -> bool:
+    """
+    Whether the filesystem of a file supports cloning it.
+    """
+    temporary = path.with_name(f".{path.name}{TEMPORARY_SUFFIX}")
+    try:
+        with open(path, "rb") as source, open(temporary, "wb") as clone:
+            fcntl.ioctl(clone.fileno(), FICLONE, source.fileno())
+        return True
+    except OSError:
+        return False
+    finally:
+        temporary.unlink(missing_ok=True)
+
+
+def is_unchanged(entry: FileEntry) -> bool:
+    """
+    Whether a file did not change since scanning it.
+    """
+    try:
+        info = os.lstat(entry.paths[0])
+    except OSError:
+        return False
+    before = entry.info
+    return (info.st_ino, info.st_size, info.st_mtime_ns) == (before.st_ino, before.st_size, before.st_mtime_ns)
+
+
+def hash_file(path: Path) -> Optional[str]:
+    """
+    Compute the digest of a file, or return `None`, when it can not be read.
+    """
+    hasher = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+    except OSError as ex:
+        logger.warning(f"Unable to hash {path}: {ex}")
+        return None
+    return f"sha256:{hasher.hexdigest()}"
+
+
+def read_xattrs(path: Path) -> Dict[str, bytes]:
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+        return {name: os.getxattr(path, name, follow_symlinks=False) for name in names}
+    except OSError:
+        return {}
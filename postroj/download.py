@@ -0,0 +1,852 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import dataclasses
+import hashlib
+import http.client
+import itertools
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Deque, Dict, Generator, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import unquote, urljoin, urlsplit
+
+from postroj.exceptions import DigestMismatch, DownloadError, InvalidImageReference, InvalidPhysicalImage
+from postroj.httpclient import HttpClient
+from postroj.oci.store import split_digest
+
+logger = logging.getLogger(__name__)
+
+
+MB = 1024 * 1024
+CHUNK_SIZE = 1 * MB
+
+# Checksums of downloaded files are published and recorded in `sha256sum` format.
+CHECKSUMS_FILE = "SHA256SUMS"
+CHECKSUM_SUFFIX = ".sha256"
+
+# Large files are downloaded in segments of this size, in parallel.
+SEGMENT_SIZE = 8 * MB
+
+# Map magic bytes of compressed archives to their compression format.
+COMPRESSION_FORMATS = [
+    (b"\x1f\x8b", "gzip"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"BZh", "bzip2"),
+]
+
+# Programs for decompressing archives, in order of preference. Multi-threaded
+# programs come first, the single-threaded standard programs are the fallback.
+# `xz` decompresses multi-block archives in parallel since version 5.4.
+DECOMPRESSORS = {
+    "gzip": [
+        ["pigz", "--decompress", "--stdout"],
+        ["gzip", "--decompress", "--stdout"],
+    ],
+    "xz": [
+        ["xz", "--decompress", "--stdout", "--threads=0"],
+    ],
+    "zstd": [
+        ["pzstd", "--decompress", "--stdout"],
+        ["zstd", "--decompress", "--stdout"],
+    ],
+    "bzip2": [
+        ["lbzip2", "--decompress", "--stdout"],
+        ["pbzip2", "--decompress", "--stdout"],
+        ["bzip2", "--decompress", "--stdout"],
+    ],
+}
+
+
+@dataclasses.dataclass
+class HttpValidators:
+    """
+    Capture the `ETag` and `Last-Modified` response headers, in order to make
+    conditional requests, only transferring resources which changed upstream.
+    """
+
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @classmethod
+    def from_response(cls, response: http.client.HTTPResponse) -> "HttpValidators":
+        return cls(etag=response.getheader("ETag"), last_modified=response.getheader("Last-Modified"))
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["HttpValidators"]:
+        if not path.exists():
+            return None
+        return cls(**json.loads(path.read_text()))
+
+    def save(self, path: Path):
+        path.write_text(json.dumps(dataclasses.asdict(self), indent=2))
+
+    def headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+@dataclasses.dataclass
+class ExtractionStats:
+    """
+    Capture information about extracting an archive.
+    """
+
+    compression: Optional[str] = None
+    decompressor: Optional[str] = None
+    size: int = 0
+    uncompressed_size: int = 0
+    seconds: float = 0.0
+    validators: Optional[HttpValidators] = None
+    digest: Optional[str] = None
+
+    def __str__(self):
+        seconds = self.seconds or 1e-9
+        if self.compression is None:
+            return f"Extracted {self.size} bytes in {self.seconds:.2f}s ({self.size / seconds / MB:.1f} MB/s)"
+        return (
+            f"Decompressed {self.size} to {self.uncompressed_size} bytes in {self.seconds:.2f}s "
+            f"using {self.decompressor} ({self.size / seconds / MB:.1f} MB/s {self.compression}, "
+            f"{self.uncompressed_size / seconds / MB:.1f} MB/s uncompressed)"
+        )
+
+
+@dataclasses.dataclass
+class DownloadStats:
+    """
+    Capture information about downloading a file.
+    """
+
+    url: str
+    size: int = 0
+    transferred: int = 0
+    segments: int = 1
+    seconds: float = 0.0
+    digest: Optional[str] = None
+
+    def __str__(self):
+        seconds = self.seconds or 1e-9
+        return (
+            f"Downloaded {self.url} with {self.size} bytes in {self.seconds:.2f}s, "
+            f"using {self.segments} segments ({self.transferred / seconds / MB:.1f} MB/s)"
+        )
+
+
+@dataclasses.dataclass
+class DownloadStream:
+    """
+    An opened download, to be consumed sequentially.
+    """
+
+    status: int
+    reason: str
+    validators: HttpValidators
+    size: Optional[int]
+    chunks: Iterator[bytes]
+    segments: int = 1
+
+
+class Downloader:
+    """
+    Download files over HTTP, splitting large files into byte ranges fetched in parallel.
+
+    The first request only asks for the first segment. When the server
+    responds with `206 Partial Content`, the other segments are requested
+    concurrently, each using a pooled connection, and `If-Range` makes sure
+    all of them originate from the same version of the resource. Otherwise,
+    the response is consumed as a single stream.
+
+    Downloads into files can be resumed. The progress is recorded next to
+    the partial file, and completed segments will not be requested again.
+    """
+
+    def __init__(self, client: Optional[HttpClient] = None, segment_size: int = SEGMENT_SIZE, max_workers: int = 4):
+        self.client = client or HttpClient()
+        self.segment_size = segment_size
+        self.max_workers = max_workers
+
+    def close(self):
+        self.client.close()
+
+    @contextmanager
+    def open(self, url: str, headers: Optional[Dict[str, str]] = None) -> Generator[DownloadStream, None, None]:
+        """
+        Open a download for consuming it sequentially.
+
+        Segments are fetched ahead of time, up to the number of workers, and
+        yielded in order, so the consumer can process the content while it is
+        still downloading.
+        """
+        with self.request_segment(url, 0, headers) as response:
+            validators = HttpValidators.from_response(response)
+            if response.status != 206:
+                yield DownloadStream(
+                    status=response.status,
+                    reason=response.reason,
+                    validators=validators,
+                    size=response.length,
+                    chunks=read_chunks(response),
+                )
+                return
+            size = content_range_size(url, response)
+            first = response.read()
+        yield DownloadStream(
+            status=200,
+            reason="OK",
+            validators=validators,
+            size=size,
+            chunks=self.iter_segments(url, validators, size, first),
+            segments=self.segment_count(size),
+        )
+
+    @contextmanager
+    def open_from(self, url: str, offset: int, validators: HttpValidators) -> Generator[DownloadStream, None, None]:
+        """
+        Open a download for consuming the remainder of a resource, starting at `offset`.
+
+        `If-Range` makes sure the remainder originates from the same version of the
+        resource as described by `validators`. Otherwise, the server responds with
+        the complete resource, signalled by status `200` instead of `206`.
+        """
+        headers = {"Range": f"bytes={offset}-"}
+        if_range = if_range_validator(validators)
+        if if_range is not None:
+            headers["If-Range"] = if_range
+        with self.client.request("GET", url, headers=headers) as response:
+            yield DownloadStream(
+                status=response.status,
+                reason=response.reason,
+                validators=HttpValidators.from_response(response),
+                size=response.length,
+                chunks=read_chunks(response),
+            )
+
+    def download(self, url: str, target: Path, digest: Optional[str] = None) -> DownloadStats:
+        """
+        Download resource at `url` into `target` file, resuming a previous partial download.
+
+        The content is hashed while downloading, and verified against `digest`,
+        when given. Only then, the file is promoted into place, and its digest
+        is recorded within a sidecar file, see `is_verified`.
+        """
+        target.parent.mkdir(parents=True, exist_ok=True)
+        partial = target.with_name(target.name + ".part")
+        progress = target.with_name(target.name + ".part.json")
+        stats = DownloadStats(url=url)
+        hasher = hashlib.sha256()
+        start = time.monotonic()
+
+        state = json.loads(progress.read_text()) if progress.exists() and partial.exists() else {}
+        if state.get("url") != url:
+            state = {}
+        done = set(state.get("done", []))
+        pending = sorted(set(range(self.segment_count(state["size"]))) - done) if state else [0]
+        first_index = pending[0] if pending else 0
+
+        with self.request_segment(url, first_index) as response:
+            validators = HttpValidators.from_response(response)
+            if response.status == 200:
+                # The server does not support ranges, consume the response as a single stream.
+                with open(partial, "wb") as f:
+                    for chunk in read_chunks(response):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        stats.transferred += len(chunk)
+                progress.unlink(missing_ok=True)
+                stats.size = stats.transferred
+                return self.promote(partial, target, hasher, digest, stats, start)
+            if response.status != 206:
+                raise DownloadError(f"Unable to download {url}. Status: {response.status} {response.reason}")
+            size = content_range_size(url, response)
+            first = response.read()
+
+        resumable = validators.etag is not None or validators.last_modified is not None
+        if not resumable or state.get("size") != size or state.get("validators") != dataclasses.asdict(validators):
+            done = set()
+            with open(partial, "wb") as f:
+                f.truncate(size)
+        else:
+            logger.info(f"Resuming download of {url}, {len(done)} segments already completed")
+
+        state = {"url": url, "size": size, "validators": dataclasses.asdict(validators), "done": sorted(done)}
+        count = self.segment_count(size)
+        stats.size = size
+        stats.segments = count
+
+        # Segments complete out of order. They are hashed as soon as they form a
+        # contiguous sequence, reading them back from the page cache.
+        hashed = 0
+        fd = os.open(partial, os.O_RDWR)
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="postroj-download") as executor:
+                futures = {
+                    executor.submit(self.fetch_segment, url, validators, index, size): index
+                    for index in range(count)
+                    if index not in done and index != first_index
+                }
+                fetched = ((futures[future], future.result()) for future in as_completed(futures))
+                completed = itertools.chain([(first_index, first)], fetched)
+                for index, data in completed:
+                    os.pwrite(fd, data, index * self.segment_size)
+                    stats.transferred += len(data)
+                    done.add(index)
+                    if resumable:
+                        state["done"] = sorted(done)
+                        progress.write_text(json.dumps(state))
+                    while hashed in done:
+                        start_offset, end_offset = self.segment_bounds(hashed, size)
+                        hasher.update(os.pread(fd, end_offset - start_offset + 1, start_offset))
+                        hashed += 1
+        finally:
+            os.close(fd)
+
+        return self.promote(partial, target, hasher, digest, stats, start, progress=progress)
+
+    @staticmethod
+    def promote(
+        partial: Path,
+        target: Path,
+        hasher,
+        digest: Optional[str],
+        stats: DownloadStats,
+        start: float,
+        progress: Optional[Path] = None,
+    ) -> DownloadStats:
+        """
+        Verify a completed download, and move it into place atomically.
+        """
+        stats.digest = "sha256:" + hasher.hexdigest()
+        stats.seconds = time.monotonic() - start
+        if digest is not None and stats.digest != digest:
+            partial.unlink(missing_ok=True)
+            if progress is not None:
+                progress.unlink(missing_ok=True)
+            raise DigestMismatch(f"Digest mismatch for {stats.url}: Expected {digest}, got {stats.digest}")
+        partial.replace(target)
+        write_sidecar(target, stats.digest)
+        if progress is not None:
+            progress.unlink(missing_ok=True)
+        logger.info(stats)
+        return stats
+
+    def published_digest(self, url: str) -> Optional[str]:
+        """
+        Look up the SHA256 digest of a resource, published next to it.
+
+        Both a `SHA256SUMS` file within the same directory, like used by
+        cloud image vendors, and a `<name>.sha256` file are supported.
+        """
+        name = posixpath.basename(unquote(urlsplit(url).path))
+        for candidate in [urljoin(url, CHECKSUMS_FILE), url + CHECKSUM_SUFFIX]:
+            try:
+                with self.client.request("GET", candidate) as response:
+                    content = response.read()
+                    if response.status != 200:
+                        continue
+            except (OSError, http.client.HTTPException) as ex:
+                logger.debug(f"Unable to acquire checksums from {candidate}: {ex}")
+                continue
+            for line in content.decode(errors="replace").splitlines():
+                hexdigest, _, filename = line.strip().partition(" ")
+                filename = filename.strip().lstrip("*")
+                if filename in [name, ""] and re.fullmatch("[0-9a-f]{64}", hexdigest):
+                    logger.info(f"Found published digest for {name} at {candidate}")
+                    return f"sha256:{hexdigest}"
+        return None
+
+    def iter_segments(self, url: str, validators: HttpValidators, size: int, first: bytes) -> Iterator[bytes]:
+        """
+        Yield segments in order, while fetching subsequent ones concurrently.
+        """
+        yield first
+        count = self.segment_count(size)
+        if count == 1:
+            return
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="postroj-download") as executor:
+            pending: Deque[Future] = deque()
+            following = iter(range(1, count))
+            try:
+                for index in itertools.islice(following, self.max_workers):
+                    pending.append(executor.submit(self.fetch_segment, url, validators, index, size))
+                while pending:
+                    data = pending.popleft().result()
+                    for index in itertools.islice(following, 1):
+                        pending.append(executor.submit(self.fetch_segment, url, validators, index, size))
+                    yield data
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def fetch_segment(self, url: str, validators: HttpValidators, index: int, size: int) -> bytes:
+        """
+        Fetch a single segment of a resource.
+        """
+        start, end = self.segment_bounds(index, size)
+        headers = {"Range": f"bytes={start}-{end}"}
+        if_range = if_range_validator(validators)
+        if if_range is not None:
+            headers["If-Range"] = if_range
+        with self.client.request("GET", url, headers=headers) as response:
+            if response.status != 206:
+                raise DownloadError(
+                    f"Unable to download {url}. Segment {start}-{end} failed with status {response.status}, "
+                    f"the resource may have changed while downloading"
+                )
+            data = response.read()
+        if len(data) != end - start + 1:
+            raise DownloadError(f"Unable to download {url}. Segment {start}-{end} is incomplete")
+        return data
+
+    @contextmanager
+    def request_segment(
+        self, url: str, index: int, headers: Optional[Dict[str, str]] = None
+    ) -> Generator[http.client.HTTPResponse, None, None]:
+        """
+        Request a segment of a resource. When the range is not satisfiable, for
+        example because the resource is empty, request the whole resource.
+        """
+        start = index * self.segment_size
+        ranged = dict(headers or {}, Range=f"bytes={start}-{start + self.segment_size - 1}")
+        with self.client.request("GET", url, headers=ranged) as response:
+            if response.status != 416:
+                yield response
+                return
+            response.read()
+        with self.client.request("GET", url, headers=headers) as response:
+            yield response
+
+    def segment_count(self, size: int) -> int:
+        return max(1, -(-size // self.segment_size))
+
+    def segment_bounds(self, index: int, size: int) -> Tuple[int, int]:
+        start = index * self.segment_size
+        return start, min(start + self.segment_size, size) - 1
+
+
+def content_range_size(url: str, response: http.client.HTTPResponse) -> int:
+    """
+    Decode the complete size of a resource from the `Content-Range` header of a partial response.
+    """
+    content_range = response.getheader("Content-Range", "")
+    try:
+        return int(content_range.rpartition("/")[2])
+    except ValueError:
+        raise DownloadError(f"Unable to download {url}. Invalid Content-Range header: {content_range}")
+
+
+class ArchiveExtractor:
+    """
+    Download a filesystem image tarball and extract it while it is downloading.
+
+    The archive is streamed into a `tar` process, so decompressing and
+    unpacking overlaps with the download, and the archive does not have to
+    be written to disk beforehand. The outcome is extracted into a staging
+    directory first, and only swapped into place when it completed
+    successfully.
+
+    When a `tarball` path is given, the archive is also retained there, in
+    order to use it instead of downloading it again next time. The archive
+    is hashed while streaming, and verified against a digest published next
+    to it, if any. It is only promoted into place when it has been verified,
+    otherwise it will not be trusted, and downloaded again. Interrupted
+    downloads are retained, and resumed next time.
+
+    When `validators` of a previous download are given, the archive is
+    requested conditionally, and only transferred when it changed upstream.
+    """
+
+    def __init__(self, downloader: Optional[Downloader] = None):
+        self.downloader = downloader or Downloader()
+
+    def extract(
+        self, url: str, target: Path, tarball: Optional[Path] = None, validators: Optional[HttpValidators] = None
+    ) -> Optional[ExtractionStats]:
+        """
+        Extract archive at `url` into `target` directory, optionally retaining it at `tarball`.
+
+        Return `None` when `validators` are given, and the archive did not change upstream.
+        """
+        staging = target.with_name(target.name + ".partial")
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+
+        try:
+            if tarball is not None and tarball.exists() and not is_verified(tarball):
+                logger.warning(f"Discarding unverified archive {tarball}")
+                remove_download(tarball)
+            if tarball is not None and tarball.exists() and validators is None:
+                logger.info(f"Extracting rootfs from verified archive {tarball} to {target}")
+                with open(tarball, "rb") as f:
+                    stats = self.untar(read_chunks(f), staging)
+            else:
+                logger.info(f"Streaming rootfs from {url} to {target}")
+                stats = self.download(url, staging, tarball, validators)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        if stats is None:
+            logger.info(f"Archive at {url} has not changed")
+            shutil.rmtree(staging, ignore_errors=True)
+            return None
+
+        swap_directory(staging, target)
+        logger.info(stats)
+        return stats
+
+    def close(self):
+        self.downloader.close()
+
+    def download(
+        self, url: str, staging: Path, tarball: Optional[Path] = None, validators: Optional[HttpValidators] = None
+    ) -> Optional[ExtractionStats]:
+        """
+        Download archive and extract it into `staging` directory, optionally retaining it at `tarball`.
+
+        When retaining the archive, an interrupted download is resumed from the
+        size of the partial file, as long as the archive did not change upstream,
+        according to the validators recorded next to it. The partial file is
+        extracted again, followed by the remainder streamed from upstream.
+        """
+        headers = validators.headers() if validators is not None else {}
+        partial = progress = None
+        offset = 0
+        if tarball is not None:
+            tarball.parent.mkdir(parents=True, exist_ok=True)
+            partial = tarball.with_name(tarball.name + ".part")
+            progress = tarball.with_name(tarball.name + ".part.json")
+            offset = self.resumable_offset(url, partial, progress)
+        hasher = hashlib.sha256()
+        keep_partial = False
+        try:
+            try:
+                with self.open_stream(url, headers, progress, offset) as stream:
+                    if stream.status == 304 and headers:
+                        return None
+                    if stream.status == 206:
+                        logger.info(f"Resuming download of {url} at offset {offset}")
+                    else:
+                        offset = 0
+                        if stream.status != 200:
+                            raise InvalidImageReference(
+                                f"Unable to download image: {url}. Status: {stream.status} {stream.reason}"
+                            )
+                    digest = self.downloader.published_digest(url)
+                    logger.info(f"Downloading {stream.size} bytes using {stream.segments} segments")
+                    if partial is not None:
+                        if if_range_validator(stream.validators) is not None and not offset:
+                            state = {"url": url, "validators": dataclasses.asdict(stream.validators)}
+                            progress.write_text(json.dumps(state))
+                        with open(partial, "ab" if offset else "wb") as f:
+                            chunks = itertools.chain(read_prefix(partial, offset), tee_chunks(stream.chunks, f))
+                            stats = self.untar(hash_chunks(chunks, hasher), staging)
+                            # `tar` may stop reading before the end of the trailing padding.
+                            deque(chunks, maxlen=0)
+                    else:
+                        chunks = hash_chunks(stream.chunks, hasher)
+                        stats = self.untar(chunks, staging)
+                        deque(chunks, maxlen=0)
+                    stats.validators = stream.validators
+            except (OSError, http.client.HTTPException, DownloadError) as ex:
+                # Retain the partial archive for resuming the download next time.
+                keep_partial = progress is not None and progress.exists()
+                raise InvalidImageReference(f"Unable to download image: {url}. Reason: {ex}")
+
+            # Only promote the archive into place when it has been verified.
+            stats.digest = "sha256:" + hasher.hexdigest()
+            if digest is not None and stats.digest != digest:
+                raise DigestMismatch(f"Digest mismatch for {url}: Expected {digest}, got {stats.digest}")
+            if partial is not None:
+                partial.replace(tarball)
+                write_sidecar(tarball, stats.digest)
+        finally:
+            if partial is not None and not keep_partial:
+                partial.unlink(missing_ok=True)
+                progress.unlink(missing_ok=True)
+
+        if digest is not None:
+            logger.info(f"Verified digest {digest} of {url}")
+        return stats
+
+    @contextmanager
+    def open_stream(
+        self, url: str, headers: Dict[str, str], progress: Optional[Path], offset: int
+    ) -> Generator[DownloadStream, None, None]:
+        """
+        Open the download of the archive, or of its remainder, when resuming at `offset`.
+        """
+        if offset:
+            state = json.loads(progress.read_text())
+            with self.downloader.open_from(url, offset, HttpValidators(**state["validators"])) as stream:
+                yield stream
+        else:
+            with self.downloader.open(url, headers=headers) as stream:
+                yield stream
+
+    @staticmethod
+    def resumable_offset(url: str, partial: Path, progress: Path) -> int:
+        """
+        Return the size of a partial download of the archive at `url`, when it can be resumed, otherwise zero.
+        """
+        if not partial.exists() or not progress.exists():
+            return 0
+        try:
+            state = json.loads(progress.read_text())
+        except ValueError:
+            return 0
+        if state.get("url") != url:
+            return 0
+        return partial.stat().st_size
+
+    @staticmethod
+    def untar(chunks: Iterator[bytes], directory: Path, options: Sequence[str] = ()) -> ExtractionStats:
+        """
+        Feed archive chunks into `tar`, extracting them into `directory`.
+        Additional command line `options` are passed to `tar`.
+
+        Compressed archives are decompressed by a separate program, preferably
+        a multi-threaded one, whose output is relayed to `tar`. Receiving,
+        decompressing, and writing files are running concurrently.
+        """
+        stats = ExtractionStats()
+        pipeline: Optional[ExtractionPipeline] = None
+        start = time.monotonic()
+        try:
+            for chunk in chunks:
+                if pipeline is None:
+                    compression = detect_compression(chunk)
+                    pipeline = ExtractionPipeline(directory, compression=compression, stats=stats, options=options)
+                pipeline.write(chunk)
+                stats.size += len(chunk)
+            if pipeline is None:
+                raise InvalidPhysicalImage("Unable to extract image. Reason: Archive is empty")
+        except BaseException:
+            if pipeline is not None:
+                pipeline.abort()
+            raise
+        pipeline.finish()
+        stats.seconds = time.monotonic() - start
+        return stats
+
+
+class ExtractionPipeline:
+    """
+    Run `tar`, optionally fed by a decompression program, and relay data between them.
+
+    The relay thread counts the number of uncompressed bytes, in order to
+    report the decompression throughput.
+    """
+
+    def __init__(
+        self, directory: Path, compression: Optional[str], stats: ExtractionStats, options: Sequence[str] = ()
+    ):
+        self.stats = stats
+        self.stats.compression = compression
+        self.decompressor: Optional[subprocess.Popen] = None
+        self.relay: Optional[threading.Thread] = None
+        command = ["tar", f"--directory={directory}", "--extract", *options]
+        self.tar = subprocess.Popen(command, stdin=subprocess.PIPE)
+        if compression is not None:
+            command = decompressor_command(compression)
+            self.stats.decompressor = command[0]
+            logger.info(f"Decompressing {compression} archive using `{' '.join(command)}`")
+            self.decompressor = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.relay = threading.Thread(target=self.forward, name="postroj-decompress", daemon=True)
+            self.relay.start()
+
+    @property
+    def stdin(self):
+        return self.decompressor.stdin if self.decompressor is not None else self.tar.stdin
+
+    def write(self, chunk: bytes):
+        try:
+            self.stdin.write(chunk)
+        except BrokenPipeError:
+            # The consuming program terminated prematurely, its exit code will tell why.
+            pass
+
+    def forward(self):
+        """
+        Relay decompressed data to `tar`.
+        """
+        receiving = True
+        try:
+            for chunk in read_chunks(self.decompressor.stdout):
+                self.stats.uncompressed_size += len(chunk)
+                if receiving:
+                    try:
+                        self.tar.stdin.write(chunk)
+                    except BrokenPipeError:
+                        # Continue draining, in order not to block the decompressor.
+                        receiving = False
+        finally:
+            close_quietly(self.tar.stdin)
+
+    def finish(self):
+        """
+        Signal the end of the archive, wait for all programs to terminate, and check their exit codes.
+        """
+        close_quietly(self.stdin)
+        if self.relay is not None:
+            self.relay.join()
+        for process in self.processes:
+            returncode = process.wait()
+            if returncode != 0:
+                raise InvalidPhysicalImage(
+                    f"Unable to extract image. Reason: {process.args[0]} exited with code {returncode}"
+                )
+        if self.decompressor is None:
+            self.stats.uncompressed_size = self.stats.size
+
+    def abort(self):
+        for process in self.processes:
+            process.kill()
+        close_quietly(self.stdin)
+        if self.relay is not None:
+            self.relay.join()
+        for process in self.processes:
+            process.wait()
+
+    @property
+    def processes(self) -> List[subprocess.Popen]:
+        return [process for process in [self.decompressor, self.tar] if process is not None]
+
+
+def detect_compression(header: bytes) -> Optional[str]:
+    """
+    Determine the compression format of an archive, based on its leading bytes.
+    """
+    for magic, compression in COMPRESSION_FORMATS:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def decompressor_command(compression: str) -> List[str]:
+    """
+    Select the most capable decompression program available for the given compression format.
+    """
+    candidates = DECOMPRESSORS[compression]
+    for command in candidates:
+        if shutil.which(command[0]):
+            return command
+    raise InvalidPhysicalImage(f"Unable to extract image. Reason: {compression} archives need `{candidates[-1][0]}`")
+
+
+def close_quietly(stream: BinaryIO):
+    try:
+        stream.close()
+    except BrokenPipeError:
+        pass
+
+
+def write_sidecar(path: Path, digest: str):
+    """
+    Record the digest of a verified file, in `sha256sum` format.
+    """
+    _, hexdigest = split_digest(digest)
+    sidecar = path.with_name(path.name + CHECKSUM_SUFFIX)
+    temporary = sidecar.with_name(sidecar.name + ".tmp")
+    temporary.write_text(f"{hexdigest}  {path.name}\n")
+    temporary.replace(sidecar)
+
+
+def is_verified(path: Path) -> bool:
+    """
+    Whether a file has been downloaded completely and verified.
+
+    Files are promoted into place before their sidecar file is written, so
+    a file without a sidecar may be incomplete, and can not be trusted.
+    """
+    return path.exists() and path.with_name(path.name + CHECKSUM_SUFFIX).exists()
+
+
+def remove_download(path: Path):
+    """
+    Remove a downloaded file and its sidecar file.
+    """
+    path.with_name(path.name + CHECKSUM_SUFFIX).unlink(missing_ok=True)
+    path.unlink(missing_ok=True)
+
+
+def if_range_validator(validators: HttpValidators) -> Optional[str]:
+    """
+    Select the validator for an `If-Range` header. Weak entity tags must not be used with `If-Range`.
+    """
+    if validators.etag and not validators.etag.startswith("W/"):
+        return validators.etag
+    return validators.last_modified
+
+
+def read_chunks(source: BinaryIO) -> Iterator[bytes]:
+    """
+    Read a file-like object in chunks.
+    """
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def read_prefix(path: Path, size: int) -> Iterator[bytes]:
+    """
+    Read the first `size` bytes of a file in chunks.
+    """
+    if size <= 0:
+        return
+    with open(path, "rb") as f:
+        while size > 0:
+            chunk = f.read(min(CHUNK_SIZE, size))
+            if not chunk:
+                break
+            size -= len(chunk)
+            yield chunk
+
+
+def hash_chunks(chunks: Iterator[bytes], hasher) -> Iterator[bytes]:
+    """
+    Pass through chunks, while also hashing them.
+    """
+    for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+
+def tee_chunks(chunks: Iterator[bytes], target: BinaryIO) -> Iterator[bytes]:
+    """
+    Pass through chunks, while also writing them to a file.
+    """
+    for chunk in chunks:
+        target.write(chunk)
+        yield chunk
+
+
+def swap_directory(source: Path, target: Path):
+    """
+    Replace `target` directory by `source` directory.
+
+    The new directory is moved into place before removing the old one, so
+    an intact directory is always present at `target`, except for a brief
+    moment in between two `rename` operations.
+    """
+    previous = target.with_name(target.name + ".previous")
+    shutil.rmtree(previous, ignore_errors=True)
+    if target.exists():
+        target.rename(previous)
+    source.rename(target)
+    shutil.rmtree(previous, ignore_errors=True)
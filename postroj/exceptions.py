@@ -16,3 +16,19 @@ class InvalidImageReference(Exception):
 
 class InvalidPhysicalImage(Exception):
     pass
+
+
+class RegistryError(Exception):
+    pass
+
+
+class DigestMismatch(Exception):
+    pass
+
+
+class DownloadError(Exception):
+    pass
+
+
+class LockTimeout(Exception):
+    pass
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import http.client
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Generator, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "racker"
+
+# Errors signalling that a server closed a kept-alive connection.
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    BrokenPipeError,
+    ConnectionResetError,
+)
+
+
+class HttpClient:
+    """
+    A minimal HTTP client, keeping connections alive and reusing them across requests.
+
+    Connections are pooled per scheme, host, and port. The client is thread-safe,
+    each request exclusively uses a pooled connection until its response has been
+    consumed.
+    """
+
+    def __init__(self, timeout: float = 60.0, max_redirects: int = 5):
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self._pool: Dict[Tuple[str, str], List[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def request(
+        self, method: str, url: str, headers: Optional[Dict[str, str]] = None, body: Optional[bytes] = None
+    ) -> Generator[http.client.HTTPResponse, None, None]:
+        """
+        Submit an HTTP request, following redirects, and yield the response.
+
+        When following a redirect to another host, the `Authorization` header
+        will be dropped, in order not to leak credentials to third parties,
+        like content delivery networks.
+        """
+        headers = dict(headers or {})
+        headers.setdefault("User-Agent", USER_AGENT)
+        for _ in range(self.max_redirects + 1):
+            connection, response = self._submit(method, url, headers, body)
+            location = response.getheader("Location")
+            if response.status in [301, 302, 303, 307, 308] and location:
+                response.read()
+                self._release(url, connection, response)
+                target = urljoin(url, location)
+                if urlsplit(target).netloc != urlsplit(url).netloc:
+                    headers.pop("Authorization", None)
+                logger.debug(f"Following redirect from {url} to {target}")
+                url = target
+                if response.status == 303:
+                    method, body = "GET", None
+                continue
+            try:
+                yield response
+            finally:
+                self._release(url, connection, response)
+            return
+        raise http.client.HTTPException(f"Too many redirects for {url}")
+
+    def close(self):
+        """
+        Close all pooled connections.
+        """
+        with self._lock:
+            for connections in self._pool.values():
+                for connection in connections:
+                    connection.close()
+            self._pool.clear()
+
+    def _submit(self, method: str, url: str, headers: Dict[str, str], body: Optional[bytes]):
+        """
+        Submit request on a pooled connection. When the server has closed a kept-alive
+        connection in the meanwhile, retry once using a fresh connection.
+        """
+        connection, reused = self._acquire(url)
+        parts = urlsplit(url)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        try:
+            connection.request(method, target, body=body, headers=headers)
+            return connection, connection.getresponse()
+        except STALE_CONNECTION_ERRORS:
+            connection.close()
+            if not reused:
+                raise
+            connection = self._connect(url)
+            connection.request(method, target, body=body, headers=headers)
+            return connection, connection.getresponse()
+
+    def _acquire(self, url: str) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            connections = self._pool.get(self._key(url))
+            if connections:
+                return connections.pop(), True
+        return self._connect(url), False
+
+    def _release(self, url: str, connection: http.client.HTTPConnection, response: http.client.HTTPResponse):
+        """
+        Return connection to the pool, when the response has been consumed completely.
+        """
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._pool.setdefault(self._key(url), []).append(connection)
+        else:
+            connection.close()
+
+    def _connect(self, url: str) -> http.client.HTTPConnection:
+        parts = urlsplit(url)
+        if parts.scheme == "https":
+            return http.client.HTTPSConnection(parts.netloc, timeout=self.timeout)
+        elif parts.scheme == "http":
+            return http.client.HTTPConnection(parts.netloc, timeout=self.timeout)
+        raise ValueError(f"Unsupported scheme for URL: {url}")
+
+    @staticmethod
+    def _key(url: str) -> Tuple[str, str]:
+        parts = urlsplit(url)
+        return parts.scheme, parts.netloc
@@ -1,27 +1,46 @@
 # -*- coding: utf-8 -*-
 # (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import dataclasses
 import enum
 import logging
 import os.path
 import shutil
-import subprocess
+import socket
 from enum import Enum
 from pathlib import Path
 from textwrap import dedent, indent
-from typing import Union
+from typing import Any, Callable, Dict, Optional, Union
 
 from furl import furl
 
 from postroj.backend.nspawn import scmd
+from postroj.download import ArchiveExtractor, HttpValidators, swap_directory
 from postroj.exceptions import InvalidImageReference, InvalidPhysicalImage, OsReleaseFileMissing, ProvisioningError
+from postroj.index import ImageIndex, ImageRecord, stamp
+from postroj.lock import FileLock
 from postroj.model import ConfigurationOptions, LinuxDistribution, OperatingSystemFamily, OperatingSystemName
+from postroj.oci.client import ANNOTATION_SOURCE_DIGEST, RegistryClient
+from postroj.oci.mirror import PullThroughCache
+from postroj.oci.store import BlobStore
+from postroj.oci.unpack import LayerUnpacker, read_descriptor, read_manifest, read_unpacked_descriptor
+from postroj.overlay import LAYER_SUFFIX, OverlayMount
+from postroj.packing import PACK_FORMATS, ImagePacker, is_packed_image
+from postroj.pkgcache import PackageCache
+from postroj.provcache import ProvisioningCache
 from postroj.registry import OS_RELEASE_NAME_MAP
+from postroj.rootfs import RootfsInspector
 from postroj.settings import get_appsettings
-from postroj.util import find_rootfs, hcmd, is_dir_empty, stdout_to_stderr, subprocess_get_error_message
+from postroj.shared import SharedArchive
+from postroj.store import ImageStore, swap_link
+from postroj.util import find_rootfs, hcmd, is_dir_empty, stdout_to_stderr
 
 logger = logging.getLogger(__name__)
 
 
+# Prefix of provisioning keys derived from the stamp of the image directory, see `provisioning_components`.
+STAMP_PREFIX = "stamp:"
+
+
 class ImageProvider:
     """
     Provision operating system images for spawning containers with
@@ -32,10 +51,15 @@ class ImageProvider:
     provider will physically manifest filesystem images at
     ``/var/lib/postroj/archive`` and activate them by symlinking into
     ``/var/lib/postroj/images``.
-    """
 
-    CAT_COMMAND = "/bin/cat"
-    OS_RELEASE_FILE = "/etc/os-release"
+    Each acquisition goes into a new version of the image, and activating it
+    swaps the links atomically, so running containers are not disturbed, and
+    previous versions can be rolled back to, see `ImageStore`.
+
+    When a pack format is configured, images are packed into compressed
+    read-only images like ``/var/lib/postroj/archive/<name>.squashfs``,
+    including their provisioning layer, and those will be activated instead.
+    """
 
     ADDITIONAL_PACKAGES = [
         # Needed for `pkgprobe`.
@@ -47,7 +71,17 @@ class ImageProvider:
         # "nano",
     ]
 
-    def __init__(self, distribution: Union[LinuxDistribution, Enum], autosetup: bool = True, force: bool = False):
+    # Version of the provisioning procedure. Increment it when changing the
+    # `setup_*` methods, in order to invalidate the provisioning cache.
+    PROVISIONING_VERSION = 1
+
+    def __init__(
+        self,
+        distribution: Union[LinuxDistribution, Enum],
+        autosetup: bool = True,
+        force: bool = False,
+        update: bool = False,
+    ):
 
         if isinstance(distribution, Enum):
             distribution = distribution.value
@@ -58,25 +92,74 @@ class ImageProvider:
         self.has_operating_system = None
         self.has_systemd = None
         self.is_docker = None
+        self.os_release = {}
+
+        # Information about the acquired artefact, to be recorded within the image index.
+        self.source_digest = None
+        self.source_size = None
 
-        # TODO: Discriminate `force` vs. `update`.
+        # With `force`, acquire the image from scratch, discarding all established artefacts.
+        # With `update`, acquire the image incrementally, only applying what changed upstream.
         self.force = force
+        self.update = update
 
         self.settings: ConfigurationOptions = get_appsettings()
         path_prefix = self.settings.archive_directory / self.distribution.fullname
         self.oci_path = path_prefix.with_suffix(".oci")
         self.image_staging = path_prefix.with_suffix(".img")
+        self.snapshot_path = path_prefix.with_suffix(".snapshots")
+        self.source_path = path_prefix.with_suffix(".source.json")
+        self.lock_path = path_prefix.with_suffix(".lock")
+        self.pack_format = self.settings.pack_format
+        self.blob_store = BlobStore(self.settings.blob_directory)
+        self.index = ImageIndex(self.settings.index_path)
+        self.provisioning_cache = ProvisioningCache(self.settings.provisioned_directory)
+        self.shared_archive = None
+        if self.settings.shared_archive_directory is not None:
+            self.shared_archive = SharedArchive(self.settings.shared_archive_directory)
+        self.record = None
+        self._inspector = None
+        self._provisioning_rootfs = None
+        self._package_cache = None
 
         self.settings.archive_directory.mkdir(parents=True, exist_ok=True)
         self.settings.image_directory.mkdir(parents=True, exist_ok=True)
-
-        if self.autosetup or self.force:
-
-            if self.image.exists():
-                self.discover()
-            else:
-                with stdout_to_stderr():
-                    self.setup()
+        self.blob_store.setup()
+
+        if self.autosetup or self.force or self.update:
+
+            # Only one process acquires and provisions an image at a time.
+            # Other processes wait for it, and reuse its outcome.
+            with self.lock() as lock:
+                if lock.waited and self.image.exists():
+                    logger.info(f"Image {self.distribution.fullname} has been acquired by another process, reusing it")
+                    self.update = False
+
+                if self.image.exists() and not self.update and not self.is_shared:
+                    self.discover()
+                    if self.record is None:
+                        # Images without a record, for example acquired before introducing the image index,
+                        # are only considered provisioned when they are bootable. Otherwise, complete them.
+                        if self.check_systemd() or not self.has_operating_system:
+                            self.update_index(provisioned=True)
+                        else:
+                            with stdout_to_stderr():
+                                self.provision(ImageAcquisitionOutcome.UP_TO_DATE)
+                    if self.pack_format and not is_packed_image(self.image):
+                        self.activate_image()
+                elif self.update or not self.activate_shared():
+                    with stdout_to_stderr():
+                        self.setup()
+
+    def lock(self) -> FileLock:
+        """
+        Acquire the lock for modifying the image. When the previous holder
+        of the lock crashed, clean up after it.
+        """
+        lock = FileLock(self.lock_path, timeout=self.settings.lock_timeout).acquire()
+        if lock.stale and lock.stale.get("host") == socket.gethostname():
+            self.store.recover(pid=lock.stale.get("pid"))
+        return lock
 
     def setup(self):
         """
@@ -87,6 +170,7 @@ class ImageProvider:
         logger.info(f"Installing image at {self.image}")
         self.acquire()
         self.activate_image()
+        self.store.retire(keep=self.settings.keep_versions)
 
     def acquire(self):
         """
@@ -101,6 +185,12 @@ class ImageProvider:
             outcome = self.acquire_from_docker()
         else:
             raise InvalidImageReference(f"Unsupported scheme for image: {self.distribution.image}")
+        self.provision(outcome)
+
+    def provision(self, outcome: "ImageAcquisitionOutcome"):
+        """
+        Inspect an acquired image, and make it bootable by provisioning systemd.
+        """
 
         self.discover()
 
@@ -108,7 +198,11 @@ class ImageProvider:
             logger.info(f"Status: Downloaded newer image for {self.distribution.fullname}")
         elif outcome == ImageAcquisitionOutcome.UP_TO_DATE:
             logger.info(f"Status: Image is up to date for {self.distribution.fullname}")
+            if self.update and self.record is not None and self.record.provisioned:
+                logger.info("Skipping provisioning, image has not changed")
+                return
 
+        self.update_index(provisioned=False)
         if self.has_operating_system:
             try:
                 self.provision_systemd()
@@ -119,9 +213,18 @@ class ImageProvider:
                 raise ProvisioningError(message)
         else:
             logger.info(f"Skipping provisioning of systemd")
+        self.update_index(provisioned=True)
 
     def discover(self):
 
+        # Use metadata from the image index, when the image did not change since recording it.
+        record = self.index.get_valid(self.distribution.fullname, self.image_staging)
+        if record is not None and record.source == self.distribution.image:
+            logger.info(f"Using metadata from image index for {self.distribution.fullname}")
+            self.apply_record(record)
+            return
+        self.record = None
+
         # Skip discovery if already qualified.
         if self.distribution.family and self.distribution.name:
             self.has_operating_system = True
@@ -132,34 +235,32 @@ class ImageProvider:
             return
 
         logger.info(f"Inspecting container image at {self.image_staging}")
-        rootfs = find_rootfs(self.image_staging)
+        self._inspector = None
+        inspector = self.inspector
+        rootfs = inspector.root
 
         # Read `/etc/os-release` file from OS root directory in order to determine operating system.
         logger.info(f"Discovering operating system from OS root directory at {rootfs}")
-        error_message = (
-            f"Container {self.distribution.fullname} at directory {rootfs} "
-            f"lacks an operating system (os-release file is missing or inaccessible)."
-        )
+        error_message = f"Container {self.distribution.fullname} at directory {rootfs} lacks an operating system"
         try:
-            process = scmd(
-                directory=rootfs, command=f"{self.CAT_COMMAND} {self.OS_RELEASE_FILE}", passthrough=False, capture=True
-            )
-            os_release = process.stdout
-            self.has_operating_system = True
-        except subprocess.CalledProcessError as ex:
-            self.has_operating_system = False
-            message = subprocess_get_error_message(exception=ex)
-            logger.exception(f"Reading {self.OS_RELEASE_FILE} failed")
-            raise OsReleaseFileMissing(f"{error_message} Error: {ex.__class__.__name__}. Reason: {message}")
+            os_release = inspector.os_release_text
         except Exception as ex:
             self.has_operating_system = False
-            logger.exception(f"Reading {self.OS_RELEASE_FILE} failed")
-            raise OsReleaseFileMissing(f"{error_message} Error: {ex.__class__.__name__}. Reason: {ex}")
+            logger.exception("Reading os-release file failed")
+            raise OsReleaseFileMissing(
+                f"{error_message} (os-release file is missing or inaccessible). "
+                f"Error: {ex.__class__.__name__}. Reason: {ex}"
+            )
+        if not inspector.has_os_tree:
+            self.has_operating_system = False
+            raise OsReleaseFileMissing(f"{error_message} (/usr directory is missing).")
+        self.has_operating_system = True
 
         # Check if systemd is present in the OS root directory.
         self.check_systemd()
 
         # Determine operating system by reading `/etc/os-release` file.
+        self.os_release = inspector.os_release
         for os_name, os_type in OS_RELEASE_NAME_MAP.items():
             if os_name in os_release:
                 self.distribution.family = os_type.family
@@ -167,6 +268,80 @@ class ImageProvider:
 
         logger.info(f"Discovered operating system family={self.distribution.family}, name={self.distribution.name}")
 
+    @property
+    def store(self) -> ImageStore:
+        return ImageStore(self.image_staging)
+
+    @property
+    def layer_path(self) -> Path:
+        """
+        Return path to the link designating the provisioning layer of the current version.
+        """
+        return self.image_staging.resolve().with_suffix(LAYER_SUFFIX)
+
+    @property
+    def inspector(self) -> RootfsInspector:
+        """
+        Return an inspector for the OS root directory, including its provisioning layer,
+        memoized until the image changes.
+        """
+        rootfs = find_rootfs(self.image_staging)
+        layers = [self.layer_path.resolve()] if self.layer_path.exists() else []
+        if self._inspector is None or self._inspector.root != rootfs or self._inspector.layers != layers:
+            self._inspector = RootfsInspector(rootfs, layers=layers)
+        return self._inspector
+
+    @property
+    def provisioning_rootfs(self) -> Path:
+        """
+        Return path to the OS root directory to be provisioned. While provisioning,
+        this is the merged directory of the overlay filesystem.
+        """
+        return self._provisioning_rootfs or find_rootfs(self.image_staging)
+
+    @property
+    def package_cache(self) -> Optional[PackageCache]:
+        """
+        Return the package cache to attach while provisioning, see `PackageCache`.
+        """
+        return self._package_cache
+
+    def apply_record(self, record: ImageRecord):
+        """
+        Use metadata about the image from its record within the image index.
+        """
+        self.record = record
+        self.has_operating_system = record.has_operating_system
+        self.has_systemd = record.has_systemd
+        self.os_release = record.os_release
+        if record.family and not self.distribution.family:
+            self.distribution.family = OperatingSystemFamily(record.family)
+        if record.os_name and not self.distribution.name:
+            self.distribution.name = OperatingSystemName(record.os_name)
+
+    def update_index(self, provisioned: bool):
+        """
+        Record metadata about the image within the image index.
+        """
+        previous = self.index.get(self.distribution.fullname) or ImageRecord(name=self.distribution.fullname)
+        family = self.distribution.family
+        name = self.distribution.name
+        self.record = dataclasses.replace(
+            previous,
+            source=self.distribution.image,
+            path=str(self.image_staging),
+            stamp=stamp(self.image_staging),
+            digest=self.source_digest or previous.digest,
+            size=self.source_size or previous.size,
+            family=family.value if isinstance(family, Enum) else None,
+            os_name=name.value if isinstance(name, Enum) else None,
+            os_release=self.os_release or previous.os_release,
+            has_operating_system=bool(self.has_operating_system),
+            has_systemd=bool(self.has_systemd),
+            provisioned=provisioned,
+        )
+        self.index.put(self.record)
+
     def check_systemd(self) -> bool:
         """
         Check whether `systemd` or another `init` program is present in the OS root directory.
@@ -175,43 +350,151 @@ class ImageProvider:
         execv(/usr/lib/systemd/systemd, /lib/systemd/systemd, /sbin/init) failed: No such file or directory
         """
 
-        self.has_systemd = False
-
-        rootfs = find_rootfs(self.image_staging)
-        init_candidates = ["usr/lib/systemd/systemd", "lib/systemd/systemd", "sbin/init"]
-        for candidate in init_candidates:
-            if (rootfs / candidate).exists():
-                self.has_systemd = True
-                logger.info(f"Init program {rootfs / candidate} found")
-                break
+        init_program = self.inspector.init_program
+        self.has_systemd = init_program is not None
+        if self.has_systemd:
+            logger.info(f"Init program {init_program} found")
 
         return self.has_systemd
 
     def provision_systemd(self):
         """
         Install systemd within the OS root directory in order to make the machine bootable.
+
+        The pristine base image is not modified. Instead, all changes are written
+        to a provisioning layer, which is stacked over the base image when
+        launching a container, see `ProvisioningCache` and `OverlayMount`.
         """
 
         if self.has_systemd:
             logger.info("Skipping systemd installation")
             return
 
+        # Use the provisioning layer from the cache, when the base image did not change.
+        # Otherwise, substitute it from the binary cache shared by multiple hosts, if any.
+        # Keys derived from the stamp of the image directory are only meaningful on this host.
+        components = self.provisioning_components()
+        key = self.provisioning_cache.key(**components)
+        substituter = None if components["digest"].startswith(STAMP_PREFIX) else self.substituter()
+        try:
+            if self.provisioning_cache.has(key):
+                logger.info(f"Provisioning cache hit for {self.distribution.fullname}, key {key}")
+            elif substituter is not None and substituter.fetch(key, self.provisioning_cache):
+                logger.info(f"Substituted provisioning layer for {self.distribution.fullname}, key {key}")
+            else:
+                logger.info(f"Provisioning cache miss for {self.distribution.fullname}, key {key}")
+                if not self.provision_layer(key, components):
+                    return
+                if substituter is not None and self.settings.publish:
+                    self.publish_layer(substituter, key)
+        finally:
+            if substituter is not None:
+                substituter.close()
+
+        # Activate the provisioning layer.
+        if self.layer_path.resolve() != self.provisioning_cache.layer_path(key).resolve():
+            self.discard_packed_images()
+        swap_link(self.layer_path, self.provisioning_cache.layer_path(key), relative=True)
+        self.check_systemd()
+
+    def substituter(self):
+        """
+        Return the configured substituter, see `Substituter`, or `None`.
+        """
+        if not self.settings.substituter:
+            return None
+        # Image bundles refer to the image provider, so import lazily.
+        from postroj.substitute import Substituter
+
+        return Substituter(self.settings.substituter)
+
+    def publish_layer(self, substituter, key: str):
+        """
+        Publish a provisioning layer to the substituter. Failures are not fatal.
+        """
+        try:
+            substituter.publish(key, self.provisioning_cache, name=self.distribution.fullname)
+        except Exception as ex:
+            logger.warning(f"Publishing provisioning layer {key} to {substituter.location} failed: {ex}")
+
+    def provision_layer(self, key: str, components: Dict[str, Any]) -> bool:
+        """
+        Provision the image into a new layer, by running the package manager on an
+        overlay filesystem stacked over the pristine base image.
+
+        Return whether provisioning made the image bootable, and the layer has been stored.
+        """
+        setup = self.setup_method()
+        rootfs = find_rootfs(self.image_staging)
+        layer = self.provisioning_cache.begin(key)
+        overlay = OverlayMount(
+            lower=[rootfs],
+            upper=layer,
+            work=self.provisioning_cache.work_path(key),
+            target=self.provisioning_cache.mount_path(key),
+        )
+        try:
+            with overlay as merged:
+                self._provisioning_rootfs = merged
+                self._package_cache = PackageCache.for_rootfs(self.distribution.fullname, merged)
+                setup()
+        except:
+            self.provisioning_cache.abort(key)
+            raise
+        finally:
+            self._provisioning_rootfs = None
+            self._package_cache = None
+
+        if not RootfsInspector(rootfs, layers=[layer]).has_systemd:
+            logger.warning(f"Provisioning did not install an init program, discarding layer {layer}")
+            self.provisioning_cache.abort(key)
+            return False
+
+        logger.info(f"Storing provisioning layer for {self.distribution.fullname} in cache, key {key}")
+        self.provisioning_cache.commit(key, **components)
+        return True
+
+    def setup_method(self) -> Callable[[], None]:
+        """
+        Return the method installing systemd and additional packages, per operating system.
+        """
         if self.distribution.name == OperatingSystemName.DEBIAN:
-            self.setup_debian()
+            return self.setup_debian
         elif self.distribution.name == OperatingSystemName.UBUNTU:
-            self.setup_ubuntu()
+            return self.setup_ubuntu
         elif self.distribution.name == OperatingSystemName.CENTOS:
-            self.setup_centos()
+            return self.setup_centos
         elif self.distribution.family == OperatingSystemFamily.REDHAT:
-            self.setup_redhat()
+            return self.setup_redhat
         elif self.distribution.family == OperatingSystemFamily.SUSE:
-            self.setup_suse()
+            return self.setup_suse
         elif self.distribution.family == OperatingSystemFamily.ARCHLINUX:
-            self.setup_archlinux()
+            return self.setup_archlinux
         else:
             raise ProvisioningError(f"Unsupported operating system: {self.distribution}")
 
-        self.check_systemd()
+    def provisioning_components(self) -> Dict[str, Any]:
+        """
+        Return everything which determines the outcome of provisioning the image.
+
+        When the digest of the base image is unknown, the stamp of its image
+        directory, i.e. its inode and modification time, is used instead. It
+        changes when acquiring the image again, so the cached layer is only
+        reused for the very same base image on this host, and never shared
+        with other hosts through the substituter.
+        """
+        digest = self.source_digest or (self.record and self.record.digest)
+        if not digest:
+            digest = f"{STAMP_PREFIX}{stamp(self.image_staging)}"
+        return {
+            "digest": digest,
+            "distribution": self.distribution.fullname,
+            "family": self.distribution.family.value if isinstance(self.distribution.family, Enum) else None,
+            "name": self.distribution.name.value if isinstance(self.distribution.name, Enum) else None,
+            "release": self.distribution.release,
+            "packages": sorted(self.ADDITIONAL_PACKAGES),
+            "version": self.PROVISIONING_VERSION,
+        }
 
     def setup_debian(self):
         """
@@ -219,13 +502,14 @@ class ImageProvider:
         by installing systemd.
         """
 
-        rootfs = find_rootfs(self.image_staging)
+        rootfs = self.provisioning_rootfs
 
         # Prepare image by installing systemd and additional packages.
         scmd(
             directory=rootfs,
             command=f"sh -c 'export DEBIAN_FRONTEND=noninteractive; "
             f"apt-get update; apt-get install --yes systemd {' '.join(self.ADDITIONAL_PACKAGES)}'",
+            package_cache=self.package_cache,
         )
 
     def setup_ubuntu(self):
@@ -243,13 +527,14 @@ class ImageProvider:
         if self.is_docker:
             return self.setup_debian()
 
-        rootfs = self.image_staging
+        rootfs = self.provisioning_rootfs
 
         # Prepare image by adding additional packages.
         scmd(
             directory=rootfs,
             command=f"sh -c 'export DEBIAN_FRONTEND=noninteractive; "
             f"apt-get update; apt-get install --yes {' '.join(self.ADDITIONAL_PACKAGES)}'",
+            package_cache=self.package_cache,
         )
 
         # Prepare image by deactivating services which are hogging the bootstrapping.
@@ -273,25 +558,23 @@ class ImageProvider:
             )
             return
 
-        rootfs = find_rootfs(self.image_staging)
-
-        has_dnf = False
-        has_microdnf = False
-        try:
-            scmd(directory=rootfs, command=f"command -v dnf")
-            has_dnf = True
-        except:
-            try:
-                scmd(directory=rootfs, command=f"command -v microdnf")
-                has_microdnf = True
-            except:
-                raise
+        rootfs = self.provisioning_rootfs
 
         # Prepare image by installing systemd and additional packages.
-        if has_dnf:
-            scmd(directory=rootfs, command=f"dnf install -y --skip-broken systemd {' '.join(self.ADDITIONAL_PACKAGES)}")
-        elif has_microdnf:
-            scmd(directory=rootfs, command=f"microdnf install -y systemd {' '.join(self.ADDITIONAL_PACKAGES)}")
+        # Keep downloaded packages within the package cache.
+        if self.inspector.find_program("dnf"):
+            scmd(
+                directory=rootfs,
+                command=f"dnf install -y --setopt=keepcache=1 --skip-broken "
+                f"systemd {' '.join(self.ADDITIONAL_PACKAGES)}",
+                package_cache=self.package_cache,
+            )
+        elif self.inspector.find_program("microdnf"):
+            scmd(
+                directory=rootfs,
+                command=f"microdnf install -y systemd {' '.join(self.ADDITIONAL_PACKAGES)}",
+                package_cache=self.package_cache,
+            )
         else:
             raise ProvisioningError(
                 f"Installing packages on Red Hat Linux or derivate failed. "
@@ -303,18 +586,22 @@ class ImageProvider:
         openSUSE images are acquired from Docker Hub.
         """
 
-        rootfs = find_rootfs(self.image_staging)
+        rootfs = self.provisioning_rootfs
 
         # Prepare image by installing systemd and additional packages.
         # TODO: Install additional packages only for `postroj pkgprobe`, only `systemd` is mandatory.
-        scmd(directory=rootfs, command=f"zypper install -y systemd {' '.join(self.ADDITIONAL_PACKAGES)}")
+        scmd(
+            directory=rootfs,
+            command=f"zypper install -y systemd {' '.join(self.ADDITIONAL_PACKAGES)}",
+            package_cache=self.package_cache,
+        )
 
     def setup_centos(self):
         """
         CentOS images are acquired from Docker Hub.
         """
 
-        rootfs = find_rootfs(self.image_staging)
+        rootfs = self.provisioning_rootfs
 
         if self.distribution.name == OperatingSystemName.CENTOS and self.distribution.release == "9":
             return self.setup_redhat()
@@ -332,17 +619,25 @@ class ImageProvider:
             )
 
         # Prepare image by adding additional packages.
-        scmd(directory=rootfs, command=f"yum install -y {' '.join(self.ADDITIONAL_PACKAGES)}")
+        scmd(
+            directory=rootfs,
+            command=f"yum install -y --setopt=keepcache=1 {' '.join(self.ADDITIONAL_PACKAGES)}",
+            package_cache=self.package_cache,
+        )
 
     def setup_archlinux(self):
         """
         Arch Linux images are acquired from Docker Hub.
         """
 
-        rootfs = find_rootfs(self.image_staging)
+        rootfs = self.provisioning_rootfs
 
         # Prepare image by installing systemd and additional packages.
-        scmd(directory=rootfs, command=f"pacman -Syu --noconfirm systemd {' '.join(self.ADDITIONAL_PACKAGES)}")
+        scmd(
+            directory=rootfs,
+            command=f"pacman -Syu --noconfirm systemd {' '.join(self.ADDITIONAL_PACKAGES)}",
+            package_cache=self.package_cache,
+        )
 
     @staticmethod
     def upgrade_systemd(rootfs):
@@ -423,29 +718,49 @@ class ImageProvider:
         os.system(upgrade_systemd_command)
 
     def acquire_from_http(self):
-        download_directory = self.settings.download_directory
+        """
+        Acquire filesystem image tarballs, like the »Ubuntu Minimal Cloud Images«.
+
+        The archive is extracted while it is downloading. Only when keeping
+        downloads is enabled, it is also retained within the download
+        directory, and will be used instead of downloading it again.
+
+        On updates, the archive is requested conditionally, using the `ETag`
+        and `Last-Modified` headers recorded with the previous download, and
+        only transferred when it changed upstream.
+        """
 
-        # Acquire image.
-        image_tarball = download_directory / os.path.basename(self.distribution.image)
         rootfs = self.image_staging
+        self.store.migrate()
 
         if self.force:
-            shutil.rmtree(rootfs, ignore_errors=True)
+            self.source_path.unlink(missing_ok=True)
 
-        try:
-            hcmd(f"wget --continue --no-clobber --directory-prefix={download_directory} {self.distribution.image}")
-        except subprocess.CalledProcessError as ex:
-            raise InvalidImageReference(f"Unable to download image: {self.distribution.image}")
-
-        if not rootfs.exists() or is_dir_empty(rootfs):
-            logger.info(f"Extracting rootfs from {image_tarball} to {rootfs}")
-            rootfs.mkdir(parents=True, exist_ok=True)
-            hcmd(f"tar --directory={rootfs} -xf {image_tarball}")
-            outcome = ImageAcquisitionOutcome.DOWLOADED_NEWER
-        else:
-            outcome = ImageAcquisitionOutcome.UP_TO_DATE
+        validators = None
+        if not self.force and rootfs.exists() and not is_dir_empty(rootfs):
+            if not self.update:
+                return ImageAcquisitionOutcome.UP_TO_DATE
+            validators = HttpValidators.load(self.source_path) or HttpValidators()
 
-        return outcome
+        tarball = None
+        if self.settings.keep_downloads:
+            tarball = self.settings.download_directory / os.path.basename(self.distribution.image)
+
+        # Extract into a new version, leaving the current one untouched.
+        incoming = self.store.incoming_path()
+        extractor = ArchiveExtractor()
+        try:
+            stats = extractor.extract(self.distribution.image, incoming, tarball=tarball, validators=validators)
+        finally:
+            extractor.close()
+
+        if stats is None:
+            return ImageAcquisitionOutcome.UP_TO_DATE
+        self.commit_version(incoming, digest=stats.digest)
+        stats.validators.save(self.source_path)
+        self.source_digest = stats.digest
+        self.source_size = stats.size
+        return ImageAcquisitionOutcome.DOWLOADED_NEWER
 
     def acquire_from_docker(self):
         """
@@ -455,40 +770,84 @@ class ImageProvider:
         TODO: To be challenged, corresponding suggestions are very welcome.
 
         For converging Docker images to rootfs filesystems suitable to be
-        started by systemd-nspawn, we use `skopeo` and `umoci`. As an
-        intermediary step, an OCI Filesystem Bundle is created.
+        started by systemd-nspawn, we use the built-in registry client and
+        layer unpacker. As an intermediary step, an OCI image layout is created.
 
         TODO: Patches for improvements are very welcome.
 
-        - https://github.com/containers/skopeo
-        - https://github.com/opencontainers/umoci
-        - https://github.com/opencontainers/runtime-spec/blob/main/bundle.md
+        All OCI image layouts share their blobs through the content-addressed
+        blob store, so layers already on disk will not be downloaded again.
+
+        - https://github.com/opencontainers/distribution-spec
+        - https://github.com/opencontainers/image-spec
         """
 
         self.is_docker = True
+        self.store.migrate()
 
         # When forces are applied, start from scratch by removing
         # all established download artefacts.
         if self.force:
             shutil.rmtree(self.oci_path, ignore_errors=True)
-            shutil.rmtree(self.image_staging, ignore_errors=True)
+            shutil.rmtree(self.snapshot_path, ignore_errors=True)
 
         # FIXME: Detect if tag is given.
         oci_tag = "default"
 
-        # Download and extract image.
+        # Download image. On updates, check whether the tag has been moved upstream
+        # first, and only download new layers.
+        cache = None
+        if self.settings.registry_cache_directory is not None:
+            cache = PullThroughCache(self.settings.registry_cache_directory)
+        client = RegistryClient(store=self.blob_store, mirrors=self.settings.registry_mirrors, cache=cache)
+        try:
+            if not (self.oci_path / "index.json").exists():
+                needs_pull = True
+            elif self.update:
+                needs_pull = not client.is_current(self.distribution.image, self.oci_path, tag=oci_tag)
+            else:
+                needs_pull = False
+            if needs_pull:
+                client.pull(self.distribution.image, layout=self.oci_path, tag=oci_tag)
+        finally:
+            client.close()
+
+        return self.unpack_layout(oci_tag)
+
+    def unpack_layout(self, oci_tag: str = "default") -> "ImageAcquisitionOutcome":
+        """
+        Unpack the image from its OCI image layout into a new version.
+        On updates, only re-apply layers from the first changed one onward.
+        """
+        if self.update:
+            unpacked = read_unpacked_descriptor(self.image_staging)
+            needs_unpack = unpacked is None or unpacked["digest"] != read_descriptor(self.oci_path, oci_tag)["digest"]
+        else:
+            needs_unpack = (
+                self.force
+                or not self.image_staging.exists()
+                or is_dir_empty(self.image_staging)
+                or is_dir_empty(self.image_staging / "rootfs", missing_ok=True)
+            )
+
         outcome = ImageAcquisitionOutcome.UP_TO_DATE
-        if not self.oci_path.exists() or not (self.oci_path / "index.json").exists():
-            hcmd(f"skopeo copy --override-os=linux {self.distribution.image} oci:{self.oci_path}:{oci_tag}")
-            outcome = ImageAcquisitionOutcome.DOWLOADED_NEWER
-        if (
-            not self.image_staging.exists()
-            or is_dir_empty(self.image_staging)
-            or is_dir_empty(self.image_staging / "rootfs", missing_ok=True)
-        ):
-            hcmd(f"umoci unpack --rootless --image={self.oci_path}:{oci_tag} {self.image_staging}")
+        if needs_unpack:
+            # Unpack into a new version, leaving the current one untouched.
+            incoming = self.store.incoming_path()
+            try:
+                LayerUnpacker().unpack(self.oci_path, incoming, tag=oci_tag, snapshots=self.snapshot_path)
+            except Exception:
+                self.store.discard(incoming)
+                raise
+            unpacked = read_unpacked_descriptor(incoming)
+            self.commit_version(incoming, digest=unpacked and unpacked["digest"])
             outcome = ImageAcquisitionOutcome.DOWLOADED_NEWER
 
+        if (self.oci_path / "index.json").exists():
+            descriptor = read_descriptor(self.oci_path, oci_tag)
+            self.source_digest = descriptor.get("annotations", {}).get(ANNOTATION_SOURCE_DIGEST, descriptor["digest"])
+            self.source_size = sum(layer.get("size", 0) for layer in read_manifest(self.oci_path, oci_tag)["layers"])
+
         return outcome
 
     @property
@@ -498,18 +857,145 @@ class ImageProvider:
         """
         return self.settings.image_directory / self.distribution.fullname
 
+    def commit_version(self, incoming: Path, digest: str = None) -> Path:
+        """
+        Commit an acquired version of the image, and make it the current one.
+        It will be used by containers only after activating it.
+        """
+        version = self.store.commit(incoming, digest=digest)
+        self.store.set_current(version)
+        return version
+
     def activate_image(self):
         """
         Activate a filesystem image to make it available for invoking it.
+        When a pack format is configured, activate the packed image.
+
+        The link is pointed to the current version itself, so running
+        containers keep using their version, when another one is activated.
         """
         if not is_dir_empty(self.image_staging):
             target_path = self.image
-            target_path.unlink(missing_ok=True)
-            target_path.symlink_to(self.image_staging, target_is_directory=True)
+            if self.pack_format:
+                source_path = self.pack_image()
+            else:
+                source_path = self.image_staging.resolve()
+            swap_link(target_path, source_path)
             return target_path
         else:
             raise InvalidPhysicalImage(f"Unable to activate image at {self.image_staging}")
 
+    @property
+    def is_shared(self) -> bool:
+        """
+        Whether the image has been activated from the shared archive.
+        """
+        return self.shared_archive is not None and self.image.exists() and self.shared_archive.contains(self.image)
+
+    def activate_shared(self) -> bool:
+        """
+        Activate the current version of the image from the shared archive, without acquiring it.
+
+        Return whether the shared archive has the image. Only the activation link is
+        written, the shared archive is not modified. When the image has been updated
+        within the shared archive, the link is pointed to its new version.
+        """
+        if self.shared_archive is None:
+            return False
+        source_path = self.shared_archive.current(self.distribution.fullname, pack_format=self.pack_format)
+        if source_path is None:
+            return False
+        if not self.image.exists() or self.image.resolve() != source_path:
+            logger.info(f"Activating image {self.distribution.fullname} from shared archive at {source_path}")
+            swap_link(self.image, source_path)
+        return True
+
+    def rollback(self) -> Path:
+        """
+        Make the previous version of the image the current one, and activate it.
+        """
+        with self.lock():
+            version = self.store.rollback()
+            logger.info(f"Rolled back {self.distribution.fullname} to version {version.name}")
+            self.discover()
+            # The provisioning layer of the version may have been pruned meanwhile.
+            if self.has_operating_system and not self.check_systemd():
+                self.provision_systemd()
+            self.update_index(provisioned=True)
+            self.activate_image()
+        return version
+
+    def load_layout(self, layout: Path, oci_tag: str = "default"):
+        """
+        Acquire the image from an OCI image layout on disk, like one imported
+        from a `docker save` archive, without contacting a registry, and
+        activate it. The layout is moved into place.
+        """
+        with self.lock():
+            self.is_docker = True
+            self.update = True
+            self.store.migrate()
+            swap_directory(layout, self.oci_path)
+            outcome = self.unpack_layout(oci_tag)
+            with stdout_to_stderr():
+                self.provision(outcome)
+            self.activate_image()
+            self.store.retire(keep=self.settings.keep_versions)
+
+    def load_bundle(self, directory: Path, metadata: Dict[str, Any]):
+        """
+        Acquire the image from an extracted image bundle, see `BundleLoader`,
+        and activate it. Its version and provisioning layer are moved into place.
+        """
+        with self.lock():
+            self.store.migrate()
+            incoming = self.store.incoming_path()
+            (directory / "image").rename(incoming)
+            self.commit_version(incoming, digest=metadata.get("digest"))
+            self.source_digest = metadata.get("digest")
+            self.source_size = metadata.get("size")
+
+            # Use the provisioning layer from the bundle, unless the same one is already present.
+            layer = metadata.get("layer")
+            if layer is not None:
+                key = layer["key"]
+                if not self.provisioning_cache.has(key):
+                    self.provisioning_cache.abort(key)
+                    self.provisioning_cache.path.mkdir(parents=True, exist_ok=True)
+                    (directory / "layer").rename(self.provisioning_cache.partial_path(key))
+                    self.provisioning_cache.commit(key, **layer["components"])
+                swap_link(self.layer_path, self.provisioning_cache.layer_path(key), relative=True)
+
+            self.discover()
+            if self.has_operating_system and not self.check_systemd():
+                with stdout_to_stderr():
+                    self.provision_systemd()
+            self.update_index(provisioned=True)
+            self.activate_image()
+            self.store.retire(keep=self.settings.keep_versions)
+
+    def packed_path(self, format: str) -> Path:
+        return self.image_staging.resolve().with_suffix(f".{format}")
+
+    def pack_image(self) -> Path:
+        """
+        Pack the OS root directory, including its provisioning layer, into a compressed
+        read-only image, see `ImagePacker`. An existing packed image is reused.
+        """
+        packed = self.packed_path(self.pack_format)
+        if packed.exists():
+            logger.info(f"Using packed image at {packed}")
+            return packed
+        layers = [self.layer_path.resolve()] if self.layer_path.exists() else []
+        return ImagePacker(format=self.pack_format).pack(find_rootfs(self.image_staging), packed, layers=layers)
+
+    def discard_packed_images(self):
+        """
+        Remove packed images, after the OS root directory or its provisioning layer changed.
+        """
+        for format in PACK_FORMATS:
+            self.packed_path(format).unlink(missing_ok=True)
+
 
 class ImageAcquisitionOutcome(enum.Enum):
     """
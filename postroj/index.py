@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import dataclasses
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Generator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY,
+    source TEXT,
+    path TEXT,
+    stamp TEXT,
+    digest TEXT,
+    size INTEGER DEFAULT 0,
+    family TEXT,
+    os_name TEXT,
+    os_release TEXT,
+    has_operating_system INTEGER DEFAULT 0,
+    has_systemd INTEGER DEFAULT 0,
+    provisioned INTEGER DEFAULT 0,
+    created REAL,
+    updated REAL,
+    last_used REAL,
+    run_count INTEGER DEFAULT 0
+)
+"""
+
+
+@dataclasses.dataclass
+class ImageRecord:
+    """
+    Metadata about a filesystem image, as recorded within the image index.
+    """
+
+    name: str
+    source: Optional[str] = None
+    path: Optional[str] = None
+    stamp: Optional[str] = None
+    digest: Optional[str] = None
+    size: int = 0
+    family: Optional[str] = None
+    os_name: Optional[str] = None
+    os_release: Dict[str, str] = dataclasses.field(default_factory=dict)
+    has_operating_system: bool = False
+    has_systemd: bool = False
+    provisioned: bool = False
+    created: Optional[float] = None
+    updated: Optional[float] = None
+    last_used: Optional[float] = None
+    run_count: int = 0
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "ImageRecord":
+        data = dict(row)
+        data["os_release"] = json.loads(data["os_release"] or "{}")
+        for field in ["has_operating_system", "has_systemd", "provisioned"]:
+            data[field] = bool(data[field])
+        return cls(**data)
+
+    def to_row(self) -> dict:
+        data = dataclasses.asdict(self)
+        data["os_release"] = json.dumps(self.os_release)
+        return data
+
+
+class ImageIndex:
+    """
+    An on-disk index of filesystem images, based on SQLite.
+
+    It records metadata about each image, like its source, digest, operating
+    system, and provisioning state, in order to answer questions about images
+    without inspecting them, and without spawning any processes.
+
+    Records are only valid as long as the image directory has not changed,
+    see `stamp`. Otherwise, the image needs to be inspected again.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    @contextmanager
+    def connect(self) -> Generator[sqlite3.Connection, None, None]:
+        """
+        Connect to the database. Each operation uses its own connection, so
+        the index can be used from multiple threads and processes.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(SCHEMA)
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, name: str) -> Optional[ImageRecord]:
+        with self.connect() as connection:
+            row = connection.execute("SELECT * FROM images WHERE name = ?", (name,)).fetchone()
+        return ImageRecord.from_row(row) if row is not None else None
+
+    def get_valid(self, name: str, path: Path) -> Optional[ImageRecord]:
+        """
+        Return the record of an image, only when the image directory did not change since recording it.
+        """
+        record = self.get(name)
+        if record is None or record.stamp is None or record.stamp != stamp(path):
+            return None
+        return record
+
+    def put(self, record: ImageRecord):
+        """
+        Insert or update the record of an image.
+        """
+        now = time.time()
+        record.created = record.created or now
+        record.updated = now
+        row = record.to_row()
+        columns = ", ".join(row.keys())
+        placeholders = ", ".join(f":{key}" for key in row.keys())
+        with self.connect() as connection:
+            connection.execute(f"INSERT OR REPLACE INTO images ({columns}) VALUES ({placeholders})", row)
+
+    def record_use(self, name: str):
+        """
+        Record that an image has been used to run a container.
+        """
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE images SET last_used = ?, run_count = run_count + 1 WHERE name = ?", (time.time(), name)
+            )
+
+    def remove(self, name: str):
+        with self.connect() as connection:
+            connection.execute("DELETE FROM images WHERE name = ?", (name,))
+
+    def all(self) -> List[ImageRecord]:
+        with self.connect() as connection:
+            rows = connection.execute("SELECT * FROM images ORDER BY name").fetchall()
+        return [ImageRecord.from_row(row) for row in rows]
+
+
+def stamp(path: Path) -> Optional[str]:
+    """
+    Compute a stamp identifying the state of an image directory.
+
+    Unpacking or extracting an image replaces the image directory, or the
+    entries within it, so its inode number or modification time changes.
+    """
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{info.st_ino}-{info.st_mtime_ns}"
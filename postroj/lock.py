@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import fcntl
+import json
+import logging
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Optional
+
+from postroj.exceptions import LockTimeout
+
+logger = logging.getLogger(__name__)
+
+
+class FileLock:
+    """
+    An exclusive lock, effective across all processes on the host, based on `flock(2)`.
+
+    The kernel releases the lock when the process holding it terminates, so
+    a crashed process will never block others. While the lock is held, the
+    lock file records the holder, and it is emptied when the lock is released
+    regularly. When a process acquires the lock, and finds a holder recorded
+    nevertheless, the previous holder crashed, and the lock is considered
+    stale. Then, `stale` contains the record of the previous holder, in order
+    to clean up after it.
+
+    After acquiring the lock, `waited` tells whether another process held it
+    before, which is the signal for reusing its outcome.
+
+    With `shared`, the lock can be held by multiple processes at the same
+    time, excluding only holders of the exclusive lock. Shared holders are
+    not recorded.
+    """
+
+    def __init__(self, path: Path, timeout: Optional[float] = None, interval: float = 0.25, shared: bool = False):
+        self.path = Path(path)
+        self.timeout = timeout
+        self.interval = interval
+        self.shared = shared
+        self.fd: Optional[int] = None
+        self.waited = False
+        self.stale: Optional[dict] = None
+
+    def acquire(self):
+        if self.fd is not None:
+            return self
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        start = time.monotonic()
+        announced = False
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    pass
+                self.waited = True
+                if not announced:
+                    logger.info(f"Waiting for lock {self.path}, held by {describe_holder(read_holder(fd))}")
+                    announced = True
+                if self.timeout is not None and time.monotonic() - start > self.timeout:
+                    raise LockTimeout(f"Timeout after {self.timeout} seconds while waiting for lock {self.path}")
+                time.sleep(self.interval)
+
+            if not self.shared:
+                previous = read_holder(fd)
+                if previous is not None:
+                    logger.warning(f"Found stale lock {self.path}, left by {describe_holder(previous)}")
+                    self.stale = previous
+                write_holder(fd, {"pid": os.getpid(), "host": socket.gethostname(), "time": time.time()})
+        except BaseException:
+            os.close(fd)
+            raise
+        self.fd = fd
+        return self
+
+    def release(self):
+        if self.fd is None:
+            return
+        try:
+            if not self.shared:
+                os.ftruncate(self.fd, 0)
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self) -> "FileLock":
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def read_holder(fd: int) -> Optional[dict]:
+    try:
+        content = os.pread(fd, 4096, 0)
+        return content and json.loads(content) or None
+    except (OSError, ValueError):
+        return None
+
+
+def write_holder(fd: int, holder: dict):
+    os.ftruncate(fd, 0)
+    os.pwrite(fd, json.dumps(holder).encode(), 0)
+    os.fsync(fd)
+
+
+def describe_holder(holder: Optional[dict]) -> str:
+    if not holder:
+        return "unknown process"
+    return f"process {holder.get('pid')} on host {holder.get('host')}"
+
+
+def is_locked(path: Path) -> bool:
+    """
+    Whether another process holds the lock at `path`.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
@@ -3,7 +3,7 @@
 import dataclasses
 from enum import Enum
 from pathlib import Path
-from typing import Union
+from typing import Dict, List, Optional, Union
 
 
 @dataclasses.dataclass
@@ -11,11 +11,69 @@ class ConfigurationOptions:
     archive_directory: Path = None
     image_directory: Path = None
     cache_directory: Path = None
+    runtime_directory: Path = None
+
+    # Whether to retain downloaded archives within the download directory.
+    keep_downloads: bool = False
+
+    # Maximum time in seconds to wait for another process acquiring the same image.
+    lock_timeout: float = 60 * 60
+
+    # Number of previous versions of each image to retain for rolling back.
+    keep_versions: int = 1
+
+    # Whether to pack images into a compressed read-only image, like `squashfs` or `erofs`.
+    pack_format: Optional[str] = None
+
+    # Directory or HTTP endpoint of a binary cache for provisioning layers, see `Substituter`.
+    substituter: Optional[str] = None
+
+    # Whether to publish provisioning layers built locally to the substituter.
+    publish: bool = False
+
+    # Archive directory shared by multiple hosts, mounted read-only, see `SharedArchive`.
+    shared_archive_directory: Optional[Path] = None
+
+    # Mirrors of container registries, consulted in order before the registry itself, see `RegistryClient`.
+    registry_mirrors: Dict[str, List[str]] = dataclasses.field(default_factory=dict)
+
+    # Directory to store manifests and blobs fetched from registries into, see `PullThroughCache`.
+    registry_cache_directory: Optional[Path] = None
+
+    # Whether to route package downloads within containers through a caching HTTP proxy, see `PackageProxy`.
+    package_proxy: bool = False
+
+    # Whether the package proxy only replays responses from its cache, without contacting upstream.
+    package_proxy_offline: bool = False
+
+    @property
+    def mount_directory(self) -> Path:
+        return self.runtime_directory / "mounts"
 
     @property
     def download_directory(self) -> Path:
         return self.cache_directory / "downloads"
 
+    @property
+    def package_cache_directory(self) -> Path:
+        return self.cache_directory / "pkg"
+
+    @property
+    def package_proxy_directory(self) -> Path:
+        return self.cache_directory / "proxy"
+
+    @property
+    def blob_directory(self) -> Path:
+        return self.archive_directory / "blobs"
+
+    @property
+    def provisioned_directory(self) -> Path:
+        return self.archive_directory / "provisioned"
+
+    @property
+    def index_path(self) -> Path:
+        return self.archive_directory / "index.sqlite"
+
 
 class OperatingSystemFamily(Enum):
     DEBIAN = "debian"
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import dataclasses
+import hashlib
+import http.client
+import json
+import logging
+import platform
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Dict, Generator, List, Optional, Tuple
+from urllib.parse import urlencode
+
+from postroj.exceptions import DigestMismatch, InvalidImageReference, InvalidPhysicalImage, RegistryError
+from postroj.httpclient import HttpClient
+from postroj.oci.mirror import PullThroughCache, registry_endpoint
+from postroj.oci.store import INDEX_MEDIA_TYPES, MANIFEST_MEDIA_TYPES, BlobStore
+from postroj.oci.unpack import read_descriptor
+
+logger = logging.getLogger(__name__)
+
+
+DOCKER_HUB_REGISTRY = "docker.io"
+DOCKER_HUB_ENDPOINT = "registry-1.docker.io"
+
+OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+OCI_CONFIG = "application/vnd.oci.image.config.v1+json"
+
+# Map Docker media types to their OCI counterparts. The content is identical.
+DOCKER_TO_OCI_MEDIA_TYPES = {
+    "application/vnd.docker.distribution.manifest.v2+json": OCI_MANIFEST,
+    "application/vnd.docker.container.image.v1+json": OCI_CONFIG,
+    "application/vnd.docker.image.rootfs.diff.tar.gzip": "application/vnd.oci.image.layer.v1.tar+gzip",
+    "application/vnd.docker.image.rootfs.diff.tar": "application/vnd.oci.image.layer.v1.tar",
+}
+
+# Annotations recorded on the OCI image layout.
+ANNOTATION_REF_NAME = "org.opencontainers.image.ref.name"
+ANNOTATION_SOURCE_NAME = "io.github.pyveci.racker.source.name"
+ANNOTATION_SOURCE_DIGEST = "io.github.pyveci.racker.source.digest"
+ANNOTATION_SOURCE_TAG_DIGEST = "io.github.pyveci.racker.source.tag.digest"
+
+# Map Python's machine names to OCI architecture names.
+OCI_ARCHITECTURES = {
+    "x86_64": "amd64",
+    "amd64": "amd64",
+    "aarch64": "arm64",
+    "arm64": "arm64",
+    "armv7l": "arm",
+    "ppc64le": "ppc64le",
+    "s390x": "s390x",
+}
+
+
+@dataclasses.dataclass
+class ImageReference:
+    """
+    A reference to an image on a container registry, like `docker://docker.io/debian:bookworm-slim`.
+    """
+
+    registry: str
+    repository: str
+    tag: Optional[str] = None
+    digest: Optional[str] = None
+
+    @classmethod
+    def parse(cls, image: str) -> "ImageReference":
+        """
+        Parse an image reference, resolving short names to Docker Hub.
+
+        - docker://docker.io/debian:bookworm-slim
+        - quay.io/centos/centos:stream9
+        - localhost:5000/foo@sha256:abc...
+        """
+        name = re.sub(r"^docker://", "", image)
+        digest = None
+        if "@" in name:
+            name, digest = name.split("@", maxsplit=1)
+        tag = None
+        head, _, tail = name.rpartition("/")
+        if ":" in tail:
+            tail, tag = tail.split(":", maxsplit=1)
+            name = f"{head}/{tail}" if head else tail
+        components = name.split("/")
+        if len(components) > 1 and ("." in components[0] or ":" in components[0] or components[0] == "localhost"):
+            registry = components[0]
+            repository = "/".join(components[1:])
+        else:
+            registry = DOCKER_HUB_REGISTRY
+            repository = name
+        if registry == DOCKER_HUB_REGISTRY and "/" not in repository:
+            repository = f"library/{repository}"
+        if not repository or not re.match(r"^[a-z0-9]+(?:[._/-]+[a-z0-9]+)*$", repository):
+            raise InvalidImageReference(f"Invalid image reference: {image}")
+        if tag is None and digest is None:
+            tag = "latest"
+        return cls(registry=registry, repository=repository, tag=tag, digest=digest)
+
+    @property
+    def reference(self) -> str:
+        """
+        The reference used for requesting the manifest, either a digest or a tag.
+        """
+        return self.digest or self.tag
+
+    @property
+    def endpoint(self) -> str:
+        """
+        The base URL of the registry API.
+
+        Registries on `localhost` are accessed using plain HTTP.
+        """
+        host = self.registry
+        if host == DOCKER_HUB_REGISTRY:
+            host = DOCKER_HUB_ENDPOINT
+        return registry_endpoint(host)
+
+    def __str__(self):
+        name = f"{self.registry}/{self.repository}"
+        if self.tag:
+            name += f":{self.tag}"
+        if self.digest:
+            name += f"@{self.digest}"
+        return name
+
+
+@dataclasses.dataclass
+class ResolvedManifest:
+    """
+    An image manifest, resolved for the host platform.
+    """
+
+    digest: str
+    media_type: str
+    content: bytes
+
+    # The digest of the manifest or image index the reference is pointing to.
+    tag_digest: Optional[str] = None
+
+    @property
+    def document(self) -> dict:
+        return json.loads(self.content)
+
+    @property
+    def layers(self) -> List[dict]:
+        return self.document["layers"]
+
+    @property
+    def config(self) -> dict:
+        return self.document["config"]
+
+
+class RegistryClient:
+    """
+    Acquire images from container registries implementing the OCI distribution API.
+
+    Manifests are resolved for the host platform, also when the image reference
+    points to a multi-architecture image index. Layers are downloaded concurrently
+    over pooled connections, and verified against their digest while streaming.
+    Blobs already available within the blob store will not be downloaded again.
+
+    Requests are directed to the mirrors configured for a registry first, in
+    order, and fall back to the next mirror, and finally to the registry
+    itself, when a mirror is unavailable or does not have the image. With a
+    pull-through cache, fetched manifests and blobs are stored for other hosts.
+
+    - https://github.com/opencontainers/distribution-spec/blob/main/spec.md
+    - https://docs.docker.com/registry/spec/auth/token/
+    """
+
+    ACCEPT_MEDIA_TYPES = INDEX_MEDIA_TYPES + MANIFEST_MEDIA_TYPES
+
+    def __init__(
+        self,
+        store: BlobStore,
+        max_workers: int = 4,
+        mirrors: Optional[Dict[str, List[str]]] = None,
+        cache: Optional[PullThroughCache] = None,
+    ):
+        self.store = store
+        self.max_workers = max_workers
+        self.mirrors = mirrors or {}
+        self.cache = cache
+        self.http = HttpClient()
+        self._tokens: Dict[Tuple[str, str], str] = {}
+        self._lock = threading.Lock()
+
+    def pull(self, image: str, layout: Path, tag: str = "default") -> ResolvedManifest:
+        """
+        Acquire an image into an OCI image layout.
+        """
+        reference = ImageReference.parse(image)
+        logger.info(f"Pulling image {reference}")
+        manifest = self.resolve(reference)
+        with self.store.lock():
+            self.fetch_blobs(reference, manifest)
+            self.write_layout(reference, manifest, layout, tag)
+        return manifest
+
+    def resolve(self, reference: ImageReference) -> ResolvedManifest:
+        """
+        Resolve image manifest. When the reference points to an image index, select
+        the manifest matching the host platform.
+        """
+        manifest = self.get_manifest(reference, reference.reference)
+        tag_digest = manifest.digest
+        if manifest.media_type in INDEX_MEDIA_TYPES:
+            descriptor = self.select_platform(manifest.document, reference)
+            manifest = self.get_manifest(reference, descriptor["digest"])
+        if manifest.media_type not in MANIFEST_MEDIA_TYPES:
+            raise RegistryError(f"Unsupported manifest media type {manifest.media_type} for image {reference}")
+        manifest.tag_digest = tag_digest
+        return manifest
+
+    def is_current(self, image: str, layout: Path, tag: str = "default") -> bool:
+        """
+        Check whether the image within the OCI image layout is still current.
+
+        Only the digest of the manifest the reference is pointing to is
+        requested, using a `HEAD` request, and compared to the digest recorded
+        when pulling the image. When the registry does not report a digest,
+        the image is considered to be outdated.
+        """
+        reference = ImageReference.parse(image)
+        try:
+            recorded = read_descriptor(layout, tag).get("annotations", {}).get(ANNOTATION_SOURCE_TAG_DIGEST)
+        except (OSError, InvalidPhysicalImage):
+            return False
+        if recorded is None:
+            return False
+        path = f"/{reference.repository}/manifests/{reference.reference}"
+        headers = {"Accept": ", ".join(self.ACCEPT_MEDIA_TYPES)}
+        with self.request("HEAD", path, reference, headers) as response:
+            response.read()
+            digest = response.getheader("Docker-Content-Digest")
+        logger.info(f"Image {reference} is at {digest}, recorded {recorded}")
+        return digest == recorded
+
+    def get_manifest(self, reference: ImageReference, ref: str) -> ResolvedManifest:
+        """
+        Request a manifest or image index by tag or digest.
+        """
+        path = f"/{reference.repository}/manifests/{ref}"
+        headers = {"Accept": ", ".join(self.ACCEPT_MEDIA_TYPES)}
+        with self.request("GET", path, reference, headers) as response:
+            content = response.read()
+            media_type = response.getheader("Content-Type", "").split(";")[0].strip()
+            digest = response.getheader("Docker-Content-Digest")
+        document = json.loads(content)
+        media_type = document.get("mediaType") or media_type
+        # Mirrors served by static web servers do not report the media type of OCI documents lacking it.
+        if media_type not in self.ACCEPT_MEDIA_TYPES:
+            media_type = OCI_INDEX if "manifests" in document else OCI_MANIFEST
+        computed = "sha256:" + hashlib.sha256(content).hexdigest()
+        if ref.startswith("sha256:") and computed != ref:
+            raise DigestMismatch(f"Digest mismatch for manifest {reference.repository}@{ref}: Got {computed}")
+        if digest and digest.startswith("sha256:") and computed != digest:
+            raise DigestMismatch(f"Digest mismatch for manifest {reference.repository}:{ref}: Got {computed}")
+        if self.cache is not None:
+            self.cache.put_manifest(reference.registry, reference.repository, computed, content)
+        return ResolvedManifest(digest=computed, media_type=media_type, content=content)
+
+    @staticmethod
+    def select_platform(index: dict, reference: ImageReference) -> dict:
+        """
+        Select the manifest for the host platform from an image index.
+        """
+        architecture = OCI_ARCHITECTURES.get(platform.machine().lower(), platform.machine().lower())
+        for descriptor in index.get("manifests", []):
+            descriptor_platform = descriptor.get("platform", {})
+            if descriptor_platform.get("os") == "linux" and descriptor_platform.get("architecture") == architecture:
+                return descriptor
+        raise InvalidImageReference(f"Image {reference} is not available for platform linux/{architecture}")
+
+    def fetch_blobs(self, reference: ImageReference, manifest: ResolvedManifest):
+        """
+        Download the configuration and all layers of an image manifest into the blob store, concurrently.
+        """
+        descriptors = [manifest.config] + manifest.layers
+        missing = [descriptor for descriptor in descriptors if not self.store.has(descriptor["digest"])]
+        logger.info(f"Image {reference} has {len(manifest.layers)} layers, {len(missing)} blobs need to be downloaded")
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="postroj-blob") as executor:
+                for future in [executor.submit(self.fetch_blob, reference, descriptor) for descriptor in missing]:
+                    future.result()
+        if self.cache is not None:
+            for descriptor in descriptors:
+                digest = descriptor["digest"]
+                self.cache.put_blob(reference.registry, reference.repository, digest, self.store.blob_path(digest))
+
+    def fetch_blob(self, reference: ImageReference, descriptor: dict):
+        """
+        Download a single blob into the blob store, verifying its digest while streaming.
+        """
+        digest = descriptor["digest"]
+        path = f"/{reference.repository}/blobs/{digest}"
+        start = time.monotonic()
+        with self.request("GET", path, reference) as response:
+            with self.store.ingest(digest, size=descriptor.get("size")) as writer:
+                while True:
+                    chunk = response.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+        duration = time.monotonic() - start
+        rate = writer.size / duration / 1024 / 1024 if duration else 0
+        logger.info(f"Downloaded blob {digest} with {writer.size} bytes in {duration:.2f}s ({rate:.1f} MB/s)")
+
+    def write_layout(self, reference: ImageReference, manifest: ResolvedManifest, layout: Path, tag: str):
+        """
+        Write an OCI image layout referencing the image manifest.
+
+        Docker manifests are converted to OCI manifests, by adjusting their
+        media types. The upstream manifest digest is recorded as annotation.
+        """
+        document = manifest.document
+        if manifest.media_type != OCI_MANIFEST:
+            document["mediaType"] = OCI_MANIFEST
+            for descriptor in [document["config"]] + document["layers"]:
+                descriptor["mediaType"] = DOCKER_TO_OCI_MEDIA_TYPES.get(
+                    descriptor["mediaType"], descriptor["mediaType"]
+                )
+            content = json.dumps(document, indent=2).encode()
+        else:
+            content = manifest.content
+        annotations = {
+            ANNOTATION_SOURCE_NAME: str(reference),
+            ANNOTATION_SOURCE_DIGEST: manifest.digest,
+            ANNOTATION_SOURCE_TAG_DIGEST: manifest.tag_digest or manifest.digest,
+        }
+        write_layout(self.store, layout, content, tag=tag, annotations=annotations)
+
+    def endpoints(self, reference: ImageReference) -> List[str]:
+        """
+        Return the base URLs of the registry API to request, mirrors first.
+        """
+        mirrors = self.mirrors.get(reference.registry, [])
+        return [registry_endpoint(mirror) for mirror in mirrors] + [reference.endpoint]
+
+    @contextmanager
+    def request(
+        self, method: str, path: str, reference: ImageReference, headers: Optional[Dict[str, str]] = None
+    ) -> Generator[http.client.HTTPResponse, None, None]:
+        """
+        Submit a request to the registry, or its mirrors, in order.
+        Fall back to the next endpoint, when a request fails.
+        """
+        endpoints = self.endpoints(reference)
+        for position, endpoint in enumerate(endpoints):
+            stack = ExitStack()
+            try:
+                response = stack.enter_context(self.request_endpoint(method, endpoint, path, reference, headers))
+            except (RegistryError, InvalidImageReference) as ex:
+                if position == len(endpoints) - 1:
+                    raise
+                logger.warning(f"Registry mirror {endpoint} failed, trying next endpoint. {ex}")
+                continue
+            with stack:
+                yield response
+                return
+
+    @contextmanager
+    def request_endpoint(
+        self,
+        method: str,
+        endpoint: str,
+        path: str,
+        reference: ImageReference,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Generator[http.client.HTTPResponse, None, None]:
+        """
+        Submit a request to a registry endpoint, negotiating a bearer token on demand.
+        """
+        url = endpoint + path
+        headers = dict(headers or {})
+        key = (endpoint, reference.repository)
+        for attempt in range(2):
+            if key in self._tokens:
+                headers["Authorization"] = f"Bearer {self._tokens[key]}"
+            stack = ExitStack()
+            try:
+                response = stack.enter_context(self.http.request(method, url, headers=headers))
+            except (OSError, http.client.HTTPException) as ex:
+                raise RegistryError(f"Request to {url} failed: {ex.__class__.__name__}: {ex}") from ex
+            with stack:
+                challenge = response.getheader("WWW-Authenticate")
+                if response.status == 401 and challenge and attempt == 0:
+                    response.read()
+                    token = self.authenticate(reference, challenge)
+                    with self._lock:
+                        self._tokens[key] = token
+                    continue
+                if response.status >= 400:
+                    details = response.read()[:500].decode(errors="replace")
+                    message = f"Request to {url} failed with status {response.status}: {details}"
+                    if response.status in [401, 403, 404]:
+                        raise InvalidImageReference(f"Unable to acquire image {reference}. {message}")
+                    raise RegistryError(message)
+                yield response
+                return
+
+    def authenticate(self, reference: ImageReference, challenge: str):
+        """
+        Acquire an anonymous bearer token, as requested by a `WWW-Authenticate` challenge.
+        """
+        scheme, _, params = challenge.partition(" ")
+        if scheme.lower() != "bearer":
+            raise RegistryError(f"Unsupported authentication scheme for {reference.registry}: {scheme}")
+        options = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        realm = options.pop("realm", None)
+        if not realm:
+            raise RegistryError(f"Invalid authentication challenge from {reference.registry}: {challenge}")
+        options.setdefault("scope", f"repository:{reference.repository}:pull")
+        with self.http.request("GET", f"{realm}?{urlencode(options)}") as response:
+            body = response.read()
+            if response.status != 200:
+                raise RegistryError(f"Authentication at {realm} failed with status {response.status}")
+        payload = json.loads(body)
+        return payload.get("token") or payload.get("access_token")
+
+    def close(self):
+        self.http.close()
+
+
+def write_layout(
+    store: BlobStore, layout: Path, manifest: bytes, tag: str, annotations: Optional[Dict[str, str]] = None
+):
+    """
+    Write an OCI image layout, designating an OCI image manifest by `tag`.
+
+    The manifest, and all blobs it references, are stored within the blob store.
+    """
+    digest = "sha256:" + hashlib.sha256(manifest).hexdigest()
+    if not store.has(digest):
+        store.put(digest, manifest)
+    index = {
+        "schemaVersion": 2,
+        "mediaType": OCI_INDEX,
+        "manifests": [
+            {
+                "mediaType": OCI_MANIFEST,
+                "digest": digest,
+                "size": len(manifest),
+                "annotations": {ANNOTATION_REF_NAME: tag, **(annotations or {})},
+            }
+        ],
+    }
+    layout.mkdir(parents=True, exist_ok=True)
+    (layout / "oci-layout").write_text(json.dumps({"imageLayoutVersion": "1.0.0"}))
+    store.link_layout(layout, index=index)
+    # Write `index.json` last, it signals the layout is complete.
+    (layout / "index.json").write_text(json.dumps(index, indent=2))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import fcntl
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Generator, Iterable, List
+
+from postroj.dedupe import FICLONE
+from postroj.download import CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+def parse_mirrors(entries: Iterable[str]) -> Dict[str, List[str]]:
+    """
+    Parse registry mirror definitions like ``docker.io=registry.internal:5000`` into a mirror map.
+
+    Multiple mirrors for the same registry are consulted in the order of their definition.
+    Mirrors are either registry hosts, or base URLs like ``http://cache.internal:8080/docker.io``.
+    """
+    mirrors: Dict[str, List[str]] = {}
+    for entry in entries:
+        registry, separator, mirror = entry.partition("=")
+        if not separator or not registry.strip() or not mirror.strip():
+            raise ValueError(f"Invalid registry mirror definition: {entry}. Use `<registry>=<mirror>`")
+        mirrors.setdefault(registry.strip(), []).append(mirror.strip())
+    return mirrors
+
+
+def registry_endpoint(host: str) -> str:
+    """
+    Return the base URL of the registry API for a registry host or base URL.
+
+    Registries on `localhost` are accessed using plain HTTP.
+    """
+    if "://" in host:
+        return host.rstrip("/") + "/v2"
+    hostname = host.split(":")[0]
+    scheme = "http" if hostname in ["localhost", "127.0.0.1", "::1"] else "https"
+    return f"{scheme}://{host}/v2"
+
+
+class PullThroughCache:
+    """
+    Store manifests and blobs fetched from container registries, for other hosts.
+
+    The cache uses the path layout of the OCI distribution API, i.e.
+    ``<path>/<registry>/v2/<repository>/manifests/<digest>`` and
+    ``<path>/<registry>/v2/<repository>/blobs/<digest>``. Served by any
+    static web server, it can be configured as a registry mirror on other
+    hosts, like ``docker.io=http://cache.internal:8080/docker.io``.
+
+    Only content addressed by digest is stored, because it never changes.
+    Tags move upstream, and a static web server can not revalidate them.
+    Hence, other hosts resolve tags using the registry itself, falling back
+    from the mirror, and acquire the manifests and blobs from the cache.
+
+    Blobs are cloned from the blob store, on filesystems supporting reflinks,
+    and copied otherwise. They are not hardlinked, because the link count of
+    a blob is its reference count, and garbage collection of the blob store
+    would never reclaim a blob once cached.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def repository_path(self, registry: str, repository: str) -> Path:
+        return self.path / registry / "v2" / repository
+
+    def put_manifest(self, registry: str, repository: str, digest: str, content: bytes):
+        """
+        Store a manifest or image index by digest.
+        """
+        target = self.repository_path(registry, repository) / "manifests" / digest
+        with atomic_target(target) as temporary:
+            temporary.write_bytes(content)
+
+    def put_blob(self, registry: str, repository: str, digest: str, source: Path):
+        """
+        Store a blob, unless it is already present. Blobs are immutable.
+        """
+        target = self.repository_path(registry, repository) / "blobs" / digest
+        if target.exists():
+            return
+        with atomic_target(target) as temporary:
+            clone_file(source, temporary)
+        logger.info(f"Stored blob {digest} of {registry}/{repository} within pull-through cache")
+
+
+def clone_file(source: Path, target: Path):
+    """
+    Copy a file, sharing its storage on filesystems supporting reflinks.
+    """
+    with open(source, "rb") as original, open(target, "wb") as clone:
+        try:
+            fcntl.ioctl(clone.fileno(), FICLONE, original.fileno())
+        except OSError:
+            shutil.copyfileobj(original, clone, CHUNK_SIZE)
+
+
+@contextmanager
+def atomic_target(target: Path) -> Generator[Path, None, None]:
+    """
+    Provide a temporary path next to `target`, and move it into place on success.
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    temporary = target.with_name(f".{target.name}.{os.getpid()}-{time.time_ns()}.tmp")
+    try:
+        yield temporary
+        os.replace(temporary, target)
+    finally:
+        temporary.unlink(missing_ok=True)
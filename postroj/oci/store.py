@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Generator, Optional, Set, Tuple
+
+from postroj.exceptions import DigestMismatch, LockTimeout
+from postroj.lock import FileLock
+
+logger = logging.getLogger(__name__)
+
+
+# Media types of OCI and Docker documents which refer to other blobs.
+INDEX_MEDIA_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+]
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+]
+
+
+class BlobStore:
+    """
+    A content-addressed store for OCI blobs, shared by all OCI image layouts
+    within the archive directory.
+
+    Blobs are stored at ``<path>/<algorithm>/<encoded>``, which is the same
+    scheme used by the ``blobs`` directory of an OCI image layout.
+
+    OCI image layouts reference blobs by hardlinking them from the store.
+    Hence, the reference count of a blob is its link count minus one, and
+    removing a layout directory releases all of its references.
+
+    Blobs are not referenced between ingesting them and linking them into
+    a layout. Operations doing so hold the store lock shared for their whole
+    duration, and garbage collection holds it exclusively.
+
+    - https://github.com/opencontainers/image-spec/blob/main/image-layout.md
+    """
+
+    # Directory for blobs in flight, before they have been verified.
+    INGEST_DIRECTORY = ".ingest"
+
+    # Lock file, see `lock`.
+    LOCK_FILE = ".lock"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def setup(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def lock(self, shared: bool = True, timeout: Optional[float] = None) -> FileLock:
+        """
+        Return the store lock. Hold it shared while ingesting blobs and linking them into a layout.
+        """
+        return FileLock(self.path / self.LOCK_FILE, timeout=timeout, shared=shared)
+
+    def blob_path(self, digest: str) -> Path:
+        """
+        Return path to blob within the store.
+        """
+        return self.path.joinpath(*split_digest(digest))
+
+    def has(self, digest: str) -> bool:
+        return self.blob_path(digest).exists()
+
+    @contextmanager
+    def ingest(self, digest: str, size: Optional[int] = None) -> Generator["BlobWriter", None, None]:
+        """
+        Write a blob into the store.
+
+        The content is hashed while streaming, and only committed to the store
+        when it matches the designated digest and size.
+        """
+        algorithm, encoded = split_digest(digest)
+        ingest_directory = self.path / self.INGEST_DIRECTORY
+        ingest_directory.mkdir(parents=True, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=ingest_directory)
+        try:
+            with open(fd, "wb") as f:
+                writer = BlobWriter(f, hashlib.new(algorithm))
+                yield writer
+            if writer.hexdigest() != encoded:
+                raise DigestMismatch(f"Digest mismatch for blob {digest}: Got {algorithm}:{writer.hexdigest()}")
+            if size is not None and writer.size != size:
+                raise DigestMismatch(f"Size mismatch for blob {digest}: Expected {size} bytes, got {writer.size}")
+            target = self.blob_path(digest)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmpname, target)
+        finally:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+
+    def put(self, digest: str, data: bytes):
+        """
+        Write a small blob, like a manifest or configuration document, into the store.
+        """
+        with self.ingest(digest, size=len(data)) as writer:
+            writer.write(data)
+
+    def adopt(self, path: Path) -> str:
+        """
+        Move a file into the store, and return its digest. When the
+        blob is already present, the file is removed instead.
+        """
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        digest = f"sha256:{hasher.hexdigest()}"
+        target = self.blob_path(digest)
+        if target.exists():
+            os.unlink(path)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path, target)
+        return digest
+
+    def refcount(self, digest: str) -> int:
+        """
+        Return the number of OCI image layouts referencing a blob.
+        """
+        return self.blob_path(digest).stat().st_nlink - 1
+
+    def link(self, digest: str, layout: Path):
+        """
+        Reference a blob from an OCI image layout by hardlinking it.
+        """
+        source = self.blob_path(digest)
+        target = Path(layout).joinpath("blobs", *split_digest(digest))
+        if target.exists():
+            if os.path.samefile(source, target):
+                return
+            target.unlink()
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.link(source, target)
+
+    def link_layout(self, layout: Path, index: Optional[dict] = None):
+        """
+        Reference all blobs needed by an OCI image layout, optionally
+        using the designated index document instead of `index.json`.
+        """
+        for digest in self.layout_digests(layout, index=index):
+            self.link(digest, layout)
+
+    def layout_digests(self, layout: Path, index: Optional[dict] = None) -> Set[str]:
+        """
+        Resolve the digests of all blobs referenced by an OCI image layout.
+        """
+        if index is None:
+            index = json.loads((Path(layout) / "index.json").read_text())
+        return set(self._walk(index))
+
+    def _walk(self, document: dict) -> Generator[str, None, None]:
+        """
+        Recursively enumerate all blobs referenced by an image index or manifest.
+        Referenced documents are read from the store.
+        """
+        descriptors = list(document.get("manifests", []))
+        if "config" in document:
+            descriptors.append(document["config"])
+        descriptors += document.get("layers", [])
+        for descriptor in descriptors:
+            digest = descriptor["digest"]
+            yield digest
+            if descriptor.get("mediaType") in INDEX_MEDIA_TYPES + MANIFEST_MEDIA_TYPES:
+                blob = self.blob_path(digest)
+                if blob.exists():
+                    yield from self._walk(json.loads(blob.read_bytes()))
+
+    def collect_garbage(self) -> int:
+        """
+        Remove all blobs not referenced by any OCI image layout.
+        Return the number of reclaimed bytes.
+
+        When other processes are acquiring images, garbage collection
+        is skipped, in order not to remove blobs about to be referenced.
+        """
+        reclaimed = 0
+        if not self.path.exists():
+            return reclaimed
+        try:
+            lock = self.lock(shared=False, timeout=0).acquire()
+        except LockTimeout:
+            logger.info(f"Skipping garbage collection, blob store {self.path} is in use")
+            return reclaimed
+        try:
+            for blob in self.path.glob("*/*"):
+                if blob.parent.name == self.INGEST_DIRECTORY:
+                    continue
+                stat = blob.stat()
+                if blob.is_file() and stat.st_nlink <= 1:
+                    logger.info(f"Removing unreferenced blob {blob}")
+                    blob.unlink()
+                    reclaimed += stat.st_size
+        finally:
+            lock.release()
+        return reclaimed
+
+
+class BlobWriter:
+    """
+    Write a blob to a file, while computing its digest and size.
+    """
+
+    def __init__(self, f: BinaryIO, hasher):
+        self.f = f
+        self.hasher = hasher
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.f.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+
+def split_digest(digest: str) -> Tuple[str, str]:
+    """
+    Split an OCI content digest like `sha256:abc...` into algorithm and encoded part.
+    """
+    try:
+        algorithm, encoded = digest.split(":", maxsplit=1)
+    except ValueError:
+        raise ValueError(f"Invalid digest: {digest}")
+    if not algorithm or not encoded or "/" in encoded or encoded.startswith("."):
+        raise ValueError(f"Invalid digest: {digest}")
+    return algorithm, encoded
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import copy
+import dataclasses
+import gzip
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import shutil
+import subprocess
+import tarfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, List, Optional
+
+from postroj.exceptions import InvalidPhysicalImage
+from postroj.oci.store import split_digest
+from postroj.util import cmd, resolve_in_root
+
+logger = logging.getLogger(__name__)
+
+
+# Record the descriptor of the unpacked image manifest within the bundle.
+MANIFEST_FILE = "manifest.json"
+
+WHITEOUT_PREFIX = ".wh."
+WHITEOUT_OPAQUE = ".wh..wh..opq"
+
+CHUNK_SIZE = 1024 * 1024
+
+# Pass `filter` argument to `tarfile` on Python versions supporting it.
+# Paths are resolved by the unpacker itself, so the member can be trusted.
+EXTRACT_OPTIONS = {"filter": "fully_trusted"} if hasattr(tarfile, "fully_trusted_filter") else {}
+
+
+@dataclasses.dataclass
+class LayerTiming:
+    """
+    Capture timing information about unpacking a single layer.
+    """
+
+    digest: str
+    size: int = 0
+    uncompressed_size: int = 0
+    entries: int = 0
+    decompress_seconds: float = 0.0
+    apply_seconds: float = 0.0
+    reused: bool = False
+
+
+class LayerUnpacker:
+    """
+    Unpack an image from an OCI image layout into a root filesystem.
+
+    Layers are decompressed concurrently into a staging area, and applied in
+    order, honoring whiteout files and opaque directories. The outcome is a
+    bundle directory with a ``rootfs`` subdirectory, like ``umoci unpack``
+    would produce it. When running as root, file ownership is retained.
+
+    - https://github.com/opencontainers/image-spec/blob/main/layer.md
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers or min(8, os.cpu_count() or 1)
+
+    def unpack(
+        self, layout: Path, bundle: Path, tag: str = "default", snapshots: Optional[Path] = None
+    ) -> List[LayerTiming]:
+        """
+        Unpack image designated by `tag` from OCI image layout into bundle directory.
+
+        When a `snapshots` directory is given, the state of the root filesystem
+        is recorded after applying each layer below the topmost one, keyed by
+        the chain of layer digests. On subsequent invocations, for example when
+        an upstream tag has been moved, the unchanged lower part of the root
+        filesystem is restored from the deepest matching snapshot, and only the
+        layers from the first changed one onward are applied.
+
+        Snapshots share unchanged files with the root filesystem by hardlinking.
+        Layers are applied by unlinking existing files before writing them, so
+        shared files are never modified in place.
+        """
+        descriptor = read_descriptor(layout, tag)
+        manifest = read_manifest(layout, tag)
+        rootfs = bundle / "rootfs"
+        staging = bundle / ".staging"
+        (bundle / MANIFEST_FILE).unlink(missing_ok=True)
+        staging.mkdir(parents=True, exist_ok=True)
+
+        layers = manifest["layers"]
+        chain = chain_ids([layer["digest"] for layer in layers])
+        timings = [LayerTiming(digest=layer["digest"], size=layer.get("size", 0)) for layer in layers]
+
+        # Restore the unchanged lower part of the root filesystem from a snapshot.
+        shutil.rmtree(rootfs, ignore_errors=True)
+        first = 0
+        if snapshots is not None:
+            for number in reversed(range(len(layers) - 1)):
+                snapshot = snapshots / chain[number]
+                if snapshot.is_dir():
+                    logger.info(f"Restoring {number + 1} unchanged layers from snapshot {snapshot}")
+                    link_tree(snapshot, rootfs)
+                    first = number + 1
+                    break
+        for timing in timings[:first]:
+            timing.reused = True
+        rootfs.mkdir(parents=True, exist_ok=True)
+
+        logger.info(f"Unpacking {len(layers) - first} of {len(layers)} layers into {rootfs}")
+        start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="postroj-unpack") as executor:
+                futures: List[Future] = [
+                    executor.submit(self.decompress, layout, layers[number], staging / f"{number}.tar", timings[number])
+                    for number in range(first, len(layers))
+                ]
+                # Apply layers in order, while subsequent layers are still being decompressed.
+                for number, future in enumerate(futures, start=first):
+                    timing = timings[number]
+                    tarball = future.result()
+                    apply_start = time.monotonic()
+                    timing.entries = apply_layer(tarball, rootfs)
+                    timing.apply_seconds = time.monotonic() - apply_start
+                    tarball.unlink()
+                    logger.info(
+                        f"Layer {number + 1}/{len(layers)} {timing.digest}: "
+                        f"Decompressed {timing.size} to {timing.uncompressed_size} bytes "
+                        f"in {timing.decompress_seconds:.2f}s, "
+                        f"applied {timing.entries} entries in {timing.apply_seconds:.2f}s"
+                    )
+                    if snapshots is not None and number < len(layers) - 1:
+                        take_snapshot(rootfs, snapshots / chain[number])
+        except Exception:
+            shutil.rmtree(rootfs, ignore_errors=True)
+            raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        # Remove snapshots not belonging to the current chain of layers.
+        if snapshots is not None:
+            for snapshot in snapshots.iterdir():
+                if snapshot.name not in chain[:-1]:
+                    logger.info(f"Removing stale snapshot {snapshot}")
+                    shutil.rmtree(snapshot, ignore_errors=True)
+
+        (bundle / MANIFEST_FILE).write_text(json.dumps(descriptor, indent=2))
+        logger.info(f"Unpacked {len(layers) - first} layers in {time.monotonic() - start:.2f}s")
+        return timings
+
+    @staticmethod
+    def decompress(layout: Path, layer: dict, target: Path, timing: LayerTiming) -> Path:
+        """
+        Decompress a layer blob into an uncompressed tarball within the staging area.
+        """
+        start = time.monotonic()
+        blob = layout.joinpath("blobs", *split_digest(layer["digest"]))
+        with open_layer(blob) as source, open(target, "wb") as f:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                timing.uncompressed_size += len(chunk)
+        timing.decompress_seconds = time.monotonic() - start
+        return target
+
+
+def chain_ids(digests: List[str]) -> List[str]:
+    """
+    Compute identifiers for each stack of layers, from the bottom up.
+    Each identifier covers the layer itself, and all layers below it.
+    """
+    chain = []
+    for digest in digests:
+        parent = chain[-1] if chain else ""
+        chain.append(hashlib.sha256(f"{parent} {digest}".encode()).hexdigest())
+    return chain
+
+
+def take_snapshot(rootfs: Path, snapshot: Path):
+    """
+    Record the state of a root filesystem, by hardlinking its files into the snapshot directory.
+    """
+    if snapshot.exists():
+        return
+    snapshot.parent.mkdir(parents=True, exist_ok=True)
+    temporary = snapshot.with_name(snapshot.name + ".tmp")
+    shutil.rmtree(temporary, ignore_errors=True)
+    link_tree(rootfs, temporary)
+    temporary.rename(snapshot)
+
+
+def link_tree(source: Path, target: Path):
+    """
+    Copy a directory tree, hardlinking all files instead of copying their content.
+    """
+    cmd(f"cp --archive --link {source} {target}", passthrough=False)
+
+
+def read_descriptor(layout: Path, tag: str) -> dict:
+    """
+    Read the descriptor of the image manifest designated by `tag` from an OCI image layout.
+    """
+    index = json.loads((layout / "index.json").read_text())
+    for descriptor in index.get("manifests", []):
+        if descriptor.get("annotations", {}).get("org.opencontainers.image.ref.name") == tag:
+            return descriptor
+    raise InvalidPhysicalImage(f"Image {tag} not found in OCI image layout at {layout}")
+
+
+def read_manifest(layout: Path, tag: str) -> dict:
+    """
+    Read the image manifest designated by `tag` from an OCI image layout.
+    """
+    descriptor = read_descriptor(layout, tag)
+    return json.loads(layout.joinpath("blobs", *split_digest(descriptor["digest"])).read_bytes())
+
+
+def read_unpacked_descriptor(bundle: Path) -> Optional[dict]:
+    """
+    Read the descriptor of the image manifest a bundle has been unpacked from.
+    """
+    path = bundle / MANIFEST_FILE
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
+
+
+def open_layer(blob: Path) -> BinaryIO:
+    """
+    Open a layer blob for reading its uncompressed content.
+
+    The compression is determined by sniffing the magic bytes, media types
+    are not always accurate. zstd-compressed layers need the `zstd` program.
+    """
+    with open(blob, "rb") as f:
+        magic = f.read(4)
+    if magic[:2] == b"\x1f\x8b":
+        return gzip.open(blob, "rb")
+    if magic == b"\x28\xb5\x2f\xfd":
+        process = subprocess.Popen(["zstd", "--decompress", "--stdout", str(blob)], stdout=subprocess.PIPE)
+        return ProcessReader(process)
+    return open(blob, "rb")
+
+
+class ProcessReader:
+    """
+    Read the output of a subprocess, checking its exit status when closing.
+    """
+
+    def __init__(self, process: subprocess.Popen):
+        self.process = process
+
+    def read(self, size: int = -1) -> bytes:
+        return self.process.stdout.read(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        if exc_type is None and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.process.args)
+
+
+def apply_layer(tarball: Path, rootfs: Path) -> int:
+    """
+    Apply an uncompressed layer tarball onto a root filesystem. Return the number of entries.
+
+    Whiteout files only refer to content of lower layers, so they are applied
+    before extracting the other entries of the layer. All paths are resolved
+    relative to the root filesystem, so no entry can escape it.
+    """
+    with tarfile.open(tarball, mode="r:") as tar:
+        members = tar.getmembers()
+
+        # Apply whiteouts, removing content from lower layers.
+        for member in members:
+            dirname, basename = split_member_name(member.name)
+            if basename == WHITEOUT_OPAQUE:
+                directory = resolve_in_root(rootfs, dirname)
+                if directory.is_dir():
+                    for child in directory.iterdir():
+                        remove_path(child)
+            elif basename.startswith(WHITEOUT_PREFIX):
+                remove_path(resolve_in_root(rootfs, dirname) / basename[len(WHITEOUT_PREFIX) :])
+
+        # Extract all other entries. Directory attributes are applied at the end,
+        # otherwise their modification times or permissions would be changed again.
+        directories = []
+        for member in members:
+            dirname, basename = split_member_name(member.name)
+            if not basename or basename.startswith(WHITEOUT_PREFIX):
+                continue
+            parent = resolve_in_root(rootfs, dirname)
+            parent.mkdir(parents=True, exist_ok=True)
+            target = parent / basename
+            if member.isdir():
+                if not target.is_dir() or target.is_symlink():
+                    remove_path(target)
+                    target.mkdir()
+                directories.append((member, target))
+                continue
+            # Always unlink existing entries, in order not to modify other hardlinks to them.
+            remove_path(target)
+            entry = copy.copy(member)
+            entry.name = basename
+            if member.islnk():
+                link_dirname, link_basename = split_member_name(member.linkname)
+                entry.linkname = str(resolve_in_root(rootfs, link_dirname) / link_basename)
+            try:
+                tar.extract(entry, path=str(parent), numeric_owner=True, **EXTRACT_OPTIONS)
+            except OSError as ex:
+                if (member.ischr() or member.isblk()) and os.geteuid() != 0:
+                    logger.debug(f"Skipping device node {member.name}: {ex}")
+                    continue
+                raise
+
+        for member, target in reversed(directories):
+            entry = copy.copy(member)
+            entry.name = target.name
+            tar.chown(entry, str(target), numeric_owner=True)
+            tar.chmod(entry, str(target))
+            tar.utime(entry, str(target))
+
+    return len(members)
+
+
+def split_member_name(name: str):
+    """
+    Normalize the name of a tarball member, and split it into directory and base name.
+    """
+    name = posixpath.normpath("/" + name).lstrip("/")
+    return posixpath.split(name)
+
+
+def remove_path(path: Path):
+    """
+    Remove a file, symlink, or directory tree, if it exists.
+    """
+    if path.is_symlink() or (path.exists() and not path.is_dir()):
+        path.unlink()
+    elif path.is_dir():
+        shutil.rmtree(path)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import logging
+from pathlib import Path
+from typing import List, Optional, Union
+
+from postroj.util import hcmd
+
+logger = logging.getLogger(__name__)
+
+
+# Suffix of the link designating the provisioning layer of an image, next to its image directory.
+LAYER_SUFFIX = ".layer"
+
+
+class OverlayMount:
+    """
+    An overlay filesystem, stacking layer directories over each other.
+
+    With an `upper` directory, all changes are written to it, leaving the
+    `lower` directories untouched. Without, the overlay filesystem is
+    read-only, and can be mounted multiple times concurrently.
+
+    - https://docs.kernel.org/filesystems/overlayfs.html
+    """
+
+    def __init__(self, lower: List[Path], target: Path, upper: Optional[Path] = None, work: Optional[Path] = None):
+        # Lower directories, topmost first.
+        self.lower = [Path(path) for path in lower]
+        self.target = Path(target)
+        self.upper = upper and Path(upper)
+        self.work = work and Path(work)
+        self.mounted = False
+
+    def options(self) -> str:
+        options = [f"lowerdir={':'.join(str(path) for path in self.lower)}"]
+        if self.upper is not None:
+            options += [f"upperdir={self.upper}", f"workdir={self.work}"]
+        return ",".join(options)
+
+    def mount(self) -> Path:
+        self.target.mkdir(parents=True, exist_ok=True)
+        if self.upper is not None:
+            self.upper.mkdir(parents=True, exist_ok=True)
+            self.work.mkdir(parents=True, exist_ok=True)
+        hcmd(f"mount -t overlay overlay -o {self.options()} {self.target}", passthrough=False)
+        self.mounted = True
+        return self.target
+
+    def unmount(self, lazy: bool = False):
+        """
+        Unmount the overlay filesystem. With `lazy`, detach it immediately,
+        and clean it up as soon as it is not busy anymore.
+        """
+        if not self.mounted:
+            return
+        hcmd(f"umount {'--lazy ' if lazy else ''}{self.target}", passthrough=False)
+        self.mounted = False
+        try:
+            self.target.rmdir()
+        except OSError:
+            pass
+
+    def __enter__(self) -> Path:
+        return self.mount()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.unmount()
+
+
+def find_layers(image_path: Union[Path, str]) -> List[Path]:
+    """
+    Return the layers to be stacked over the image directory when launching a container, topmost first.
+
+    Images are activated by symlinking ``images/<name>`` to ``archive/<name>.img``. When the image
+    has been provisioned, ``archive/<name>.layer`` links to its provisioning layer. Packed images
+    already contain their provisioning layer.
+    """
+    image = Path(image_path).resolve()
+    if not image.is_dir():
+        return []
+    layer = image.with_suffix(LAYER_SUFFIX)
+    if layer.exists():
+        return [layer.resolve()]
+    return []
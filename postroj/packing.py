@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import logging
+import shutil
+from pathlib import Path
+from typing import List, Optional, Union
+
+from postroj.exceptions import InvalidPhysicalImage
+from postroj.overlay import OverlayMount
+from postroj.util import hcmd
+
+logger = logging.getLogger(__name__)
+
+
+# Compressed read-only image formats, and the programs used to create them.
+PACK_FORMATS = {
+    "squashfs": "mksquashfs",
+    "erofs": "mkfs.erofs",
+}
+
+
+class ImagePacker:
+    """
+    Pack an OS root directory into a compressed read-only image.
+
+    Compared to directory trees, packed images need much less disk space,
+    a single inode each, and can be copied between hosts quickly. They are
+    booted from a read-only loop mount, using ``--volatile=overlay`` as
+    before, see `LoopMount`.
+
+    When `layers` are given, the packed image contains the merged directory
+    of an overlay filesystem, stacking the layers over the root directory,
+    so provisioning layers become part of the packed image.
+
+    - https://docs.kernel.org/filesystems/squashfs.html
+    - https://docs.kernel.org/filesystems/erofs.html
+    """
+
+    def __init__(self, format: str = "squashfs", compression: str = "zstd"):
+        if format not in PACK_FORMATS:
+            raise ValueError(f"Unknown image format: {format}. Use one of {', '.join(PACK_FORMATS)}")
+        self.format = format
+        self.compression = compression
+
+    @property
+    def program(self) -> str:
+        return PACK_FORMATS[self.format]
+
+    def command(self, source: Path, target: Path) -> str:
+        if self.format == "squashfs":
+            return f"{self.program} {source} {target} -comp {self.compression} -noappend -no-progress -quiet"
+        else:
+            return f"{self.program} -z{self.compression} --quiet {target} {source}"
+
+    def pack(self, rootfs: Path, target: Path, layers: Optional[List[Path]] = None) -> Path:
+        """
+        Pack an OS root directory, and its layers, into a packed image at `target`.
+        The image is staged next to the target, and only moved into place on success.
+        """
+        if shutil.which(self.program) is None:
+            raise InvalidPhysicalImage(f"Unable to pack image, program not found: {self.program}")
+        partial = target.with_name(target.name + ".partial")
+        partial.unlink(missing_ok=True)
+        logger.info(f"Packing OS root directory {rootfs} into {target}")
+        try:
+            if layers:
+                with OverlayMount(lower=layers + [rootfs], target=target.with_name(target.name + ".mnt")) as merged:
+                    hcmd(self.command(merged, partial), passthrough=False)
+            else:
+                hcmd(self.command(rootfs, partial), passthrough=False)
+            partial.rename(target)
+        except Exception:
+            partial.unlink(missing_ok=True)
+            raise
+        return target
+
+
+class LoopMount:
+    """
+    A read-only loop mount of a packed image.
+    """
+
+    def __init__(self, image: Path, target: Path):
+        self.image = Path(image)
+        self.target = Path(target)
+        self.mounted = False
+
+    @property
+    def format(self) -> str:
+        return self.image.suffix.lstrip(".")
+
+    def mount(self) -> Path:
+        self.target.mkdir(parents=True, exist_ok=True)
+        hcmd(f"mount -t {self.format} -o loop,ro {self.image} {self.target}", passthrough=False)
+        self.mounted = True
+        return self.target
+
+    def unmount(self, lazy: bool = False):
+        if not self.mounted:
+            return
+        hcmd(f"umount {'--lazy ' if lazy else ''}{self.target}", passthrough=False)
+        self.mounted = False
+        try:
+            self.target.rmdir()
+        except OSError:
+            pass
+
+    def __enter__(self) -> Path:
+        return self.mount()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.unmount()
+
+
+def is_packed_image(image_path: Union[Path, str]) -> bool:
+    """
+    Whether an image path refers to a packed image, after following the activation link.
+    """
+    path = Path(image_path).resolve()
+    return path.is_file() and path.suffix.lstrip(".") in PACK_FORMATS
+
+
+def loop_backing_files() -> List[Path]:
+    """
+    Return the backing files of all loop devices.
+    """
+    paths = []
+    for backing_file in Path("/sys/block").glob("loop*/loop/backing_file"):
+        try:
+            paths.append(Path(backing_file.read_text().strip()))
+        except OSError:
+            continue
+    return paths
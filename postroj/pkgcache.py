@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import logging
+from pathlib import Path, PurePosixPath
+from typing import List, Optional
+
+from postroj.exceptions import LockTimeout
+from postroj.lock import FileLock
+from postroj.rootfs import RootfsInspector
+from postroj.settings import get_appsettings
+
+logger = logging.getLogger(__name__)
+
+
+# Cache directories of package managers within the container.
+PACKAGE_CACHE_PATHS = {
+    "apt-get": "/var/cache/apt/archives",
+    "dnf": "/var/cache/dnf",
+    "microdnf": "/var/cache/yum",
+    "yum": "/var/cache/yum",
+    "zypper": "/var/cache/zypp",
+    "pacman": "/var/cache/pacman/pkg",
+}
+
+# Hooks purging the package cache after each transaction, disabled while a package cache is attached.
+# Debian and Ubuntu images from Docker Hub remove all downloaded packages after `apt-get install`.
+PURGE_HOOKS = ["/etc/apt/apt.conf.d/docker-clean"]
+
+
+class PackageCache:
+    """
+    A package cache on the host, per distribution and release, bind-mounted to the
+    cache directory of the package manager within the container, like
+    ``/var/cache/postroj/pkg/debian-bookworm/archives`` to ``/var/cache/apt/archives``.
+    Packages are downloaded once, and reused when provisioning images, and by
+    probes and test runs within containers.
+
+    Package managers do not expect others to use their cache concurrently. Hence,
+    a package cache is only attached to one container at a time, guarded by the
+    lock at ``<cache>.lock``. While it is in use, other containers run without it.
+    """
+
+    def __init__(self, path: Path, target: str, purge_hooks: Optional[List[str]] = None):
+        self.path = Path(path)
+        self.target = target
+        self.purge_hooks = purge_hooks or []
+        self.lock = FileLock(self.path.with_name(f"{self.path.name}.lock"), timeout=0)
+
+    @classmethod
+    def for_rootfs(cls, name: str, rootfs: Path) -> Optional["PackageCache"]:
+        """
+        Return the package cache for an OS root directory, by the package manager found there, or `None`.
+        """
+        inspector = RootfsInspector(rootfs)
+        target = PACKAGE_CACHE_PATHS.get(inspector.package_manager)
+        if target is None:
+            return None
+        path = get_appsettings().package_cache_directory / name / PurePosixPath(target).name
+        return cls(path=path, target=target, purge_hooks=[hook for hook in PURGE_HOOKS if inspector.exists(hook)])
+
+    def attach(self) -> List[str]:
+        """
+        Acquire the package cache, and return the `systemd-nspawn` options for binding it.
+        When it is in use by another container, return no options.
+        """
+        try:
+            self.lock.acquire()
+        except LockTimeout:
+            logger.info(f"Package cache {self.path} is in use, running without it")
+            return []
+        self.path.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Using package cache {self.path} at {self.target}")
+        options = [f"--bind={self.path}:{self.target}"]
+        options += [f"--bind-ro=/dev/null:{hook}" for hook in self.purge_hooks]
+        return options
+
+    def detach(self):
+        self.lock.release()
@@ -11,6 +11,7 @@ from typing import List
 import click
 
 from postroj.container import PostrojContainer
+from postroj.download import Downloader, is_verified
 from postroj.image import ImageProvider
 from postroj.probe import ProbeBase
 from postroj.registry import find_distribution
@@ -86,13 +87,19 @@ class PackageProbe(ProbeBase):
 
         logger.info(f"Setting up package {package}")
 
-        # Download package.
+        # Download package. The download directory is shared with the container.
         if package.startswith("http"):
-            logger.info(f"Downloading {package}")
-            self.run(
-                f"/usr/bin/wget --continue --no-clobber --directory-prefix={settings.download_directory} {package}"
-            )
-            package = settings.download_directory / os.path.basename(package)
+            target = settings.download_directory / os.path.basename(package)
+            if is_verified(target):
+                logger.info(f"Using package {target} from download directory")
+            else:
+                logger.info(f"Downloading {package}")
+                downloader = Downloader()
+                try:
+                    downloader.download(package, target, digest=downloader.published_digest(package))
+                finally:
+                    downloader.close()
+            package = target
         else:
             raise ValueError(f"Unable to acquire package at {package}")
 
@@ -101,7 +108,7 @@ class PackageProbe(ProbeBase):
         if self.is_debian:
             self.run(f"/usr/bin/apt-get install --yes {package}")
         elif self.is_redhat:
-            self.run(f"/usr/bin/yum install -y {package}")
+            self.run(f"/usr/bin/yum install -y --setopt=keepcache=1 {package}")
         elif self.is_suse:
             """
             Problem
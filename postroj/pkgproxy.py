@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import hashlib
+import http.client
+import json
+import logging
+import os
+import re
+import shlex
+import shutil
+import threading
+from email.message import Message
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path, PurePosixPath
+from typing import Dict, List, Optional, Union
+from urllib.parse import urlsplit
+
+from postroj.download import CHUNK_SIZE, HttpValidators
+from postroj.httpclient import HttpClient
+from postroj.oci.mirror import atomic_target
+from postroj.rootfs import RootfsInspector
+from postroj.settings import get_appsettings
+
+logger = logging.getLogger(__name__)
+
+
+# Package files never change under their name, they are served from the cache without asking upstream.
+# This includes files addressed by their digest, like `by-hash` files of APT, and RPM repository metadata.
+# Other files, like `InRelease`, `Packages.xz`, or `repomd.xml`, are revalidated on each request.
+IMMUTABLE_PATTERN = re.compile(
+    r"(\.(u|d)?deb|\.d?rpm|\.pkg\.tar\.(zst|xz|gz)(\.sig)?|/by-hash/[^/]+/[0-9a-f]+|/repodata/[0-9a-f]{32,}-[^/]+)$"
+)
+
+# Response headers relayed to the client.
+RELAYED_HEADERS = ["Content-Type", "ETag", "Last-Modified"]
+
+# Proxy configuration of openSUSE, read by `zypper`. Other package managers honor the `http_proxy` variable.
+SYSCONFIG_PROXY = "/etc/sysconfig/proxy"
+
+# Programs using the package proxy, when running them on containers. Other commands, like
+# probes accessing services within the container, or commands of users, do not use it.
+PACKAGE_MANAGERS = ["apt", "apt-get", "dnf", "microdnf", "yum", "zypper", "pacman"]
+
+
+class PackageProxy:
+    """
+    A caching HTTP proxy for package repositories, used by package managers within containers.
+
+    Responses are stored below ``<path>/<host>``, by the digest of their URL. Package files
+    are served from the cache without contacting upstream, repository metadata is
+    revalidated using conditional requests. When upstream is not reachable, or when
+    running `offline`, all responses are replayed from the cache, so a warmed cache
+    permits provisioning images and running probes without network access.
+
+    Only plain HTTP is proxied. Repositories accessed via HTTPS bypass the proxy.
+    """
+
+    def __init__(self, path: Path, host: str = "127.0.0.1", port: int = 0, offline: bool = False):
+        self.path = Path(path)
+        self.offline = offline
+        self.client = HttpClient()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, name="package-proxy", daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    @property
+    def url(self) -> str:
+        """
+        The URL of the proxy, as seen from containers sharing the network namespace of the host.
+        """
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def environment(self) -> Dict[str, str]:
+        return {"http_proxy": self.url, "no_proxy": "localhost,127.0.0.1"}
+
+    def start(self) -> "PackageProxy":
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.thread.start()
+        logger.info(f"Started package proxy at {self.url}, caching into {self.path}")
+        return self
+
+    def serve_forever(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Serving package proxy at port {self.port}, caching into {self.path}")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.client.close()
+
+    def options(self, rootfs: Union[Path, str]) -> List[str]:
+        """
+        Return the `systemd-nspawn` options for configuring the package manager within `rootfs` to use the proxy.
+        """
+        options = [f"--setenv={name}={value}" for name, value in self.environment.items()]
+        return options + self.bind_options(rootfs)
+
+    def bind_options(self, rootfs: Union[Path, str]) -> List[str]:
+        """
+        Return the `systemd-nspawn` options for binding proxy configuration files into `rootfs`.
+        Configuration files are only bound over existing ones, in order not to leave stubs behind.
+        """
+        if not RootfsInspector(Path(rootfs)).exists(SYSCONFIG_PROXY):
+            return []
+        sysconfig = self.path / f".sysconfig-proxy-{self.port}"
+        if not sysconfig.exists():
+            with atomic_target(sysconfig) as temporary:
+                temporary.write_text(f'PROXY_ENABLED="yes"\nHTTP_PROXY="{self.url}"\nNO_PROXY="localhost,127.0.0.1"\n')
+        return [f"--bind-ro={sysconfig}:{SYSCONFIG_PROXY}"]
+
+    def entry_path(self, url: str) -> Path:
+        return self.path / urlsplit(url).netloc / hashlib.sha256(url.encode()).hexdigest()
+
+    def handle(self, handler: BaseHTTPRequestHandler):
+        """
+        Respond to a proxy request, from the cache, or by forwarding it upstream.
+        """
+        url = handler.path
+        head = handler.command == "HEAD"
+        if urlsplit(url).scheme != "http":
+            return handler.send_error(400, "Only absolute URLs using `http` are proxied")
+
+        path = self.entry_path(url)
+        metadata = self.load(path)
+        if metadata is not None and (self.offline or IMMUTABLE_PATTERN.search(urlsplit(url).path)):
+            logger.debug(f"Serving {url} from cache")
+            return self.send_cached(handler, path, metadata, head)
+        if self.offline:
+            return handler.send_error(504, "Not available within the cache of the package proxy")
+
+        headers = HttpValidators(metadata["etag"], metadata["last_modified"]).headers() if metadata else {}
+        try:
+            with self.client.request(handler.command, url, headers=headers) as response:
+                if response.status == 200 and not head:
+                    return self.store(handler, response, url, path)
+                body = response.read()
+        except (OSError, http.client.HTTPException) as ex:
+            if metadata is None:
+                return handler.send_error(502, f"Upstream not available: {ex}")
+            logger.warning(f"Upstream not available, serving {url} from cache: {ex}")
+            return self.send_cached(handler, path, metadata, head)
+
+        if metadata is not None and (response.status == 304 or response.status >= 500):
+            logger.debug(f"Serving {url} from cache, upstream responded with status {response.status}")
+            return self.send_cached(handler, path, metadata, head)
+        return self.relay(handler, response, body)
+
+    @staticmethod
+    def load(path: Path) -> Optional[Dict[str, Optional[str]]]:
+        metadata = path.with_name(f"{path.name}.json")
+        if not metadata.exists() or not path.exists():
+            return None
+        return json.loads(metadata.read_text())
+
+    @staticmethod
+    def send_cached(handler: BaseHTTPRequestHandler, path: Path, metadata: Dict[str, Optional[str]], head: bool):
+        """
+        Respond from the cache. When the client already has this version, according to
+        its `If-None-Match` or `If-Modified-Since` headers, respond with `304 Not Modified`.
+        """
+        not_modified = is_not_modified(handler.headers, metadata)
+        with open(path, "rb") as data:
+            handler.send_response(304 if not_modified else 200)
+            for header in RELAYED_HEADERS:
+                value = metadata[header.lower().replace("-", "_")]
+                if value:
+                    handler.send_header(header, value)
+            if not not_modified:
+                handler.send_header("Content-Length", str(os.fstat(data.fileno()).st_size))
+            handler.end_headers()
+            if not head and not not_modified:
+                shutil.copyfileobj(data, handler.wfile, CHUNK_SIZE)
+
+    @staticmethod
+    def relay(handler: BaseHTTPRequestHandler, response: http.client.HTTPResponse, body: bytes):
+        """
+        Relay a response without storing it, like errors, and responses to `HEAD` requests.
+        """
+        handler.send_response(response.status)
+        for header in RELAYED_HEADERS:
+            value = response.getheader(header)
+            if value:
+                handler.send_header(header, value)
+        handler.send_header("Content-Length", response.getheader("Content-Length", str(len(body))))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    @staticmethod
+    def store(handler: BaseHTTPRequestHandler, response: http.client.HTTPResponse, url: str, path: Path):
+        """
+        Stream a response to the client and into the cache at the same time.
+
+        When the client disconnects, the download is completed nevertheless, in order to warm the cache.
+        Incomplete downloads are discarded. As the response has been started already, the connection
+        to the client is closed then, signalling the failure.
+        """
+        handler.send_response(200)
+        for header in RELAYED_HEADERS:
+            value = response.getheader(header)
+            if value:
+                handler.send_header(header, value)
+        length = response.getheader("Content-Length")
+        if length is not None:
+            handler.send_header("Content-Length", length)
+        else:
+            handler.send_header("Connection", "close")
+            handler.close_connection = True
+        handler.end_headers()
+
+        connected = True
+
+        def send(chunk: bytes):
+            nonlocal connected
+            if connected:
+                try:
+                    handler.wfile.write(chunk)
+                except OSError:
+                    connected = False
+
+        # The last chunk is held back until the response has been stored, so the
+        # client finds it within the cache when requesting it again right away.
+        held = b""
+        try:
+            with atomic_target(path) as temporary, open(temporary, "wb") as output:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                    output.write(chunk)
+                    send(held)
+                    held = chunk
+            metadata = {"url": url, "content_type": response.getheader("Content-Type")}
+            metadata.update(vars(HttpValidators.from_response(response)))
+            with atomic_target(path.with_name(f"{path.name}.json")) as temporary:
+                temporary.write_text(json.dumps(metadata, indent=2))
+            logger.info(f"Stored {url} within package proxy cache")
+        except (OSError, http.client.HTTPException) as ex:
+            logger.warning(f"Failed to proxy {url}: {ex}")
+            handler.close_connection = True
+            return
+        send(held)
+
+    def _handler(self):
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logger.debug(f"Package proxy: {format % args}")
+
+            def do_GET(self):
+                proxy.handle(self)
+
+            def do_HEAD(self):
+                proxy.handle(self)
+
+        return Handler
+
+
+def is_not_modified(headers: Message, metadata: Dict[str, Optional[str]]) -> bool:
+    """
+    Evaluate the conditional request headers of a client against the validators of a cached response.
+    `If-None-Match` takes precedence over `If-Modified-Since`, entity tags are compared weakly.
+    """
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match is not None:
+        etag = metadata.get("etag")
+        if etag is None:
+            return False
+        candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+        return "*" in candidates or etag.removeprefix("W/") in candidates
+    if_modified_since = headers.get("If-Modified-Since")
+    last_modified = metadata.get("last_modified")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+
+def is_package_command(command: str) -> bool:
+    """
+    Whether a command invokes a package manager, directly or by a shell.
+    """
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        return False
+    if words[:2] in [["sh", "-c"], ["/bin/sh", "-c"], ["bash", "-c"], ["/bin/bash", "-c"]] and len(words) > 2:
+        return any(is_package_command(part) for part in re.split(r"[;&|]+", words[2]) if part.strip())
+    return bool(words) and PurePosixPath(words[0]).name in PACKAGE_MANAGERS
+
+
+_package_proxy: Optional[PackageProxy] = None
+_package_proxy_lock = threading.Lock()
+
+
+def get_package_proxy() -> Optional[PackageProxy]:
+    """
+    Return the package proxy of this process, starting it on first use, or `None`, when not enabled.
+    """
+    global _package_proxy
+    settings = get_appsettings()
+    if not settings.package_proxy:
+        return None
+    with _package_proxy_lock:
+        if _package_proxy is None:
+            proxy = PackageProxy(settings.package_proxy_directory, offline=settings.package_proxy_offline)
+            _package_proxy = proxy.start()
+    return _package_proxy
@@ -7,6 +7,8 @@ from abc import abstractmethod
 from furl import furl
 
 from postroj.container import PostrojContainer
+from postroj.overlay import find_layers
+from postroj.rootfs import RootfsInspector
 from postroj.util import find_rootfs, print_header, wait_for_port
 
 logger = logging.getLogger(__name__)
@@ -15,7 +17,10 @@ logger = logging.getLogger(__name__)
 class ProbeBase:
     def __init__(self, container: PostrojContainer):
         self.container = container
-        self.container.rootfs = find_rootfs(self.container.image_path)
+        # Packed images are only accessible while the container is running, see `PostrojContainer.boot`.
+        if self.container.rootfs is None:
+            self.container.rootfs = find_rootfs(self.container.image_path)
+        self.inspector = RootfsInspector(self.container.rootfs, layers=find_layers(self.container.image_path))
 
     @abstractmethod
     def invoke(self):
@@ -26,22 +31,19 @@ class ProbeBase:
 
     @property
     def is_debian(self):
-        return (self.container.rootfs / "etc" / "debian_version").exists()
+        return self.inspector.is_debian
 
     @property
     def is_redhat(self):
-        redhat_release_file = self.container.rootfs / "etc" / "redhat-release"
-        os_release_file = self.container.rootfs / "etc" / "os-release"
-        return redhat_release_file.exists() or 'ID_LIKE="fedora"' in os_release_file.read_text()
+        return self.inspector.is_redhat
 
     @property
     def is_suse(self):
-        os_release_file = self.container.rootfs / "etc" / "os-release"
-        return os_release_file.exists() and "suse" in os_release_file.read_text().lower()
+        return self.inspector.is_suse
 
     @property
     def is_archlinux(self):
-        return (self.container.rootfs / "etc" / "arch-release").exists()
+        return self.inspector.is_archlinux
 
     def check_unit(self, name):
         """
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import hashlib
+import json
+import logging
+import shutil
+import time
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ProvisioningCache:
+    """
+    A cache for provisioning layers, keyed by everything which determines
+    the outcome of provisioning: The digest of the base image, the
+    distribution, the set of packages to install, and the version of the
+    provisioning code.
+
+    Provisioning does not modify the pristine base image. Instead, all
+    changes are written to a layer directory, which is the upper directory
+    of an overlay filesystem stacked over the base image, see `OverlayMount`.
+    Hence, bases and layers can be refreshed and removed independently, and
+    multiple layers, for example using different sets of packages, can
+    share the same base image.
+
+    Layers are stored at ``<path>/<key>``, accompanied by a ``<key>.json``
+    file describing the key components. While provisioning, a layer is
+    staged at ``<path>/<key>.partial``, and only moved into place on success.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    @staticmethod
+    def key(**components) -> str:
+        """
+        Compute the cache key from its components.
+        """
+        return hashlib.sha256(json.dumps(components, sort_keys=True).encode()).hexdigest()
+
+    def layer_path(self, key: str) -> Path:
+        return self.path / key
+
+    def partial_path(self, key: str) -> Path:
+        return self.path / f"{key}.partial"
+
+    def work_path(self, key: str) -> Path:
+        """
+        The work directory of the overlay filesystem, which needs to be on the same filesystem as the layer.
+        """
+        return self.path / f"{key}.work"
+
+    def mount_path(self, key: str) -> Path:
+        return self.path / f"{key}.mnt"
+
+    def has(self, key: str) -> bool:
+        return self.layer_path(key).is_dir()
+
+    def begin(self, key: str) -> Path:
+        """
+        Start staging a layer, and return its directory.
+        """
+        self.abort(key)
+        partial = self.partial_path(key)
+        partial.mkdir(parents=True)
+        return partial
+
+    def commit(self, key: str, **components) -> Path:
+        """
+        Move a staged layer into place.
+        """
+        layer = self.layer_path(key)
+        shutil.rmtree(layer, ignore_errors=True)
+        self.partial_path(key).rename(layer)
+        shutil.rmtree(self.work_path(key), ignore_errors=True)
+        metadata = {"key": key, "components": components, "created": time.time()}
+        layer.with_suffix(".json").write_text(json.dumps(metadata, indent=2))
+        return layer
+
+    def abort(self, key: str):
+        """
+        Discard a staged layer.
+        """
+        shutil.rmtree(self.partial_path(key), ignore_errors=True)
+        shutil.rmtree(self.work_path(key), ignore_errors=True)
+
+    def metadata(self, key: str) -> Optional[dict]:
+        try:
+            return json.loads(self.layer_path(key).with_suffix(".json").read_text())
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import dataclasses
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from postroj.download import CHECKSUM_SUFFIX
+from postroj.index import ImageIndex
+from postroj.lock import is_locked
+from postroj.model import ConfigurationOptions
+from postroj.oci.store import BlobStore
+from postroj.overlay import LAYER_SUFFIX
+from postroj.packing import PACK_FORMATS, loop_backing_files
+from postroj.settings import get_appsettings
+from postroj.store import VERSIONS_SUFFIX, ImageStore
+
+logger = logging.getLogger(__name__)
+
+
+# Suffixes of the artefacts belonging to an image within the archive directory, see `ImageProvider`.
+IMAGE_SUFFIXES = [".img", VERSIONS_SUFFIX, ".oci", ".snapshots", ".source.json", LAYER_SUFFIX]
+IMAGE_SUFFIXES += [f".{format}" for format in PACK_FORMATS]
+
+# Suffixes of temporary artefacts, left behind by interrupted operations.
+TEMPORARY_SUFFIXES = [".partial", ".previous", ".work", ".mnt", ".part", ".part.json", ".tmp"]
+
+# Temporary artefacts are only removed when they have not been touched for this long,
+# in order not to interfere with operations in progress.
+TEMPORARY_MAX_AGE = 24 * 60 * 60
+
+
+@dataclasses.dataclass
+class PruneCandidate:
+    """
+    A set of paths which can be removed together.
+    """
+
+    name: str
+    kind: str
+    paths: List[Path]
+    size: int = 0
+    last_used: float = 0
+
+
+@dataclasses.dataclass
+class PruneReport:
+    usage_before: int = 0
+    usage_after: int = 0
+    evicted: List[PruneCandidate] = dataclasses.field(default_factory=list)
+
+    @property
+    def reclaimed(self) -> int:
+        return self.usage_before - self.usage_after
+
+    def to_dict(self) -> dict:
+        return {
+            "usage_before": self.usage_before,
+            "usage_after": self.usage_after,
+            "reclaimed": self.reclaimed,
+            "evicted": [
+                {
+                    "name": candidate.name,
+                    "kind": candidate.kind,
+                    "size": candidate.size,
+                    "last_used": candidate.last_used,
+                    "paths": [str(path) for path in candidate.paths],
+                }
+                for candidate in self.evicted
+            ],
+        }
+
+
+class Pruner:
+    """
+    Reclaim disk space within the archive and cache directories.
+
+    Candidates for eviction are images not activated within the image
+    directory, previous versions of activated images, provisioning layers
+    not used by activated images, downloaded archives, and temporary
+    artefacts left behind by interrupted operations.
+    Afterwards, OCI blobs not referenced by any image are removed.
+
+    Images activated within the image directory, and everything used by
+    running containers, will never be evicted.
+
+    Without a budget, all candidates are evicted. With a budget, candidates
+    are evicted in least recently used order, until the disk usage fits into
+    the budget. The time of last use is taken from the image index, where
+    `racker run` records it, and from the file modification times otherwise.
+    """
+
+    def __init__(self, settings: Optional[ConfigurationOptions] = None):
+        self.settings = settings or get_appsettings()
+        self.index = ImageIndex(self.settings.index_path)
+        self.blob_store = BlobStore(self.settings.blob_directory)
+
+    @property
+    def roots(self) -> List[Path]:
+        return [self.settings.archive_directory, self.settings.cache_directory]
+
+    def prune(self, budget: Optional[int] = None, dry_run: bool = False) -> PruneReport:
+        report = PruneReport(usage_before=self.usage())
+        usage = report.usage_before
+        candidates = sorted(self.candidates(), key=lambda candidate: candidate.last_used)
+        for candidate in candidates:
+            if budget is not None and usage <= budget:
+                break
+            logger.info(f"Evicting {candidate.kind} {candidate.name}, {candidate.size} bytes")
+            if not dry_run:
+                self.evict(candidate)
+            report.evicted.append(candidate)
+            usage -= candidate.size
+
+        if dry_run:
+            report.usage_after = usage
+        else:
+            self.blob_store.collect_garbage()
+            report.usage_after = self.usage()
+        logger.info(f"Reclaimed {report.reclaimed} bytes, disk usage is {report.usage_after} bytes")
+        return report
+
+    def evict(self, candidate: PruneCandidate):
+        for path in candidate.paths:
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
+        if candidate.kind == "image":
+            for record in self.index.all():
+                if record.path and Path(record.path) in candidate.paths:
+                    self.index.remove(record.name)
+
+    def candidates(self) -> List[PruneCandidate]:
+        protected = self.protected_paths()
+
+        def is_protected(paths: Iterable[Path]) -> bool:
+            for path in paths:
+                # Do not follow links at the final path component, like the provisioning layer link of an image.
+                path = path.parent.resolve() / path.name
+                for other in protected:
+                    if other == path or path in other.parents:
+                        return True
+            return False
+
+        candidates = []
+        for candidate in self.image_candidates():
+            if not is_protected(candidate.paths):
+                candidates.append(candidate)
+            else:
+                versions = self.version_candidates(self.settings.archive_directory / f"{candidate.name}.img")
+                candidates += [version for version in versions if not is_protected(version.paths)]
+        for candidate in self.layer_candidates() + self.download_candidates():
+            if not is_protected(candidate.paths):
+                candidates.append(candidate)
+        for candidate in self.temporary_candidates():
+            if time.time() - candidate.last_used > TEMPORARY_MAX_AGE and not is_protected(candidate.paths):
+                candidates.append(candidate)
+        for candidate in candidates:
+            candidate.size = disk_usage(candidate.paths, shared=True)
+        return candidates
+
+    def protected_paths(self) -> Set[Path]:
+        """
+        Return paths of activated images, their provisioning layers, and everything used by running containers.
+        """
+        protected = set(paths_in_use())
+        image_directory = self.settings.image_directory
+        if image_directory.exists():
+            for link in image_directory.iterdir():
+                if link.is_symlink() and link.exists():
+                    image = link.resolve()
+                    protected.add(image)
+                    layer = image.with_suffix(LAYER_SUFFIX)
+                    if layer.exists():
+                        protected.add(layer.resolve())
+        return protected
+
+    def image_candidates(self) -> List[PruneCandidate]:
+        archive_directory = self.settings.archive_directory
+        if not archive_directory.exists():
+            return []
+        groups: Dict[str, List[Path]] = {}
+        for path in archive_directory.iterdir():
+            for suffix in IMAGE_SUFFIXES:
+                if path.name.endswith(suffix):
+                    groups.setdefault(path.name[: -len(suffix)], []).append(path)
+                    break
+        last_used = {}
+        for record in self.index.all():
+            if record.path:
+                last_used[Path(record.path)] = record.last_used or record.updated or record.created or 0
+        candidates = []
+        for name, paths in sorted(groups.items()):
+            # Skip images currently being acquired.
+            if is_locked(archive_directory / f"{name}.lock"):
+                continue
+            image = archive_directory / f"{name}.img"
+            used = last_used.get(image) or max(modification_time(path) for path in paths)
+            candidates.append(PruneCandidate(name=name, kind="image", paths=sorted(paths), last_used=used))
+        return candidates
+
+    def version_candidates(self, current_link: Path) -> List[PruneCandidate]:
+        """
+        Return versions of an image other than the current one, see `ImageStore`.
+        """
+        store = ImageStore(current_link)
+        current = store.current()
+        candidates = []
+        for version in store.versions():
+            if version == current:
+                continue
+            paths = [version, version.with_suffix(LAYER_SUFFIX)] + [
+                version.with_suffix(f".{format}") for format in PACK_FORMATS
+            ]
+            name = f"{current_link.stem}/{version.name}"
+            candidates.append(
+                PruneCandidate(name=name, kind="version", paths=paths, last_used=modification_time(version))
+            )
+        return candidates
+
+    def layer_candidates(self) -> List[PruneCandidate]:
+        directory = self.settings.provisioned_directory
+        if not directory.exists():
+            return []
+        candidates = []
+        for layer in sorted(directory.iterdir()):
+            if layer.is_dir() and not has_suffix(layer, TEMPORARY_SUFFIXES):
+                paths = [layer, layer.with_suffix(".json")]
+                candidates.append(
+                    PruneCandidate(name=layer.name, kind="layer", paths=paths, last_used=modification_time(layer))
+                )
+        return candidates
+
+    def download_candidates(self) -> List[PruneCandidate]:
+        directory = self.settings.download_directory
+        if not directory.exists():
+            return []
+        candidates = []
+        for path in sorted(directory.iterdir()):
+            if path.is_file() and not has_suffix(path, TEMPORARY_SUFFIXES + [CHECKSUM_SUFFIX]):
+                info = path.stat()
+                candidates.append(
+                    PruneCandidate(
+                        name=path.name,
+                        kind="download",
+                        paths=[path, path.with_name(path.name + CHECKSUM_SUFFIX)],
+                        last_used=max(info.st_atime, info.st_mtime),
+                    )
+                )
+        return candidates
+
+    def temporary_candidates(self) -> List[PruneCandidate]:
+        directories = [
+            self.settings.archive_directory,
+            self.settings.provisioned_directory,
+            self.settings.download_directory,
+        ]
+        candidates = []
+        for directory in directories:
+            if not directory.exists():
+                continue
+            for path in sorted(directory.iterdir()):
+                if has_suffix(path, TEMPORARY_SUFFIXES):
+                    used = modification_time(path)
+                    candidates.append(PruneCandidate(name=path.name, kind="temporary", paths=[path], last_used=used))
+        return candidates
+
+    def usage(self) -> int:
+        return disk_usage(self.roots)
+
+
+def disk_usage(paths: Iterable[Path], shared: bool = False) -> int:
+    """
+    Compute the disk usage of files and directories, counting hardlinked files once.
+
+    With `shared`, files also linked from elsewhere are accounted proportionally, in order to
+    estimate the amount of disk space reclaimed when removing the paths.
+    """
+    seen: Set[tuple] = set()
+    total = 0.0
+
+    def account(path: str):
+        nonlocal total
+        try:
+            info = os.lstat(path)
+        except OSError:
+            return
+        inode = (info.st_dev, info.st_ino)
+        if inode in seen:
+            return
+        seen.add(inode)
+        size = info.st_blocks * 512
+        total += size / info.st_nlink if shared and info.st_nlink > 1 else size
+
+    for path in paths:
+        path = str(path)
+        account(path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            for directory, dirnames, filenames in os.walk(path):
+                for name in dirnames + filenames:
+                    account(os.path.join(directory, name))
+    return int(total)
+
+
+def paths_in_use() -> Set[Path]:
+    """
+    Return root directories of running containers, directories stacked by overlay filesystems,
+    and packed images attached to loop devices.
+
+    They are determined from the command lines of `systemd-nspawn` processes,
+    from the mounted overlay filesystems, see `OverlayMount`, and from the
+    loop devices, see `LoopMount`. Mount points of overlay filesystems are
+    included as well.
+    """
+    paths = set()
+    for cmdline in Path("/proc").glob("[0-9]*/cmdline"):
+        try:
+            arguments = cmdline.read_bytes().decode(errors="replace").split("\0")
+        except OSError:
+            continue
+        if not arguments or os.path.basename(arguments[0]) != "systemd-nspawn":
+            continue
+        for number, argument in enumerate(arguments):
+            if argument.startswith("--directory="):
+                paths.add(argument[len("--directory=") :])
+            elif argument in ["-D", "--directory"] and number + 1 < len(arguments):
+                paths.add(arguments[number + 1])
+    try:
+        mounts = Path("/proc/self/mounts").read_text().splitlines()
+    except OSError:
+        mounts = []
+    for mount in mounts:
+        fields = mount.split()
+        if len(fields) < 4 or fields[2] != "overlay":
+            continue
+        paths.add(fields[1])
+        for option in fields[3].split(","):
+            key, _, value = option.partition("=")
+            if key in ["lowerdir", "upperdir"]:
+                paths.update(value.split(":"))
+    paths.update(str(path) for path in loop_backing_files())
+    return {Path(path).resolve() for path in paths if path}
+
+
+def modification_time(path: Path) -> float:
+    try:
+        return path.lstat().st_mtime
+    except OSError:
+        return 0
+
+
+def has_suffix(path: Path, suffixes: List[str]) -> bool:
+    return any(path.name.endswith(suffix) for suffix in suffixes)
+
+
+def parse_size(value: str) -> int:
+    """
+    Parse a size like `500M` or `20G` into bytes. Suffixes are binary multiples.
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    number = value.strip().upper().removesuffix("B").removesuffix("I")
+    factor = 1
+    if number[-1:] in units:
+        factor = units[number[-1]]
+        number = number[:-1]
+    try:
+        return int(float(number) * factor)
+    except ValueError:
+        raise ValueError(f"Invalid size: {value}")
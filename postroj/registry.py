@@ -364,6 +364,19 @@ def find_distribution(image_label: str) -> LinuxDistribution:
     raise ValueError(f"Unknown image label: {image_label}")
 
 
+def resolve_distribution(image_label: str) -> LinuxDistribution:
+    """
+    Resolve a curated image label like `debian-bookworm`, or otherwise,
+    a container image name like `debian:bookworm-slim`.
+    """
+    try:
+        return find_distribution(image_label)
+    except ValueError:
+        from racker.babelfish import DynamicDistribution
+
+        return DynamicDistribution.from_image(image_label)
+
+
 def generate_images():
     for distribution in generate_curated_distributions():
         yield distribution.fullname
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import errno
+import logging
+import os
+import stat
+from functools import cached_property
+from pathlib import Path, PurePosixPath
+from typing import Dict, List, Optional, Union
+
+from postroj.util import resolve_in_root
+
+logger = logging.getLogger(__name__)
+
+
+# Locations of the `os-release` file, in order of precedence.
+# https://www.freedesktop.org/software/systemd/man/os-release.html
+OS_RELEASE_FILES = ["/etc/os-release", "/usr/lib/os-release"]
+
+# Init programs, in the order `systemd-nspawn --boot` would probe them.
+INIT_PROGRAMS = ["/usr/lib/systemd/systemd", "/lib/systemd/systemd", "/sbin/init"]
+
+# Package managers, in order of preference.
+PACKAGE_MANAGERS = ["apt-get", "dnf", "microdnf", "yum", "zypper", "pacman", "apk"]
+
+# Directories searched for programs, like the default `PATH` of `systemd-nspawn`.
+PROGRAM_DIRECTORIES = ["/usr/local/sbin", "/usr/local/bin", "/usr/sbin", "/usr/bin", "/sbin", "/bin"]
+
+
+class RootfsInspector:
+    """
+    Inspect an OS root directory in-process, without spawning a container.
+
+    Paths are resolved within the root directory like `chroot` would do, so
+    absolute symlinks, as in ``/etc/os-release -> /usr/lib/os-release``, are
+    followed correctly, and will never escape it, see `resolve_in_root`.
+
+    When `layers` are given, they are stacked over the root directory, like
+    the layers of an overlay filesystem, see `resolve_in_layers`.
+
+    Results are memoized per inspector. After changing the root directory,
+    for example by installing packages, use a new inspector.
+    """
+
+    def __init__(self, root: Union[Path, str], layers: Optional[List[Path]] = None):
+        self.root = Path(root)
+        # Layers stacked over the root directory, topmost first.
+        self.layers = [Path(layer) for layer in layers or []]
+        self._programs: Dict[str, Optional[str]] = {}
+
+    def resolve(self, path: Union[Path, str]) -> Path:
+        if self.layers:
+            return resolve_in_layers(self.layers + [self.root], path)
+        return resolve_in_root(self.root, path)
+
+    def exists(self, path: Union[Path, str]) -> bool:
+        try:
+            return self.resolve(path).exists()
+        except OSError:
+            return False
+
+    def is_executable(self, path: Union[Path, str]) -> bool:
+        try:
+            resolved = self.resolve(path)
+        except OSError:
+            return False
+        return resolved.is_file() and os.access(resolved, os.X_OK)
+
+    def read_text(self, path: Union[Path, str]) -> str:
+        return self.resolve(path).read_text()
+
+    def read_os_release(self) -> str:
+        """
+        Read the `os-release` file, falling back to ``/usr/lib/os-release``
+        when ``/etc/os-release`` is missing.
+        """
+        for path in OS_RELEASE_FILES:
+            try:
+                return self.read_text(path)
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError(errno.ENOENT, "No such file or directory", str(self.root / "etc" / "os-release"))
+
+    @cached_property
+    def os_release_text(self) -> str:
+        return self.read_os_release()
+
+    @cached_property
+    def os_release(self) -> Dict[str, str]:
+        return parse_os_release(self.os_release_text)
+
+    @property
+    def id(self) -> str:
+        return self.os_release.get("ID", "linux")
+
+    @property
+    def id_like(self) -> List[str]:
+        return self.os_release.get("ID_LIKE", "").split()
+
+    @property
+    def version_id(self) -> Optional[str]:
+        return self.os_release.get("VERSION_ID")
+
+    @property
+    def ids(self) -> List[str]:
+        """
+        Return the operating system identifier, followed by the identifiers of related operating systems.
+        """
+        return [self.id] + self.id_like
+
+    @cached_property
+    def has_os_tree(self) -> bool:
+        """
+        `systemd-nspawn` refuses to spawn containers from directories without an ``/usr`` directory.
+        """
+        try:
+            return self.resolve("/usr").is_dir()
+        except OSError:
+            return False
+
+    @cached_property
+    def init_program(self) -> Optional[str]:
+        """
+        Return the path to the init program, or `None`.
+
+        When `systemd-nspawn` would encounter an OS root directory without an appropriate program, it would croak like:
+        execv(/usr/lib/systemd/systemd, /lib/systemd/systemd, /sbin/init) failed: No such file or directory
+        """
+        for candidate in INIT_PROGRAMS:
+            if self.exists(candidate):
+                return candidate
+        return None
+
+    @property
+    def has_systemd(self) -> bool:
+        return self.init_program is not None
+
+    def find_program(self, name: str) -> Optional[str]:
+        """
+        Find a program like `command -v` would do within the container, and return its path, or `None`.
+        """
+        if name not in self._programs:
+            self._programs[name] = None
+            for directory in PROGRAM_DIRECTORIES:
+                candidate = f"{directory}/{name}"
+                if self.is_executable(candidate):
+                    self._programs[name] = candidate
+                    break
+        return self._programs[name]
+
+    @cached_property
+    def package_manager(self) -> Optional[str]:
+        """
+        Return the name of the package manager, or `None`.
+        """
+        for name in PACKAGE_MANAGERS:
+            if self.find_program(name):
+                return name
+        return None
+
+    def has_os_release(self) -> bool:
+        try:
+            return bool(self.os_release_text)
+        except OSError:
+            return False
+
+    @property
+    def is_debian(self) -> bool:
+        return self.exists("/etc/debian_version") or (self.has_os_release() and "debian" in self.ids)
+
+    @property
+    def is_redhat(self) -> bool:
+        if self.exists("/etc/redhat-release"):
+            return True
+        return self.has_os_release() and any(name in self.ids for name in ["fedora", "rhel", "centos"])
+
+    @property
+    def is_suse(self) -> bool:
+        return self.has_os_release() and any("suse" in name for name in self.ids)
+
+    @property
+    def is_archlinux(self) -> bool:
+        return self.exists("/etc/arch-release") or (self.has_os_release() and "arch" in self.ids)
+
+
+def resolve_in_layers(roots: List[Path], path: Union[Path, str], follow_symlinks: bool = True) -> Path:
+    """
+    Resolve a path within a stack of directories, topmost first, like within
+    the merged directory of an overlay filesystem, see `resolve_in_root`.
+
+    Return the path within the topmost directory providing it. When no
+    directory provides it, or it has been removed by a whiteout, raise
+    `FileNotFoundError`.
+    """
+    pending = list(PurePosixPath("/", path).parts[1:])
+    resolved: List[str] = []
+    hops = 0
+    while pending:
+        part = pending.pop(0)
+        if part in ["", "."]:
+            continue
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+        candidate = lookup_in_layers(roots, resolved + [part])
+        if candidate is not None and (follow_symlinks or pending) and candidate.is_symlink():
+            hops += 1
+            if hops > 40:
+                raise OSError(errno.ELOOP, "Too many levels of symbolic links", str(path))
+            target = os.readlink(candidate)
+            if target.startswith("/"):
+                resolved = []
+            pending = target.split("/") + pending
+            continue
+        resolved.append(part)
+    found = lookup_in_layers(roots, resolved)
+    if found is None:
+        raise FileNotFoundError(errno.ENOENT, "No such file or directory", str(path))
+    return found
+
+
+def lookup_in_layers(roots: List[Path], parts: List[str]) -> Optional[Path]:
+    """
+    Find an entry within a stack of directories, topmost first, honoring
+    whiteouts and opaque directories of overlay filesystems.
+    """
+    for root in roots:
+        for depth in range(1, len(parts) + 1):
+            candidate = root.joinpath(*parts[:depth])
+            if is_whiteout(candidate):
+                return None
+            if not os.path.lexists(candidate):
+                break
+            if depth == len(parts):
+                return candidate
+            if is_opaque(candidate):
+                return None
+        else:
+            return root
+    return None
+
+
+def is_whiteout(path: Path) -> bool:
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISCHR(info.st_mode) and info.st_rdev == 0
+
+
+def is_opaque(path: Path) -> bool:
+    try:
+        return os.getxattr(path, "trusted.overlay.opaque", follow_symlinks=False) == b"y"
+    except OSError:
+        return False
+
+
+def parse_os_release(content: str) -> Dict[str, str]:
+    """
+    Parse the content of an `/etc/os-release` file.
+
+    - https://www.freedesktop.org/software/systemd/man/os-release.html
+    """
+    data = {}
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        key, _, value = line.partition("=")
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+            value = value[1:-1]
+        data[key.strip()] = value
+    return data
@@ -2,10 +2,12 @@
 # (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
 import dataclasses
 import logging
+import os
 import sys
 import time
 from contextlib import redirect_stdout
 from copy import copy
+from pathlib import Path
 from typing import Dict, List, Type, Union
 
 import click
@@ -13,8 +15,11 @@ import click
 from postroj.container import PostrojContainer
 from postroj.image import ImageProvider
 from postroj.model import LinuxDistribution
+from postroj.packing import PACK_FORMATS
 from postroj.probe import ProbeBase
-from postroj.registry import CURATED_OPERATING_SYSTEMS, CuratedOperatingSystem
+from postroj.prune import disk_usage
+from postroj.registry import CURATED_OPERATING_SYSTEMS, CuratedOperatingSystem, find_distribution
+from postroj.settings import get_appsettings
 from postroj.util import to_json
 
 logger = logging.getLogger(__name__)
@@ -61,6 +66,92 @@ def selftest_pkgprobe():
         sys.exit(5)
 
 
+@click.command()
+@click.option("--image", type=str, required=True, help="Name of the image to benchmark, like `debian-bullseye`")
+@click.option(
+    "--format",
+    "formats",
+    type=click.Choice(list(PACK_FORMATS)),
+    multiple=True,
+    default=["squashfs"],
+    show_default=True,
+    help="Packed image formats to compare against the directory format",
+)
+@click.option("--rounds", type=click.IntRange(min=1), default=3, show_default=True, help="Number of boots per format")
+def selftest_pack_benchmark(image: str, formats: List[str], rounds: int):
+    """
+    Compare boot latency and disk usage of packed images against the directory format.
+
+    - Acquire the image, and pack it into each format.
+    - Measure disk usage and number of inodes per format.
+    - Spawn a container multiple times per format, and measure the time until it has booted completely.
+    """
+    results = [benchmark_format(image, format, rounds=rounds) for format in [None] + list(formats)]
+    print(to_json(results))
+
+
+@dataclasses.dataclass
+class BenchmarkResult:
+    """
+    Capture measurements about an image format.
+    """
+
+    format: str
+    disk_usage: int
+    inodes: int
+    boot_seconds: List[float] = dataclasses.field(default_factory=list)
+
+    @property
+    def boot_seconds_median(self) -> float:
+        return sorted(self.boot_seconds)[len(self.boot_seconds) // 2]
+
+
+def benchmark_format(image: str, format: Union[str, None], rounds: int) -> BenchmarkResult:
+    """
+    Measure disk usage and boot latency of an image in the given format, or as a directory.
+    """
+    settings = get_appsettings()
+    pack_format = settings.pack_format
+    settings.pack_format = format
+    try:
+        ip = ImageProvider(distribution=find_distribution(image))
+        ip.activate_image()
+    finally:
+        settings.pack_format = pack_format
+
+    if format is None:
+        paths = [ip.image_staging.resolve()] + ([ip.layer_path.resolve()] if ip.layer_path.exists() else [])
+    else:
+        paths = [ip.packed_path(format)]
+    result = BenchmarkResult(format=format or "directory", disk_usage=disk_usage(paths), inodes=count_inodes(paths))
+
+    for _ in range(rounds):
+        start = time.monotonic()
+        with PostrojContainer(image_path=ip.image) as pc:
+            with redirect_stdout(sys.stderr):
+                pc.boot()
+                pc.wait()
+            result.boot_seconds.append(time.monotonic() - start)
+    logger.info(
+        f"Format {result.format}: {result.disk_usage} bytes, {result.inodes} inodes, "
+        f"booted in {result.boot_seconds_median:.2f}s"
+    )
+    return result
+
+
+def count_inodes(paths: List[Path]) -> int:
+    inodes = set()
+    for path in paths:
+        for directory, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                info = os.lstat(os.path.join(directory, name))
+                inodes.add((info.st_dev, info.st_ino))
+        if not Path(path).is_dir():
+            info = os.lstat(path)
+            inodes.add((info.st_dev, info.st_ino))
+    return len(inodes)
+
+
 class HostinfoProbe(ProbeBase):
     """
     A very basic probe which just invokes `hostnamectl` on a container.
@@ -104,7 +195,7 @@ class ApacheProbe(ProbeBase):
             self.run(f"/usr/bin/apt-get install --yes {package_name}")
         elif self.is_redhat:
             package_name = unit_name = "httpd"
-            self.run(f"/usr/bin/yum install -y {package_name}")
+            self.run(f"/usr/bin/yum install -y --setopt=keepcache=1 {package_name}")
         elif self.is_archlinux:
             package_name = "apache"
             unit_name = "httpd"
@@ -213,3 +304,4 @@ def print_report(results):
 
 selftest_main.add_command(cmd=selftest_pkgprobe, name="pkgprobe")
 selftest_main.add_command(cmd=selftest_hostnamectl, name="hostnamectl")
+selftest_main.add_command(cmd=selftest_pack_benchmark, name="pack-benchmark")
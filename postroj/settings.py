@@ -8,6 +8,7 @@ appsettings = ConfigurationOptions(
     archive_directory=Path("/var/lib/postroj/archive"),
     image_directory=Path("/var/lib/postroj/images"),
     cache_directory=Path("/var/cache/postroj"),
+    runtime_directory=Path("/run/postroj"),
 )
 
 
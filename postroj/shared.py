@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import logging
+from pathlib import Path
+from typing import Optional
+
+from postroj.store import ImageStore
+from postroj.util import is_dir_empty
+
+logger = logging.getLogger(__name__)
+
+
+class SharedArchive:
+    """
+    An archive directory shared by multiple hosts, for example on NFS or a
+    cluster filesystem, mounted read-only on runner hosts.
+
+    A build host populates it like its own archive, by pulling images with
+    ``archive_directory`` pointing to it. Runner hosts activate the images
+    from there, instead of acquiring private copies. Nothing is written to
+    the shared archive by them: Locks, activation links, overlay mounts, and
+    caches stay within the writable directories of each host.
+
+    Version links and provisioning layer links within the archive are
+    relative, see `swap_link`, so the archive can be mounted at any path.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def store(self, name: str) -> ImageStore:
+        return ImageStore(self.path / f"{name}.img")
+
+    def current(self, name: str, pack_format: Optional[str] = None) -> Optional[Path]:
+        """
+        Return path to the current version of an image, or `None`, when the archive does not have it.
+
+        When a pack format is requested, and the version has been packed, return the packed image.
+        """
+        version = self.store(name).current()
+        if version is None or is_dir_empty(version):
+            return None
+        if pack_format:
+            packed = version.with_suffix(f".{pack_format}")
+            if packed.is_file():
+                return packed
+        return version
+
+    def contains(self, path: Path) -> bool:
+        """
+        Whether a path is located within the shared archive.
+        """
+        path = Path(path).resolve()
+        root = self.path.resolve()
+        return path == root or root in path.parents
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import datetime
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from postroj.overlay import LAYER_SUFFIX
+from postroj.packing import PACK_FORMATS
+
+logger = logging.getLogger(__name__)
+
+
+# Suffix of the directory holding all versions of an image, next to its current version link.
+VERSIONS_SUFFIX = ".versions"
+
+# Prefix of directories a new version is being acquired into.
+INCOMING_PREFIX = ".incoming-"
+
+# Leftovers of interrupted acquisitions are only removed when they have not been touched for this long.
+INCOMING_MAX_AGE = 24 * 60 * 60
+
+
+class ImageStore:
+    """
+    Manage versions of an image within the archive directory.
+
+    Each acquisition of an image goes into a new version directory at
+    ``archive/<name>.versions/<version>``, keyed by the time of acquisition
+    and the digest of the acquired artefact. Versions are never modified
+    after they have been committed. The current version is designated by
+    the ``archive/<name>.img`` link.
+
+    Activation switches links atomically, by renaming a new link over the
+    old one, see `swap_link`. Containers already running keep using the
+    version they have been booted from, so images can be updated under load,
+    and a bad version can be rolled back instantly.
+
+    Provisioning layers and packed images belong to a version, and are
+    stored next to it, like ``<version>.layer``, or ``<version>.squashfs``.
+    """
+
+    def __init__(self, current_link: Path):
+        self.current_link = Path(current_link)
+        self.path = self.current_link.with_suffix(VERSIONS_SUFFIX)
+
+    def incoming_path(self) -> Path:
+        """
+        Return path to a new directory for acquiring a version into.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        return self.path / f"{INCOMING_PREFIX}{os.getpid()}-{time.time_ns()}"
+
+    def commit(self, incoming: Path, digest: Optional[str] = None) -> Path:
+        """
+        Move an acquired version into place, and return its path.
+        """
+        version = datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        if digest:
+            version += "-" + digest.split(":")[-1][:12]
+        path = self.path / version
+        incoming.rename(path)
+        logger.info(f"Committed image version {path}")
+        return path
+
+    def discard(self, incoming: Path):
+        shutil.rmtree(incoming, ignore_errors=True)
+
+    def recover(self, pid: int):
+        """
+        Remove leftovers of an acquisition by a process which crashed.
+        """
+        if not self.path.is_dir():
+            return
+        for path in self.path.glob(f"{INCOMING_PREFIX}{pid}-*"):
+            logger.info(f"Removing leftover of crashed process {pid}: {path}")
+            shutil.rmtree(path, ignore_errors=True)
+
+    def current(self) -> Optional[Path]:
+        """
+        Return path to the current version, or `None`.
+        """
+        if self.current_link.is_symlink() and self.current_link.exists():
+            return self.current_link.resolve()
+        return None
+
+    def set_current(self, version: Path):
+        swap_link(self.current_link, version, relative=True)
+        logger.info(f"Current version of {self.current_link} is {version.name}")
+
+    def versions(self) -> List[Path]:
+        """
+        Return all committed versions, oldest first.
+        """
+        if not self.path.is_dir():
+            return []
+        return sorted(
+            path for path in self.path.iterdir() if path.is_dir() and not path.name.startswith(".") and not path.suffix
+        )
+
+    def previous(self) -> Optional[Path]:
+        """
+        Return the version before the current one, or `None`.
+        """
+        current = self.current()
+        versions = self.versions()
+        if current not in versions:
+            return None
+        position = versions.index(current)
+        return versions[position - 1] if position > 0 else None
+
+    def rollback(self) -> Path:
+        """
+        Make the version before the current one the current version.
+        """
+        previous = self.previous()
+        if previous is None:
+            raise FileNotFoundError(f"No previous version to roll back to at {self.path}")
+        self.set_current(previous)
+        return previous
+
+    def migrate(self):
+        """
+        Convert an image directory of the former layout, without versions, into a version.
+        """
+        legacy = self.current_link
+        if not legacy.is_dir() or legacy.is_symlink():
+            return
+        incoming = self.incoming_path()
+        legacy.rename(incoming)
+        version = self.commit(incoming)
+        layer = legacy.with_suffix(LAYER_SUFFIX)
+        if layer.is_symlink():
+            layer.rename(version.with_suffix(LAYER_SUFFIX))
+        for format in PACK_FORMATS:
+            legacy.with_suffix(f".{format}").unlink(missing_ok=True)
+        self.set_current(version)
+        logger.info(f"Migrated image directory {legacy} to version {version}")
+
+    def retire(self, keep: int = 1, protected: Iterable[Path] = ()) -> List[Path]:
+        """
+        Remove versions older than the current one, except the `keep` most recent ones,
+        and all versions still referenced by activated images, or running containers.
+
+        Return the paths of the removed versions.
+        """
+        in_use = {Path(path).resolve() for path in protected}
+        in_use.update(referenced_paths())
+        current = self.current()
+        versions = self.versions()
+        if current in versions:
+            versions = versions[: versions.index(current)]
+        candidates = versions[: max(0, len(versions) - keep)]
+
+        retired = []
+        for version in candidates:
+            if any(other == version or version in other.parents for other in in_use):
+                logger.info(f"Keeping version {version}, it is still in use")
+                continue
+            logger.info(f"Retiring version {version}")
+            remove_version(version)
+            retired.append(version)
+
+        # Remove leftovers of interrupted acquisitions.
+        if self.path.is_dir():
+            for path in self.path.glob(f"{INCOMING_PREFIX}*"):
+                if time.time() - path.lstat().st_mtime > INCOMING_MAX_AGE:
+                    shutil.rmtree(path, ignore_errors=True)
+        return retired
+
+
+def swap_link(link: Path, target: Path, relative: bool = False):
+    """
+    Point a symbolic link to a new target atomically.
+
+    The new link is created next to the old one, and renamed over it, so
+    the link is always present, pointing either to the old or the new target.
+
+    With `relative`, the link refers to its target relative to its own location,
+    so it stays valid when the archive is mounted elsewhere, see `SharedArchive`.
+    """
+    temporary = link.with_name(f".{link.name}.{os.getpid()}.tmp")
+    temporary.unlink(missing_ok=True)
+    reference = Path(os.path.relpath(target, link.parent)) if relative else target
+    temporary.symlink_to(reference, target_is_directory=target.is_dir())
+    os.replace(temporary, link)
+
+
+def remove_version(version: Path):
+    """
+    Remove a version, its provisioning layer link, and its packed images.
+    """
+    shutil.rmtree(version, ignore_errors=True)
+    version.with_suffix(LAYER_SUFFIX).unlink(missing_ok=True)
+    for format in PACK_FORMATS:
+        version.with_suffix(f".{format}").unlink(missing_ok=True)
+
+
+def referenced_paths() -> List[Path]:
+    """
+    Return paths used by running containers, and targets of the links within the image directory.
+    """
+    from postroj.prune import paths_in_use
+    from postroj.settings import get_appsettings
+
+    paths = list(paths_in_use())
+    image_directory = get_appsettings().image_directory
+    if image_directory.is_dir():
+        for link in image_directory.iterdir():
+            if link.is_symlink() and link.exists():
+                paths.append(link.resolve())
+    return paths
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Generator, Iterator, Optional
+from urllib.parse import urlsplit
+
+from postroj.bundle import (
+    BUNDLE_FORMAT,
+    BUNDLE_VERSION,
+    EXTRACT_OPTIONS,
+    LAYER_DIRECTORY,
+    METADATA_FILE,
+    BundleStats,
+    BundleWriter,
+)
+from postroj.download import ArchiveExtractor, Downloader, hash_chunks, read_chunks
+from postroj.exceptions import DigestMismatch, DownloadError, InvalidPhysicalImage
+from postroj.httpclient import HttpClient
+from postroj.provcache import ProvisioningCache
+
+logger = logging.getLogger(__name__)
+
+
+# Suffixes of the files making up an entry of a substituter.
+BUNDLE_SUFFIX = ".bundle"
+INFO_SUFFIX = ".json"
+
+
+class Substituter:
+    """
+    A binary cache for provisioning layers, shared by multiple hosts, in the
+    spirit of Nix substituters. Before provisioning an image, the substituter
+    is consulted, and a ready-made provisioning layer is used when available.
+    Hosts which provisioned an image themselves can publish the layer there.
+
+    Entries are keyed like the provisioning cache, by the digest of the base
+    image, and everything determining the outcome of the provisioning recipe,
+    see `ProvisioningCache.key`. Each entry consists of a layer-only image
+    bundle at ``<key>.bundle``, see `BundleWriter`, and an info document at
+    ``<key>.json``, recording the digest of the bundle. The info document is
+    written last, so only complete entries are visible. Bundles are verified
+    against their digest while extracting them, and discarded on mismatch.
+
+    The location is either a directory, which may be on a network filesystem,
+    or an HTTP endpoint. Publishing to an HTTP endpoint uses `PUT` requests.
+    """
+
+    def __init__(self, location: str, compression: Optional[str] = "zstd"):
+        self.location = location
+        self.compression = compression
+        self.client = HttpClient()
+
+    @property
+    def is_http(self) -> bool:
+        return urlsplit(self.location).scheme in ["http", "https"]
+
+    @property
+    def directory(self) -> Path:
+        parts = urlsplit(self.location)
+        return Path(parts.path if parts.scheme == "file" else self.location)
+
+    def url(self, name: str) -> str:
+        return self.location.rstrip("/") + "/" + name
+
+    def close(self):
+        self.client.close()
+
+    def info(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the info document of an entry, or `None`, when the substituter does not have it.
+        """
+        name = key + INFO_SUFFIX
+        if not self.is_http:
+            path = self.directory / name
+            return json.loads(path.read_text()) if path.exists() else None
+        with self.client.request("GET", self.url(name)) as response:
+            data = response.read()
+            if response.status == 404:
+                return None
+            if response.status != 200:
+                raise DownloadError(f"Unable to query {self.url(name)}. Status: {response.status} {response.reason}")
+        return json.loads(data)
+
+    def fetch(self, key: str, cache: ProvisioningCache) -> bool:
+        """
+        Acquire a provisioning layer from the substituter into the provisioning cache.
+
+        Return whether the layer has been substituted. Failures are not fatal,
+        the layer will be provisioned locally instead.
+        """
+        try:
+            info = self.info(key)
+            if info is None:
+                logger.info(f"Substituter {self.location} does not have provisioning layer {key}")
+                return False
+            logger.info(f"Substituting provisioning layer {key} from {self.location}")
+            self.extract(key, info, cache)
+            return True
+        except (OSError, ValueError, DigestMismatch, DownloadError, InvalidPhysicalImage) as ex:
+            logger.warning(f"Substituting provisioning layer {key} from {self.location} failed: {ex}")
+            return False
+
+    def extract(self, key: str, info: Dict[str, Any], cache: ProvisioningCache):
+        """
+        Extract the bundle of an entry, verify it, and commit its layer to the provisioning cache.
+        """
+        staging = cache.path / f"{key}.substitute.partial"
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        try:
+            hasher = hashlib.sha256()
+            with self.open(key + BUNDLE_SUFFIX) as chunks:
+                stats = ArchiveExtractor.untar(hash_chunks(chunks, hasher), staging, options=EXTRACT_OPTIONS)
+            digest = f"sha256:{hasher.hexdigest()}"
+            if digest != info.get("digest"):
+                raise DigestMismatch(f"Digest mismatch for bundle {key}: Expected {info.get('digest')}, got {digest}")
+            logger.info(stats)
+            metadata = json.loads((staging / METADATA_FILE).read_text())
+            layer = metadata.get("layer") or {}
+            if layer.get("key") != key or not (staging / LAYER_DIRECTORY).is_dir():
+                raise InvalidPhysicalImage(f"Bundle {key} lacks provisioning layer {key}")
+
+            cache.abort(key)
+            (staging / LAYER_DIRECTORY).rename(cache.partial_path(key))
+            cache.commit(key, **layer.get("components", {}))
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    @contextmanager
+    def open(self, name: str) -> Generator[Iterator[bytes], None, None]:
+        """
+        Open a file of the substituter, and yield its content in chunks.
+        """
+        if not self.is_http:
+            with open(self.directory / name, "rb") as f:
+                yield read_chunks(f)
+            return
+        downloader = Downloader(client=self.client)
+        with downloader.open(self.url(name)) as stream:
+            if stream.status != 200:
+                raise DownloadError(f"Unable to download {self.url(name)}. Status: {stream.status} {stream.reason}")
+            yield stream.chunks
+
+    def publish(self, key: str, cache: ProvisioningCache, name: Optional[str] = None) -> BundleStats:
+        """
+        Publish a provisioning layer from the provisioning cache to the substituter.
+        """
+        layer = cache.layer_path(key)
+        if not cache.has(key):
+            raise InvalidPhysicalImage(f"Unable to publish provisioning layer {key}. Reason: Layer does not exist")
+        components = (cache.metadata(key) or {}).get("components", {})
+        metadata = {
+            "format": BUNDLE_FORMAT,
+            "version": BUNDLE_VERSION,
+            "name": name,
+            "created": time.time(),
+            "layer": {"key": key, "components": components},
+        }
+        writer = BundleWriter(compression=self.compression)
+        logger.info(f"Publishing provisioning layer {key} to {self.location}")
+        stats: BundleStats = self.write(
+            key + BUNDLE_SUFFIX, lambda f: writer.write_trees(name or key, metadata, [(layer, LAYER_DIRECTORY)], f)
+        )
+
+        # Write the info document last, it signals the entry is complete.
+        info = {
+            "key": key,
+            "digest": stats.digest,
+            "size": stats.size,
+            "compression": stats.compression,
+            "components": components,
+            "host": socket.gethostname(),
+            "created": time.time(),
+        }
+        data = json.dumps(info, indent=2).encode()
+        self.write(key + INFO_SUFFIX, lambda f: f.write(data))
+        return stats
+
+    def write(self, name: str, producer: Callable[[BinaryIO], Any]) -> Any:
+        """
+        Write a file to the substituter, using content written by `producer`, and return its outcome.
+
+        Within directories, the file is moved into place atomically. HTTP endpoints
+        receive the content streaming, using chunked transfer encoding.
+        """
+        if not self.is_http:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            target = self.directory / name
+            temporary = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+            try:
+                with open(temporary, "wb") as f:
+                    outcome = producer(f)
+                os.replace(temporary, target)
+            finally:
+                temporary.unlink(missing_ok=True)
+            return outcome
+
+        read_fd, write_fd = os.pipe()
+        result: Dict[str, Any] = {}
+
+        def produce():
+            try:
+                with open(write_fd, "wb") as f:
+                    result["outcome"] = producer(f)
+            except BaseException as ex:
+                result["error"] = ex
+
+        thread = threading.Thread(target=produce, name="postroj-upload", daemon=True)
+        thread.start()
+        # Use a dedicated client, a request with a streaming body can not be retried on a stale connection.
+        client = HttpClient()
+        try:
+            with open(read_fd, "rb") as body:
+                with client.request("PUT", self.url(name), body=body) as response:
+                    response.read()
+                    status, reason = response.status, response.reason
+        finally:
+            thread.join()
+            client.close()
+        if "error" in result:
+            raise result["error"]
+        if status not in [200, 201, 204]:
+            raise DownloadError(f"Unable to upload {self.url(name)}. Status: {status} {reason}")
+        return result["outcome"]
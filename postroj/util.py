@@ -3,6 +3,7 @@
 import asyncio
 import dataclasses
 import enum
+import errno
 import io
 import json
 import logging
@@ -16,7 +17,7 @@ import time
 from abc import abstractmethod
 from asyncio import AbstractEventLoop
 from contextlib import contextmanager, redirect_stdout
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from types import TracebackType
 from typing import Optional, Tuple, Union
 
@@ -444,6 +445,77 @@ def boot(ctx: click.Context, verbose: bool, debug: bool):
     setup_logging(level=log_level)
 
 
+def storage_options(func):
+    """
+    Add options for configuring storage shared by multiple hosts, and access to container registries
+    and package repositories.
+    """
+    options = [
+        click.option(
+            "--shared-archive",
+            type=click.Path(file_okay=False, path_type=Path),
+            envvar="POSTROJ_SHARED_ARCHIVE",
+            help="Archive directory shared by multiple hosts, to activate images from without acquiring them",
+        ),
+        click.option(
+            "--registry-mirror",
+            "registry_mirrors",
+            multiple=True,
+            envvar="POSTROJ_REGISTRY_MIRRORS",
+            help="Mirror for a container registry, like `docker.io=registry.internal:5000`, tried in order",
+        ),
+        click.option(
+            "--registry-cache",
+            type=click.Path(file_okay=False, path_type=Path),
+            envvar="POSTROJ_REGISTRY_CACHE",
+            help="Directory to store fetched manifests and blobs into, for serving them to other hosts",
+        ),
+        click.option(
+            "--package-proxy",
+            is_flag=True,
+            envvar="POSTROJ_PACKAGE_PROXY",
+            help="Route package downloads within containers through a caching HTTP proxy",
+        ),
+        click.option(
+            "--package-proxy-offline",
+            is_flag=True,
+            envvar="POSTROJ_PACKAGE_PROXY_OFFLINE",
+            help="Serve package downloads from the cache of the package proxy only, without network access",
+        ),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def configure_storage(
+    shared_archive: Optional[Path] = None,
+    registry_mirrors: Tuple[str, ...] = (),
+    registry_cache: Optional[Path] = None,
+    package_proxy: bool = False,
+    package_proxy_offline: bool = False,
+):
+    """
+    Apply the options added by `storage_options` to the application settings.
+    """
+    from postroj.oci.mirror import parse_mirrors
+    from postroj.settings import get_appsettings
+
+    settings = get_appsettings()
+    if shared_archive is not None:
+        settings.shared_archive_directory = shared_archive
+    if registry_mirrors:
+        try:
+            settings.registry_mirrors = parse_mirrors(registry_mirrors)
+        except ValueError as ex:
+            raise click.BadParameter(str(ex), param_hint="--registry-mirror")
+    if registry_cache is not None:
+        settings.registry_cache_directory = registry_cache
+    if package_proxy or package_proxy_offline:
+        settings.package_proxy = True
+        settings.package_proxy_offline = package_proxy_offline
+
+
 def subprocess_get_error_message(exception: subprocess.CalledProcessError, process: Optional[subprocess.Popen] = None):
 
     # Capture stderr output into error message.
@@ -485,24 +557,61 @@ def subprocess_forward_stderr_stdout(exception: subprocess.CalledProcessError):
 
 def find_rootfs(image_path: Union[Path, str]) -> Path:
     """
-    Check for existence of `/etc/os-release` file in OS root directory.
+    Check for existence of `/etc/os-release` or `/usr/lib/os-release` file in OS root directory.
     When `systemd-nspawn` would encounter an OS root directory without an
-    `/etc/os-release` file, it would croak like::
+    `os-release` file, it would croak like::
 
         Directory /path/to/rootfs doesn't look like an OS root directory (os-release file is missing). Refusing.
     """
     image_path = Path(image_path)
-    os_release_file = Path("./etc/os-release")
-    os_release_candidates = [
+    rootfs_candidates = [
         # Image directory contains rootfs directly.
-        image_path / os_release_file,
-        # Image directory contains "rootfs" subdirectory, having been converted with `umoci`.
-        image_path / "rootfs" / os_release_file,
+        image_path,
+        # Image directory contains "rootfs" subdirectory, having been unpacked from an OCI image.
+        image_path / "rootfs",
     ]
-    for candidate in os_release_candidates:
-        if candidate.exists():
-            return candidate.parent.parent
+    for candidate in rootfs_candidates:
+        for os_release_file in ["/etc/os-release", "/usr/lib/os-release"]:
+            try:
+                if os.path.lexists(resolve_in_root(candidate, os_release_file, follow_symlinks=False)):
+                    return candidate
+            except OSError:
+                pass
 
     raise OsReleaseFileMissing(
         f"OS root directory {image_path} lacks an operating system (os-release file is missing)."
     )
+
+
+def resolve_in_root(root: Union[Path, str], path: Union[Path, str], follow_symlinks: bool = True) -> Path:
+    """
+    Resolve a path within an OS root directory, like `chroot` would do.
+
+    Symlinks are followed relative to the root directory, so absolute link
+    targets and `..` components will never escape it. When `follow_symlinks`
+    is false, a symlink at the final path component will not be followed.
+    """
+    root = Path(root)
+    pending = list(PurePosixPath("/", path).parts[1:])
+    resolved = []
+    hops = 0
+    while pending:
+        part = pending.pop(0)
+        if part in ["", "."]:
+            continue
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+        candidate = root.joinpath(*resolved, part)
+        if (follow_symlinks or pending) and candidate.is_symlink():
+            hops += 1
+            if hops > 40:
+                raise OSError(errno.ELOOP, "Too many levels of symbolic links", str(root / path))
+            target = os.readlink(candidate)
+            if target.startswith("/"):
+                resolved = []
+            pending = target.split("/") + pending
+            continue
+        resolved.append(part)
+    return root.joinpath(*resolved)
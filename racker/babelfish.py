@@ -8,6 +8,7 @@ from slugify import slugify
 from tld import get_tld
 
 from postroj.model import LinuxDistribution
+from postroj.oci.client import DOCKER_HUB_REGISTRY
 
 logger = logging.getLogger(__name__)
 
@@ -91,6 +92,10 @@ class DynamicDistribution(LinuxDistribution):
 
         - docker://fedora:36
         - docker://ghcr.io/jpmens/mqttwarn-standard
+
+        Labels without registry resolve to Docker Hub. Image names designate the
+        upstream registry also when mirrors are configured, so they stay the same
+        on all hosts, while requests are directed to the mirrors, see `RegistryClient`.
         """
         if self.image.startswith("docker://"):
             return
@@ -117,5 +122,5 @@ class DynamicDistribution(LinuxDistribution):
                         do_prefix = True
 
             if do_prefix:
-                image_probe = "docker://docker.io/" + self.image
+                image_probe = f"docker://{DOCKER_HUB_REGISTRY}/" + self.image
             self.image = image_probe
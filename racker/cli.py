@@ -10,8 +10,10 @@ import click
 
 from postroj.api import pull_curated_image
 from postroj.container import PostrojContainer
-from postroj.exceptions import ProvisioningError
-from postroj.util import boot, subprocess_get_error_message
+from postroj.exceptions import InvalidImageReference, ProvisioningError, RegistryError
+from postroj.index import ImageIndex
+from postroj.settings import get_appsettings
+from postroj.util import boot, configure_storage, storage_options, subprocess_get_error_message
 from racker.image import ImageLibrary
 
 logger = logging.getLogger(__name__)
@@ -21,8 +23,10 @@ logger = logging.getLogger(__name__)
 @click.version_option(package_name="racker")
 @click.option("--verbose", is_flag=True, required=False)
 @click.option("--debug", is_flag=True, required=False)
+@storage_options
 @click.pass_context
-def cli(ctx: click.Context, verbose: bool, debug: bool):
+def cli(ctx: click.Context, verbose: bool, debug: bool, **storage):
+    configure_storage(**storage)
     return boot(ctx, verbose, debug)
 
 
@@ -105,9 +109,16 @@ def racker_run(ctx, interactive: bool, tty: bool, rm: bool, image: str, command:
         # subprocess_forward_stderr_stdout(exception=ex)
         raise SystemExit(ex.returncode)
 
+    except (InvalidImageReference, RegistryError) as ex:
+        logger.critical(f"Acquiring filesystem image failed. {ex}")
+        raise SystemExit(1)
+
     except ProvisioningError as ex:
         raise SystemExit(1)
 
+    # Record usage of the image.
+    ImageIndex(get_appsettings().index_path).record_use(rootfs.name)
+
     # Status reporting.
     logger.info(f"Invoking command '{command}' on {rootfs}")
 
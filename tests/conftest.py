@@ -12,6 +12,7 @@ import postroj.model
 import postroj.settings
 from postroj.image import ImageProvider
 from racker.babelfish import DynamicDistribution
+from tests.util import FileServerStandin, RegistryStandin
 
 
 @pytest.fixture(scope="session")
@@ -33,6 +34,7 @@ def adjust_storage_paths(monkeypatch_session):
         archive_directory=Path("/var/lib/testdrive/postroj/archive"),
         image_directory=Path("/var/lib/testdrive/postroj/images"),
         cache_directory=Path("/var/cache/testdrive/postroj"),
+        runtime_directory=Path("/run/testdrive/postroj"),
     )
     monkeypatch_session.setattr(postroj.settings, "appsettings", appsettings)
 
@@ -87,3 +89,23 @@ def scmd_first_command(scmd_mock):
 def hcmd_mock():
     with patch("postroj.image.hcmd") as hcmd:
         yield hcmd
+
+
+@pytest.fixture
+def registry_standin(tmp_path):
+    """
+    A local stand-in for a container registry, serving images from a directory.
+    """
+    registry = RegistryStandin(root=tmp_path / "registry").start()
+    yield registry
+    registry.stop()
+
+
+@pytest.fixture
+def file_standin(tmp_path):
+    """
+    A local stand-in for a web server, serving files from a directory.
+    """
+    server = FileServerStandin(root=tmp_path / "www").start()
+    yield server
+    server.stop()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import threading
+import time
+from unittest.mock import patch
+
+from postroj.api import pull_multiple_images
+
+
+def test_pull_multiple_images_concurrent():
+    """
+    Images are pulled concurrently, bounded by the number of workers.
+    """
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def pull(name):
+        with lock:
+            active.append(name)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.remove(name)
+        return name
+
+    names = ["foo", "bar", "baz", "qux"]
+    with patch("postroj.api.pull_single_image", side_effect=lambda name, update: pull(name)):
+        providers = pull_multiple_images(names, jobs=2)
+
+    assert providers == names
+    assert max(peak) == 2
+
+
+def test_pull_multiple_images_continue_on_error(caplog):
+    """
+    A failing image does not stop the others from being pulled.
+    """
+
+    def pull(name):
+        if name == "bar":
+            raise ValueError(f"Unknown image label: {name}")
+        return name
+
+    with patch("postroj.api.pull_single_image", side_effect=lambda name, update: pull(name)):
+        providers = pull_multiple_images(["foo", "bar", "baz"], jobs=3)
+
+    assert providers == ["foo", "baz"]
+    assert "Failed pulling image bar. Reason: Unknown image label: bar" in caplog.text
+    assert "Pulled 2 of 3 images. Failed: bar" in caplog.text
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import io
+import json
+import shutil
+import tarfile
+
+import pytest
+
+from postroj.bundle import BundleLoader, BundleWriter
+from postroj.exceptions import DigestMismatch, InvalidPhysicalImage
+from postroj.oci.unpack import read_descriptor
+from tests.util import OS_RELEASE, cleanup, make_image, make_layer, make_provider
+
+
+def test_bundle_roundtrip():
+    """
+    An image saved into a bundle is loaded again, including its provisioning layer and metadata.
+    """
+    ip = make_provider("testdrive/bundle:latest")
+    try:
+        key = make_image(ip)
+        buffer = io.BytesIO()
+        stats = BundleWriter(compression="gzip").write(ip, buffer)
+        assert stats.size == len(buffer.getvalue())
+        assert stats.digest.startswith("sha256:")
+
+        # Start from scratch, like on another host.
+        ip = make_provider("testdrive/bundle:latest")
+        shutil.rmtree(ip.provisioning_cache.layer_path(key))
+
+        buffer.seek(0)
+        loaded = BundleLoader().load(buffer, digest=stats.digest)
+        assert loaded.distribution.fullname == ip.distribution.fullname
+        assert (loaded.image / "etc" / "os-release").read_bytes() == OS_RELEASE
+        assert (loaded.image / "usr" / "bin" / "foo").samefile(loaded.image / "usr" / "bin" / "bar")
+        assert loaded.layer_path.resolve() == ip.provisioning_cache.layer_path(key)
+        assert (ip.provisioning_cache.layer_path(key) / "sbin" / "init").read_text() == "init"
+
+        record = loaded.index.get(ip.distribution.fullname)
+        assert record.digest == "sha256:0123456789abcdef"
+        assert record.has_systemd and record.provisioned
+        assert list(ip.settings.archive_directory.glob("load-*")) == []
+    finally:
+        cleanup(ip)
+
+
+def test_bundle_digest_mismatch():
+    ip = make_provider("testdrive/bundle:latest")
+    try:
+        make_image(ip)
+        buffer = io.BytesIO()
+        BundleWriter(compression=None).write(ip, buffer)
+        buffer.seek(0)
+        with pytest.raises(DigestMismatch) as ex:
+            BundleLoader().load(buffer, digest="sha256:foo")
+        ex.match("Digest mismatch for bundle: Expected sha256:foo, got sha256:")
+        assert list(ip.settings.archive_directory.glob("load-*")) == []
+    finally:
+        cleanup(ip)
+
+
+def make_docker_archive(tags, layers) -> bytes:
+    """
+    Create an archive like `docker save` produces it, in its legacy layout.
+    """
+    files = {"config.json": json.dumps({"architecture": "amd64"}).encode()}
+    for number, layer in enumerate(layers):
+        files[f"{number}/layer.tar"] = layer
+    files["manifest.json"] = json.dumps(
+        [
+            {
+                "Config": "config.json",
+                "RepoTags": tags,
+                "Layers": [f"{number}/layer.tar" for number in range(len(layers))],
+            }
+        ]
+    ).encode()
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+def test_load_docker_archive():
+    """
+    Images from `docker save` archives are unpacked, and named by their tag.
+    """
+    ip = make_provider("testdrive/docker-save:latest")
+    try:
+        archive = make_docker_archive(
+            tags=["testdrive/docker-save:latest"],
+            layers=[
+                make_layer({"etc/os-release": OS_RELEASE, "usr/bin/foo": b"foo", "sbin/init": b"init"}, compress=False),
+                make_layer({"usr/bin/.wh.foo": b"", "usr/bin/bar": b"bar"}),
+            ],
+        )
+        loaded = BundleLoader().load(io.BytesIO(archive))
+        assert loaded.distribution.fullname == ip.distribution.fullname
+        rootfs = loaded.image / "rootfs"
+        assert (rootfs / "etc" / "os-release").read_bytes() == OS_RELEASE
+        assert not (rootfs / "usr" / "bin" / "foo").exists()
+        assert (rootfs / "usr" / "bin" / "bar").read_bytes() == b"bar"
+        assert read_descriptor(ip.oci_path, "default")["mediaType"] == "application/vnd.oci.image.manifest.v1+json"
+
+        # Loading the same archive again does not unpack it again.
+        version = ip.store.current()
+        BundleLoader().load(io.BytesIO(archive))
+        assert ip.store.current() == version
+    finally:
+        cleanup(ip)
+
+
+def test_load_docker_archive_select_tag():
+    archive = make_docker_archive(tags=[], layers=[])
+    with pytest.raises(InvalidPhysicalImage) as ex:
+        BundleLoader().load(io.BytesIO(archive))
+    ex.match("Image is untagged, name it using `--tag`")
+
+
+def test_load_invalid_archive():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        tar.addfile(tarfile.TarInfo("foo"), io.BytesIO(b""))
+    with pytest.raises(InvalidPhysicalImage) as ex:
+        BundleLoader().load(io.BytesIO(buffer.getvalue()))
+    ex.match("Archive is neither an image bundle, nor a `docker save` archive")
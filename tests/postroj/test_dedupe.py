@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import json
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from postroj.cli import cli
+from postroj.dedupe import Deduplicator
+from postroj.lock import FileLock
+from postroj.model import ConfigurationOptions
+
+
+@pytest.fixture
+def settings(tmp_path) -> ConfigurationOptions:
+    """
+    An archive with two sibling images sharing some files, and an OCI blob store.
+    Files within ``/etc`` have the same size, but different content.
+    """
+    settings = ConfigurationOptions(
+        archive_directory=tmp_path / "archive",
+        image_directory=tmp_path / "images",
+        cache_directory=tmp_path / "cache",
+        runtime_directory=tmp_path / "run",
+    )
+    shared = os.urandom(8192)
+    for name in ["stretch", "buster"]:
+        image = settings.archive_directory / f"debian-{name}.img"
+        (image / "usr" / "bin").mkdir(parents=True)
+        (image / "usr" / "bin" / "bash").write_bytes(shared)
+        (image / "etc").mkdir()
+        (image / "etc" / "os-release").write_text(f"ID=debian\nVERSION_CODENAME={name}\n")
+        (image / "etc" / "hostname").write_bytes(os.urandom(len(f"ID=debian\nVERSION_CODENAME={name}\n")))
+        os.utime(image / "usr" / "bin" / "bash", ns=(0, 0))
+    settings.blob_directory.mkdir(parents=True)
+    (settings.blob_directory / "blob").write_bytes(shared)
+    os.utime(settings.blob_directory / "blob", ns=(0, 0))
+    return settings
+
+
+def inode(path):
+    return os.stat(path).st_ino
+
+
+def test_dedupe_hardlink(settings):
+    archive = settings.archive_directory
+    report = Deduplicator(settings, method="hardlink").run()
+    assert report.hardlinked == 1
+    assert report.skipped == 0
+    assert report.saved >= 8192
+    assert inode(archive / "debian-stretch.img/usr/bin/bash") == inode(archive / "debian-buster.img/usr/bin/bash")
+    assert inode(archive / "debian-stretch.img/etc/os-release") != inode(archive / "debian-buster.img/etc/os-release")
+
+    # The blob store is left alone.
+    assert os.stat(settings.blob_directory / "blob").st_nlink == 1
+    assert sorted(path.name for path in (archive / "debian-buster.img/usr/bin").iterdir()) == ["bash"]
+
+
+def test_dedupe_incremental(settings):
+    archive = settings.archive_directory
+    report = Deduplicator(settings, method="hardlink").run()
+    assert report.hashed == 6
+    assert report.cached == 0
+
+    # A subsequent run only hashes new files.
+    (archive / "debian-bullseye.img/usr/bin").mkdir(parents=True)
+    bash = (archive / "debian-buster.img/usr/bin/bash").read_bytes()
+    (archive / "debian-bullseye.img/usr/bin/bash").write_bytes(bash)
+    os.utime(archive / "debian-bullseye.img/usr/bin/bash", ns=(0, 0))
+    report = Deduplicator(settings, method="hardlink").run()
+    assert report.hashed == 1
+    assert report.cached == 5
+    assert report.hardlinked == 1
+    assert os.stat(archive / "debian-bullseye.img/usr/bin/bash").st_nlink == 3
+
+
+def test_dedupe_metadata_mismatch(settings):
+    """
+    Hardlinked files share their metadata, so files with different metadata are not hardlinked.
+    """
+    archive = settings.archive_directory
+    os.chmod(archive / "debian-buster.img/usr/bin/bash", 0o755)
+    report = Deduplicator(settings, method="hardlink").run()
+    assert report.hardlinked == 0
+    assert report.skipped == 1
+    assert inode(archive / "debian-stretch.img/usr/bin/bash") != inode(archive / "debian-buster.img/usr/bin/bash")
+
+
+def test_dedupe_ignore_time(settings):
+    archive = settings.archive_directory
+    os.utime(archive / "debian-buster.img/usr/bin/bash", ns=(0, 42))
+    assert Deduplicator(settings, method="hardlink").run().hardlinked == 0
+    assert Deduplicator(settings, method="hardlink", ignore_time=True).run().hardlinked == 1
+
+
+def test_dedupe_auto(settings):
+    """
+    Files are reflinked when the filesystem supports it, and hardlinked otherwise.
+    """
+    archive = settings.archive_directory
+    report = Deduplicator(settings).run()
+    assert report.reflinked + report.hardlinked == 1
+    assert (archive / "debian-buster.img/usr/bin/bash").read_bytes() == (
+        archive / "debian-stretch.img/usr/bin/bash"
+    ).read_bytes()
+
+
+def test_dedupe_skip_work_in_progress(settings):
+    """
+    Trees being built at any depth, like provisioning layers, their work directories,
+    and incoming versions of images, are left untouched.
+    """
+    archive = settings.archive_directory
+    bash = (archive / "debian-buster.img/usr/bin/bash").read_bytes()
+    paths = [
+        archive / "provisioned/k1.partial/usr/bin/bash",
+        archive / "provisioned/k1.work/work/bash",
+        archive / "debian-bookworm.versions/.incoming-1-2/usr/bin/bash",
+    ]
+    for path in paths:
+        path.parent.mkdir(parents=True)
+        path.write_bytes(bash)
+        os.utime(path, ns=(0, 0))
+    report = Deduplicator(settings, method="hardlink").run()
+    assert report.hardlinked == 1
+    for path in paths:
+        assert os.stat(path).st_nlink == 1
+
+
+def test_dedupe_skip_locked_image(settings):
+    """
+    Images locked by other processes, for example while acquiring them, are left untouched.
+    """
+    archive = settings.archive_directory
+    lock = FileLock(archive / "debian-buster.lock").acquire()
+    try:
+        report = Deduplicator(settings, method="hardlink").run()
+    finally:
+        lock.release()
+    assert report.hardlinked == 0
+    assert os.stat(archive / "debian-buster.img/usr/bin/bash").st_nlink == 1
+
+    # Once released, the image is deduplicated.
+    assert Deduplicator(settings, method="hardlink").run().hardlinked == 1
+
+
+def test_cli_dedupe_dry_run(settings, monkeypatch):
+    monkeypatch.setattr("postroj.dedupe.get_appsettings", lambda: settings)
+    runner = CliRunner()
+    result = runner.invoke(cli, ["dedupe", "--dry-run", "--method=hardlink"], catch_exceptions=False)
+    assert result.exit_code == 0
+    report = json.loads(result.stdout)
+    assert report["hardlinked"] == 1
+    archive = settings.archive_directory
+    assert inode(archive / "debian-stretch.img/usr/bin/bash") != inode(archive / "debian-buster.img/usr/bin/bash")
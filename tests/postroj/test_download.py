@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import dataclasses
+import gzip
+import json
+import lzma
+import os
+from unittest.mock import patch
+
+import pytest
+
+from postroj.download import (
+    ArchiveExtractor,
+    Downloader,
+    HttpValidators,
+    decompressor_command,
+    detect_compression,
+    is_verified,
+)
+from postroj.exceptions import DigestMismatch, InvalidImageReference, InvalidPhysicalImage
+from tests.util import FileServerStandin, make_layer, sha256_digest
+
+
+def test_extract_streaming(file_standin, tmp_path):
+    (file_standin.root / "rootfs.tar.gz").write_bytes(make_layer({"etc/os-release": b"ID=foo\n"}))
+    target = tmp_path / "image.img"
+
+    ArchiveExtractor().extract(file_standin.url("rootfs.tar.gz"), target)
+
+    assert (target / "etc" / "os-release").read_bytes() == b"ID=foo\n"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["image.img", "www"]
+
+
+def test_extract_keep_tarball(file_standin, tmp_path):
+    archive = make_layer({"etc/os-release": b"ID=foo\n"}, compress=False)
+    (file_standin.root / "rootfs.tar.xz").write_bytes(lzma.compress(archive))
+    target = tmp_path / "image.img"
+    tarball = tmp_path / "downloads" / "rootfs.tar.xz"
+    target.mkdir()
+    (target / "stale").touch()
+
+    extractor = ArchiveExtractor()
+    stats = extractor.extract(file_standin.url("rootfs.tar.xz"), target, tarball=tarball)
+    assert (stats.compression, stats.decompressor) == ("xz", "xz")
+    assert (stats.size, stats.uncompressed_size) == (len(lzma.compress(archive)), len(archive))
+    assert tarball.read_bytes() == lzma.compress(archive)
+    assert not (target / "stale").exists()
+
+    # Second time, the retained archive is used.
+    extractor.extract(file_standin.url("rootfs.tar.xz"), target, tarball=tarball)
+    assert (target / "etc" / "os-release").read_bytes() == b"ID=foo\n"
+    assert file_standin.requests.count("GET /rootfs.tar.xz bytes=0-8388607") == 1
+    assert sorted(path.name for path in tarball.parent.iterdir()) == ["rootfs.tar.xz", "rootfs.tar.xz.sha256"]
+
+
+def test_extract_not_found(file_standin, tmp_path):
+    target = tmp_path / "image.img"
+    with pytest.raises(InvalidImageReference) as ex:
+        ArchiveExtractor().extract(file_standin.url("foo.tar.gz"), target, tarball=tmp_path / "foo.tar.gz")
+    assert ex.match("Unable to download image: .+/foo.tar.gz. Status: 404")
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["www"]
+
+
+def test_extract_corrupt_keeps_previous(file_standin, tmp_path):
+    (file_standin.root / "rootfs.tar.gz").write_bytes(make_layer({"etc/os-release": b"ID=foo\n"})[:-40])
+    target = tmp_path / "image.img"
+    target.mkdir()
+    (target / "previous").touch()
+
+    with pytest.raises(InvalidPhysicalImage) as ex:
+        ArchiveExtractor().extract(file_standin.url("rootfs.tar.gz"), target)
+    assert ex.match("Unable to extract image. Reason: (gzip|pigz) exited with code 1")
+    assert [path.name for path in target.iterdir()] == ["previous"]
+    assert not target.with_name("image.img.partial").exists()
+
+
+def test_detect_compression():
+    assert detect_compression(b"\x1f\x8b\x08\x00") == "gzip"
+    assert detect_compression(lzma.compress(b"foo")) == "xz"
+    assert detect_compression(b"\x28\xb5\x2f\xfd\x00") == "zstd"
+    assert detect_compression(b"etc/\x00\x00\x00") is None
+
+
+def test_decompressor_command():
+    with patch("shutil.which", lambda program: program != "pigz"):
+        assert decompressor_command("gzip") == ["gzip", "--decompress", "--stdout"]
+    assert decompressor_command("xz") == ["xz", "--decompress", "--stdout", "--threads=0"]
+    with patch("shutil.which", lambda program: None):
+        with pytest.raises(InvalidPhysicalImage) as ex:
+            decompressor_command("zstd")
+        assert ex.match("zstd archives need `zstd`")
+
+
+def test_extract_not_a_tarball(file_standin, tmp_path):
+    """
+    When `tar` gives up early, the decompressor must not be blocked.
+    """
+    (file_standin.root / "rootfs.tar.gz").write_bytes(gzip.compress(os.urandom(8 * 1024 * 1024)))
+    with pytest.raises(InvalidPhysicalImage) as ex:
+        ArchiveExtractor().extract(file_standin.url("rootfs.tar.gz"), tmp_path / "image.img")
+    assert ex.match("Unable to extract image. Reason: tar exited with code 2")
+
+
+def test_extract_conditional(file_standin, tmp_path):
+    (file_standin.root / "rootfs.tar.gz").write_bytes(make_layer({"etc/os-release": b"ID=foo\n"}))
+    target = tmp_path / "image.img"
+    extractor = ArchiveExtractor()
+
+    stats = extractor.extract(file_standin.url("rootfs.tar.gz"), target)
+    assert stats.validators.etag and stats.validators.last_modified
+
+    # Unchanged upstream.
+    assert extractor.extract(file_standin.url("rootfs.tar.gz"), target, validators=stats.validators) is None
+    assert (target / "etc" / "os-release").read_bytes() == b"ID=foo\n"
+
+    # Changed upstream.
+    (file_standin.root / "rootfs.tar.gz").write_bytes(make_layer({"etc/os-release": b"ID=bar\n"}))
+    assert extractor.extract(file_standin.url("rootfs.tar.gz"), target, validators=stats.validators) is not None
+    assert (target / "etc" / "os-release").read_bytes() == b"ID=bar\n"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["image.img", "www"]
+
+
+def test_downloader_segmented(file_standin, tmp_path):
+    data = os.urandom(100_000)
+    (file_standin.root / "foo.deb").write_bytes(data)
+    (file_standin.root / "bar.deb").write_bytes(data[:20_000])
+    downloader = Downloader(segment_size=16_384, max_workers=3)
+
+    stats = downloader.download(file_standin.url("foo.deb"), tmp_path / "foo.deb")
+    downloader.download(file_standin.url("bar.deb"), tmp_path / "bar.deb")
+    downloader.close()
+
+    assert (tmp_path / "foo.deb").read_bytes() == data
+    assert (tmp_path / "bar.deb").read_bytes() == data[:20_000]
+    assert (stats.size, stats.transferred, stats.segments) == (100_000, 100_000, 7)
+    assert "GET /foo.deb bytes=98304-99999" in file_standin.requests
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "bar.deb",
+        "bar.deb.sha256",
+        "foo.deb",
+        "foo.deb.sha256",
+        "www",
+    ]
+
+    # Connections are reused across segments and files.
+    assert file_standin.connections <= 3
+    assert len(file_standin.requests) == 9
+
+
+def test_downloader_stream(file_standin):
+    data = os.urandom(100_000)
+    (file_standin.root / "foo.tar").write_bytes(data)
+    downloader = Downloader(segment_size=16_384, max_workers=2)
+    with downloader.open(file_standin.url("foo.tar")) as stream:
+        assert (stream.status, stream.size, stream.segments) == (200, 100_000, 7)
+        assert b"".join(stream.chunks) == data
+    downloader.close()
+
+
+def test_downloader_without_ranges(tmp_path):
+    server = FileServerStandin(root=tmp_path / "www", ranges=False).start()
+    try:
+        data = os.urandom(100_000)
+        (server.root / "foo.deb").write_bytes(data)
+        downloader = Downloader(segment_size=16_384)
+        stats = downloader.download(server.url("foo.deb"), tmp_path / "foo.deb")
+        with downloader.open(server.url("foo.deb")) as stream:
+            assert (stream.status, stream.segments) == (200, 1)
+            assert b"".join(stream.chunks) == data
+        downloader.close()
+    finally:
+        server.stop()
+    assert (tmp_path / "foo.deb").read_bytes() == data
+    assert (stats.size, stats.segments) == (100_000, 1)
+
+
+def test_downloader_resume(file_standin, tmp_path):
+    data = os.urandom(100_000)
+    (file_standin.root / "foo.deb").write_bytes(data)
+    url = file_standin.url("foo.deb")
+    with Downloader().open(url) as stream:
+        validators = stream.validators
+        b"".join(stream.chunks)
+
+    # Simulate an interrupted download, which completed the first two segments.
+    partial = tmp_path / "foo.deb.part"
+    partial.write_bytes(data[:32_768] + bytes(100_000 - 32_768))
+    state = {"url": url, "size": 100_000, "validators": dataclasses.asdict(validators), "done": [0, 1]}
+    (tmp_path / "foo.deb.part.json").write_text(json.dumps(state))
+    file_standin.requests.clear()
+
+    stats = Downloader(segment_size=16_384).download(url, tmp_path / "foo.deb", digest=sha256_digest(data))
+    assert (tmp_path / "foo.deb").read_bytes() == data
+    assert stats.transferred == 100_000 - 32_768
+    assert stats.digest == sha256_digest(data)
+    assert file_standin.requests[0] == "GET /foo.deb bytes=32768-49151"
+    assert not any(request.endswith("bytes=0-16383") for request in file_standin.requests)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["foo.deb", "foo.deb.sha256", "www"]
+
+
+def test_downloader_resume_changed(file_standin, tmp_path):
+    """
+    When the resource changed upstream, a partial download is discarded.
+    """
+    data = os.urandom(50_000)
+    (file_standin.root / "foo.deb").write_bytes(data)
+    url = file_standin.url("foo.deb")
+    (tmp_path / "foo.deb.part").write_bytes(bytes(50_000))
+    state = {"url": url, "size": 50_000, "validators": dataclasses.asdict(HttpValidators(etag='"stale"')), "done": [0]}
+    (tmp_path / "foo.deb.part.json").write_text(json.dumps(state))
+
+    stats = Downloader(segment_size=16_384).download(url, tmp_path / "foo.deb")
+    assert (tmp_path / "foo.deb").read_bytes() == data
+    assert stats.transferred == 50_000
+
+
+def test_downloader_empty(file_standin, tmp_path):
+    (file_standin.root / "empty").write_bytes(b"")
+    Downloader().download(file_standin.url("empty"), tmp_path / "empty")
+    assert (tmp_path / "empty").read_bytes() == b""
+
+
+def test_extract_verify_published_digest(file_standin, tmp_path):
+    archive = make_layer({"etc/os-release": b"ID=foo\n"})
+    (file_standin.root / "rootfs.tar.gz").write_bytes(archive)
+    (file_standin.root / "SHA256SUMS").write_text(
+        f"{'0' * 64} *other.tar.gz\n{sha256_digest(archive)[7:]} *rootfs.tar.gz\n"
+    )
+    target = tmp_path / "image.img"
+    tarball = tmp_path / "downloads" / "rootfs.tar.gz"
+
+    stats = ArchiveExtractor().extract(file_standin.url("rootfs.tar.gz"), target, tarball=tarball)
+    assert stats.digest == sha256_digest(archive)
+    assert is_verified(tarball)
+    assert (tarball.parent / "rootfs.tar.gz.sha256").read_text() == f"{sha256_digest(archive)[7:]}  rootfs.tar.gz\n"
+
+
+def test_extract_digest_mismatch(file_standin, tmp_path):
+    (file_standin.root / "rootfs.tar.gz").write_bytes(make_layer({"etc/os-release": b"ID=foo\n"}))
+    (file_standin.root / "rootfs.tar.gz.sha256").write_text("0" * 64)
+    target = tmp_path / "image.img"
+    tarball = tmp_path / "downloads" / "rootfs.tar.gz"
+
+    with pytest.raises(DigestMismatch) as ex:
+        ArchiveExtractor().extract(file_standin.url("rootfs.tar.gz"), target, tarball=tarball)
+    assert ex.match(f"Digest mismatch for .+/rootfs.tar.gz: Expected sha256:{'0' * 64}")
+    assert not target.exists()
+    assert list(tarball.parent.iterdir()) == []
+
+
+def test_extract_resume(file_standin, tmp_path):
+    """
+    An interrupted download of an archive is resumed, and the partial archive is extracted again.
+    """
+    archive = make_layer({"etc/os-release": b"ID=foo\n", "foo": os.urandom(100_000)})
+    (file_standin.root / "rootfs.tar.gz").write_bytes(archive)
+    target = tmp_path / "image.img"
+    tarball = tmp_path / "downloads" / "rootfs.tar.gz"
+    untar = ArchiveExtractor.untar
+
+    def interrupted(chunks, directory):
+        next(chunks)
+        raise ConnectionResetError("Connection reset by peer")
+
+    extractor = ArchiveExtractor(downloader=Downloader(segment_size=16_384))
+    with patch.object(ArchiveExtractor, "untar", side_effect=interrupted):
+        with pytest.raises(InvalidImageReference):
+            extractor.extract(file_standin.url("rootfs.tar.gz"), target, tarball=tarball)
+    partial = tarball.with_name("rootfs.tar.gz.part")
+    offset = partial.stat().st_size
+    assert 0 < offset < len(archive)
+    assert tarball.with_name("rootfs.tar.gz.part.json").exists()
+
+    file_standin.requests.clear()
+    with patch.object(ArchiveExtractor, "untar", side_effect=untar):
+        stats = extractor.extract(file_standin.url("rootfs.tar.gz"), target, tarball=tarball)
+    assert f"GET /rootfs.tar.gz bytes={offset}-" in file_standin.requests
+    assert stats.digest == sha256_digest(archive)
+    assert tarball.read_bytes() == archive
+    assert (target / "etc" / "os-release").read_bytes() == b"ID=foo\n"
+    assert sorted(path.name for path in tarball.parent.iterdir()) == ["rootfs.tar.gz", "rootfs.tar.gz.sha256"]
+
+
+def test_extract_unverified_tarball(file_standin, tmp_path):
+    """
+    Archives without a record of their verification, for example truncated ones, are not trusted.
+    """
+    archive = make_layer({"etc/os-release": b"ID=foo\n"})
+    (file_standin.root / "rootfs.tar.gz").write_bytes(archive)
+    tarball = tmp_path / "downloads" / "rootfs.tar.gz"
+    tarball.parent.mkdir()
+    tarball.write_bytes(archive[:-40])
+
+    ArchiveExtractor().extract(file_standin.url("rootfs.tar.gz"), tmp_path / "image.img", tarball=tarball)
+    assert tarball.read_bytes() == archive
+    assert is_verified(tarball)
+
+
+def test_downloader_digest_mismatch(file_standin, tmp_path):
+    (file_standin.root / "foo.deb").write_bytes(b"foo")
+    with pytest.raises(DigestMismatch):
+        Downloader().download(file_standin.url("foo.deb"), tmp_path / "foo.deb", digest=sha256_digest(b"bar"))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["www"]
+
+
+def test_downloader_published_digest(file_standin):
+    (file_standin.root / "foo.deb.sha256").write_text(f"{sha256_digest(b'foo')[7:]}  foo.deb\n")
+    downloader = Downloader()
+    assert downloader.published_digest(file_standin.url("foo.deb")) == sha256_digest(b"foo")
+    assert downloader.published_digest(file_standin.url("bar.deb")) is None
+    downloader.close()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+from unittest.mock import patch
+
+from postroj.image import ImageProvider
+from postroj.index import ImageIndex, ImageRecord, stamp
+from postroj.model import OperatingSystemFamily, OperatingSystemName
+from racker.babelfish import DynamicDistribution
+from tests.util import cleanup, make_image, make_provider
+
+OS_RELEASE = """
+PRETTY_NAME="Debian GNU/Linux 12 (bookworm)"
+NAME="Debian GNU/Linux"
+VERSION_ID="12"
+# Comment
+ID=debian
+"""
+
+
+def test_index_roundtrip(tmp_path):
+    index = ImageIndex(tmp_path / "index.sqlite")
+    assert index.get("foo") is None
+
+    index.put(ImageRecord(name="foo", source="docker://foo", os_release={"ID": "debian"}, has_systemd=True))
+    record = index.get("foo")
+    assert record.source == "docker://foo"
+    assert record.os_release == {"ID": "debian"}
+    assert record.has_systemd is True
+    assert record.provisioned is False
+    assert record.created == record.updated
+
+    index.record_use("foo")
+    index.record_use("foo")
+    assert index.get("foo").run_count == 2
+    assert index.get("foo").last_used is not None
+
+    assert [record.name for record in index.all()] == ["foo"]
+    index.remove("foo")
+    assert index.all() == []
+
+
+def test_index_get_valid(tmp_path):
+    image = tmp_path / "foo.img"
+    image.mkdir()
+    index = ImageIndex(tmp_path / "index.sqlite")
+    index.put(ImageRecord(name="foo", stamp=stamp(image)))
+    assert index.get_valid("foo", image) is not None
+
+    # Changing the image directory invalidates the record.
+    (image / "manifest.json").touch()
+    assert index.get_valid("foo", image) is None
+
+
+def test_discover_from_index(tmp_path_factory, fakeroot):
+    """
+    After discovering an image once, its metadata is answered from the index, without inspecting the image.
+    """
+
+    def provider():
+        ip = ImageProvider(distribution=DynamicDistribution.from_image("foo"), autosetup=False)
+        ip.image_staging = fakeroot
+        ip.index = index
+        return ip
+
+    index = ImageIndex(tmp_path_factory.mktemp("index") / "index.sqlite")
+    (fakeroot / "usr").mkdir()
+    (fakeroot / "etc" / "os-release").write_text(OS_RELEASE)
+
+    ip = provider()
+    ip.discover()
+    ip.update_index(provisioned=True)
+
+    ip = provider()
+    with patch("postroj.image.RootfsInspector") as inspector:
+        ip.discover()
+    inspector.assert_not_called()
+    assert ip.record.provisioned is True
+    assert ip.has_operating_system is True
+    assert ip.os_release["VERSION_ID"] == "12"
+    assert ip.distribution.family == OperatingSystemFamily.DEBIAN
+    assert ip.distribution.name == OperatingSystemName.DEBIAN
+
+
+def test_index_register_existing_image():
+    """
+    Images found on disk without a record are only recorded as provisioned when they are bootable.
+    Otherwise, they are provisioned on first use.
+    """
+    image = "testdrive/unindexed:latest"
+    ip = make_provider(image)
+    try:
+        make_image(ip)
+        ip.index.remove(ip.distribution.fullname)
+        with patch.object(ImageProvider, "provision_systemd") as provision_systemd:
+            ip = ImageProvider(distribution=DynamicDistribution.from_image(image))
+        provision_systemd.assert_not_called()
+        assert ip.record.provisioned is True
+
+        # A half-provisioned image, lacking its provisioning layer.
+        ip.layer_path.unlink()
+        ip.index.remove(ip.distribution.fullname)
+        with patch.object(ImageProvider, "provision_systemd") as provision_systemd:
+            ip = ImageProvider(distribution=DynamicDistribution.from_image(image))
+        provision_systemd.assert_called_once()
+    finally:
+        cleanup(ip)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import fcntl
+import json
+import os
+import threading
+
+import pytest
+
+from postroj.exceptions import LockTimeout
+from postroj.lock import FileLock, is_locked, read_holder
+from postroj.store import INCOMING_PREFIX, ImageStore
+
+
+def hold(path, release: threading.Event):
+    """
+    Hold the lock through a separate open file description, like another process would.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    release.wait()
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+def test_lock_acquire_release(tmp_path):
+    path = tmp_path / "foo.lock"
+    assert not is_locked(path)
+    with FileLock(path) as lock:
+        assert is_locked(path)
+        assert not lock.waited
+        assert lock.stale is None
+        assert read_holder(lock.fd)["pid"] == os.getpid()
+        # Acquiring again is a no-op.
+        assert lock.acquire() is lock
+    assert not is_locked(path)
+    assert path.read_text() == ""
+
+
+def test_lock_waited(tmp_path):
+    path = tmp_path / "foo.lock"
+    release = threading.Event()
+    holder = threading.Thread(target=hold, args=(path, release))
+    holder.start()
+    while not is_locked(path):
+        pass
+    threading.Timer(0.2, release.set).start()
+    with FileLock(path, interval=0.05) as lock:
+        assert lock.waited
+    holder.join()
+
+
+def test_lock_timeout(tmp_path):
+    path = tmp_path / "foo.lock"
+    release = threading.Event()
+    holder = threading.Thread(target=hold, args=(path, release))
+    holder.start()
+    try:
+        while not is_locked(path):
+            pass
+        with pytest.raises(LockTimeout) as ex:
+            FileLock(path, timeout=0.1, interval=0.05).acquire()
+        ex.match("Timeout after 0.1 seconds while waiting for lock")
+    finally:
+        release.set()
+        holder.join()
+
+
+def test_lock_shared(tmp_path):
+    """
+    Shared locks are held by multiple holders at the same time, and exclude the exclusive lock.
+    """
+    path = tmp_path / "foo.lock"
+    with FileLock(path, shared=True), FileLock(path, shared=True) as lock:
+        assert not lock.waited
+        with pytest.raises(LockTimeout):
+            FileLock(path, timeout=0).acquire()
+    with FileLock(path) as lock:
+        assert lock.stale is None
+
+
+def test_lock_stale(tmp_path):
+    """
+    A holder recorded within an unlocked lock file designates a crashed process.
+    """
+    path = tmp_path / "foo.lock"
+    path.write_text(json.dumps({"pid": 4242, "host": "foo", "time": 0}))
+    with FileLock(path) as lock:
+        assert not lock.waited
+        assert lock.stale["pid"] == 4242
+
+
+def test_store_recover(tmp_path):
+    store = ImageStore(tmp_path / "foo.img")
+    store.path.mkdir()
+    (store.path / f"{INCOMING_PREFIX}4242-1").mkdir()
+    (store.path / f"{INCOMING_PREFIX}4243-1").mkdir()
+    store.recover(pid=4242)
+    assert [path.name for path in store.path.iterdir()] == [f"{INCOMING_PREFIX}4243-1"]
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import pytest
+
+from postroj.exceptions import InvalidImageReference
+from postroj.oci.client import RegistryClient
+from postroj.oci.mirror import PullThroughCache, parse_mirrors, registry_endpoint
+from postroj.oci.store import BlobStore
+from tests.util import FileServerStandin, RegistryStandin, make_layer, sha256_digest
+
+
+def test_parse_mirrors():
+    mirrors = parse_mirrors(
+        ["docker.io=registry.internal:5000", "quay.io=foo", "docker.io=http://cache:8080/docker.io"]
+    )
+    assert mirrors == {"docker.io": ["registry.internal:5000", "http://cache:8080/docker.io"], "quay.io": ["foo"]}
+    with pytest.raises(ValueError) as ex:
+        parse_mirrors(["docker.io"])
+    ex.match("Invalid registry mirror definition: docker.io. Use `<registry>=<mirror>`")
+
+
+def test_registry_endpoint():
+    assert registry_endpoint("registry.internal:5000") == "https://registry.internal:5000/v2"
+    assert registry_endpoint("localhost:5000") == "http://localhost:5000/v2"
+    assert registry_endpoint("http://cache:8080/docker.io/") == "http://cache:8080/docker.io/v2"
+
+
+def test_registry_client_mirror(tmp_path, registry_standin):
+    """
+    Mirrors are consulted in order, unavailable mirrors are skipped, the registry itself is not contacted.
+    """
+    mirror = RegistryStandin(root=tmp_path / "mirror").start()
+    try:
+        layers = [make_layer({"foo": b"bar"})]
+        source_digest = mirror.publish("foo", "latest", layers=layers, multiarch=True)
+        mirrors = {registry_standin.address: ["localhost:1", mirror.address]}
+        client = RegistryClient(store=BlobStore(tmp_path / "blobs"), mirrors=mirrors)
+        manifest = client.pull(f"{registry_standin.address}/foo", layout=tmp_path / "foo.oci")
+        client.close()
+    finally:
+        mirror.stop()
+    assert manifest.digest == source_digest
+    assert f"GET /v2/foo/blobs/{sha256_digest(layers[0])}" in mirror.requests
+    assert registry_standin.requests == []
+
+
+def test_registry_client_mirror_fallback(tmp_path, registry_standin):
+    """
+    When mirrors do not have the image, it is acquired from the registry itself.
+    """
+    mirror = RegistryStandin(root=tmp_path / "mirror").start()
+    try:
+        source_digest = registry_standin.publish("foo", "latest", layers=[make_layer({"foo": b"bar"})])
+        mirrors = {registry_standin.address: [mirror.address]}
+        client = RegistryClient(store=BlobStore(tmp_path / "blobs"), mirrors=mirrors)
+        manifest = client.pull(f"{registry_standin.address}/foo", layout=tmp_path / "foo.oci")
+
+        # Failures of the registry itself are reported.
+        with pytest.raises(InvalidImageReference) as ex:
+            client.pull(f"{registry_standin.address}/unknown", layout=tmp_path / "unknown.oci")
+        ex.match(f"Request to http://{registry_standin.address}/v2/unknown/manifests/latest failed with status 404")
+        client.close()
+    finally:
+        mirror.stop()
+    assert manifest.digest == source_digest
+    assert "GET /v2/foo/manifests/latest" in mirror.requests
+
+
+def test_registry_client_pull_through(tmp_path, registry_standin):
+    """
+    Manifests and blobs stored by the pull-through cache are served to other hosts by a static web server.
+    """
+    layers = [make_layer({"etc/os-release": b"ID=foo\n"}), make_layer({"foo": b"bar"})]
+    source_digest = registry_standin.publish("foo", "latest", layers=layers, multiarch=True)
+    image = f"{registry_standin.address}/foo:latest"
+
+    cache = PullThroughCache(tmp_path / "cache")
+    store = BlobStore(tmp_path / "blobs")
+    client = RegistryClient(store=store, cache=cache)
+    client.pull(image, layout=tmp_path / "foo.oci")
+    client.close()
+    repository = cache.repository_path(registry_standin.address, "foo")
+    for layer in layers:
+        assert (repository / "blobs" / sha256_digest(layer)).read_bytes() == layer
+        # The cache does not hold references on blobs, only the OCI image layout does.
+        assert store.refcount(sha256_digest(layer)) == 1
+    assert (repository / "manifests" / source_digest).exists()
+    # Tags move upstream, so they are not stored.
+    assert not (repository / "manifests" / "latest").exists()
+
+    # Another host resolves the tag using the registry, and acquires the image from the cache.
+    registry_standin.requests.clear()
+    server = FileServerStandin(tmp_path / "cache").start()
+    try:
+        mirrors = {registry_standin.address: [server.url(registry_standin.address)]}
+        client = RegistryClient(store=BlobStore(tmp_path / "other"), mirrors=mirrors)
+        manifest = client.pull(image, layout=tmp_path / "other.oci")
+        client.close()
+    finally:
+        server.stop()
+    assert manifest.digest == source_digest
+    assert registry_standin.requests == ["GET /v2/foo/manifests/latest"]
+
+
+def test_registry_client_pull_through_moved_tag(tmp_path, registry_standin):
+    """
+    When a tag moved upstream, hosts using the pull-through cache as a mirror acquire the new image.
+    """
+    cache = PullThroughCache(tmp_path / "cache")
+    registry_standin.publish("foo", "latest", layers=[make_layer({"foo": b"bar"})])
+    client = RegistryClient(store=BlobStore(tmp_path / "blobs"), cache=cache)
+    client.pull(f"{registry_standin.address}/foo:latest", layout=tmp_path / "foo.oci")
+    client.close()
+
+    source_digest = registry_standin.publish("foo", "latest", layers=[make_layer({"foo": b"baz"})])
+    server = FileServerStandin(tmp_path / "cache").start()
+    try:
+        mirrors = {registry_standin.address: [server.url(registry_standin.address)]}
+        client = RegistryClient(store=BlobStore(tmp_path / "other"), mirrors=mirrors)
+        manifest = client.pull(f"{registry_standin.address}/foo:latest", layout=tmp_path / "other.oci")
+        client.close()
+    finally:
+        server.stop()
+    assert manifest.digest == source_digest
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import hashlib
+import json
+import re
+import shutil
+from pathlib import Path
+
+import pytest
+
+from postroj.exceptions import DigestMismatch, InvalidImageReference
+from postroj.oci.client import ImageReference, RegistryClient
+from postroj.oci.store import BlobStore, split_digest
+from postroj.oci.unpack import LayerUnpacker, read_descriptor, read_unpacked_descriptor
+from postroj.util import resolve_in_root
+from tests.util import RegistryStandin, make_layer, sha256_digest
+
+
+def make_blob(store: BlobStore, data: bytes) -> str:
+    digest = "sha256:" + hashlib.sha256(data).hexdigest()
+    path = store.blob_path(digest)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return digest
+
+
+def make_layout(store: BlobStore, layout: Path, layers: list) -> str:
+    """
+    Create an OCI image layout, whose blobs are only available within the store.
+    """
+    config = make_blob(store, b"{}")
+    layer_digests = [make_blob(store, layer) for layer in layers]
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.oci.image.manifest.v1+json",
+        "config": {"mediaType": "application/vnd.oci.image.config.v1+json", "digest": config},
+        "layers": [
+            {"mediaType": "application/vnd.oci.image.layer.v1.tar+gzip", "digest": digest} for digest in layer_digests
+        ],
+    }
+    manifest_digest = make_blob(store, json.dumps(manifest).encode())
+    index = {
+        "schemaVersion": 2,
+        "manifests": [{"mediaType": "application/vnd.oci.image.manifest.v1+json", "digest": manifest_digest}],
+    }
+    layout.mkdir(parents=True)
+    (layout / "index.json").write_text(json.dumps(index))
+    return manifest_digest
+
+
+def test_blobstore_link_layout(tmp_path):
+    store = BlobStore(tmp_path / "blobs")
+    store.setup()
+
+    make_layout(store, tmp_path / "foo.oci", layers=[b"base", b"foo"])
+    make_layout(store, tmp_path / "bar.oci", layers=[b"base", b"bar"])
+    store.link_layout(tmp_path / "foo.oci")
+    store.link_layout(tmp_path / "bar.oci")
+
+    base = "sha256:" + hashlib.sha256(b"base").hexdigest()
+    foo = "sha256:" + hashlib.sha256(b"foo").hexdigest()
+    assert store.refcount(base) == 2
+    assert store.refcount(foo) == 1
+    assert (tmp_path / "foo.oci" / "blobs" / "sha256" / split_digest(base)[1]).read_bytes() == b"base"
+
+    # Linking again does not add another reference.
+    store.link_layout(tmp_path / "foo.oci")
+    assert store.refcount(base) == 2
+
+
+def test_blobstore_collect_garbage(tmp_path):
+    store = BlobStore(tmp_path / "blobs")
+    store.setup()
+
+    make_layout(store, tmp_path / "foo.oci", layers=[b"base", b"foo"])
+    bar_manifest = make_layout(store, tmp_path / "bar.oci", layers=[b"base", b"bar"])
+    store.link_layout(tmp_path / "foo.oci")
+
+    # Blobs only used by the unlinked `bar` layout are unreferenced.
+    expected = len(b"bar") + store.blob_path(bar_manifest).stat().st_size
+    assert store.collect_garbage() == expected
+    assert store.has("sha256:" + hashlib.sha256(b"base").hexdigest())
+    assert not store.has("sha256:" + hashlib.sha256(b"bar").hexdigest())
+
+
+def test_split_digest_invalid():
+    with pytest.raises(ValueError) as ex:
+        split_digest("sha256:../../etc/passwd")
+    assert ex.match(re.escape("Invalid digest: sha256:../../etc/passwd"))
+
+
+@pytest.mark.parametrize(
+    "image,expected",
+    [
+        ("debian", ("docker.io", "library/debian", "latest", None)),
+        ("docker://docker.io/debian:bookworm-slim", ("docker.io", "library/debian", "bookworm-slim", None)),
+        ("opensuse/tumbleweed:latest", ("docker.io", "opensuse/tumbleweed", "latest", None)),
+        ("docker://quay.io/centos/centos:stream9", ("quay.io", "centos/centos", "stream9", None)),
+        ("localhost:5000/foo@sha256:abc", ("localhost:5000", "foo", None, "sha256:abc")),
+    ],
+)
+def test_image_reference_parse(image, expected):
+    reference = ImageReference.parse(image)
+    assert (reference.registry, reference.repository, reference.tag, reference.digest) == expected
+
+
+def test_image_reference_endpoint():
+    assert ImageReference.parse("debian").endpoint == "https://registry-1.docker.io/v2"
+    assert ImageReference.parse("localhost:5000/foo").endpoint == "http://localhost:5000/v2"
+
+
+def test_registry_client_pull(tmp_path, registry_standin):
+    """
+    Pull a multi-architecture image into an OCI image layout.
+    """
+    layers = [make_layer({"etc/os-release": b"ID=foo\n"}), make_layer({"etc/hostname": b"foo\n"})]
+    source_digest = registry_standin.publish("foo", "latest", layers=layers, multiarch=True)
+
+    store = BlobStore(tmp_path / "blobs")
+    client = RegistryClient(store=store)
+    layout = tmp_path / "foo.oci"
+    manifest = client.pull(f"docker://{registry_standin.address}/foo:latest", layout=layout)
+    client.close()
+
+    assert manifest.digest == source_digest
+    index = json.loads((layout / "index.json").read_text())
+    descriptor = index["manifests"][0]
+    assert descriptor["annotations"]["org.opencontainers.image.ref.name"] == "default"
+    assert descriptor["annotations"]["io.github.pyveci.racker.source.digest"] == source_digest
+
+    # Docker manifests are converted to OCI manifests, all blobs are linked into the layout.
+    document = json.loads(store.blob_path(descriptor["digest"]).read_bytes())
+    assert document["mediaType"] == "application/vnd.oci.image.manifest.v1+json"
+    assert document["layers"][0]["mediaType"] == "application/vnd.oci.image.layer.v1.tar+gzip"
+    for layer in layers:
+        assert store.refcount(sha256_digest(layer)) == 1
+
+    # Connections are kept alive and reused.
+    assert registry_standin.connections < len(registry_standin.requests)
+
+
+def test_registry_client_shared_layers(tmp_path, registry_standin):
+    """
+    Layers already within the blob store will not be downloaded again.
+    """
+    base = make_layer({"etc/os-release": b"ID=foo\n"})
+    registry_standin.publish("foo", "1", layers=[base, make_layer({"one": b"1"})])
+    registry_standin.publish("foo", "2", layers=[base, make_layer({"two": b"2"})])
+
+    store = BlobStore(tmp_path / "blobs")
+    client = RegistryClient(store=store)
+    client.pull(f"{registry_standin.address}/foo:1", layout=tmp_path / "one.oci")
+    client.pull(f"{registry_standin.address}/foo:2", layout=tmp_path / "two.oci")
+    client.close()
+
+    assert registry_standin.requests.count(f"GET /v2/foo/blobs/{sha256_digest(base)}") == 1
+    assert store.refcount(sha256_digest(base)) == 2
+
+
+def test_registry_client_is_current(tmp_path, registry_standin):
+    """
+    Detect moved tags by only requesting the manifest digest.
+    """
+    image = f"{registry_standin.address}/foo:latest"
+    layout = tmp_path / "foo.oci"
+    client = RegistryClient(store=BlobStore(tmp_path / "blobs"))
+    assert client.is_current(image, layout=layout) is False
+
+    registry_standin.publish("foo", "latest", layers=[make_layer({"foo": b"1"})], multiarch=True)
+    client.pull(image, layout=layout)
+    registry_standin.requests.clear()
+    assert client.is_current(image, layout=layout) is True
+    assert registry_standin.requests == ["HEAD /v2/foo/manifests/latest"]
+
+    registry_standin.publish("foo", "latest", layers=[make_layer({"foo": b"2"})], multiarch=True)
+    assert client.is_current(image, layout=layout) is False
+    client.close()
+
+
+def test_registry_client_token_authentication(tmp_path):
+    registry = RegistryStandin(root=tmp_path / "registry", token="secret").start()
+    try:
+        registry.publish("foo", "latest", layers=[make_layer({"foo": b"bar"})])
+        client = RegistryClient(store=BlobStore(tmp_path / "blobs"))
+        client.pull(f"{registry.address}/foo", layout=tmp_path / "foo.oci")
+        client.close()
+    finally:
+        registry.stop()
+    assert "GET /token?service=test&scope=repository%3Afoo%3Apull" in registry.requests
+
+
+def test_registry_client_digest_mismatch(tmp_path, registry_standin):
+    layer = make_layer({"foo": b"bar"})
+    registry_standin.publish("foo", "latest", layers=[layer])
+    (registry_standin.root / "foo" / "blobs" / sha256_digest(layer)).write_bytes(b"corrupted")
+
+    store = BlobStore(tmp_path / "blobs")
+    client = RegistryClient(store=store)
+    with pytest.raises(DigestMismatch) as ex:
+        client.pull(f"{registry_standin.address}/foo", layout=tmp_path / "foo.oci")
+    assert ex.match(f"Digest mismatch for blob {sha256_digest(layer)}")
+    assert not store.has(sha256_digest(layer))
+    assert not (tmp_path / "foo.oci" / "index.json").exists()
+
+
+def test_registry_client_image_not_found(tmp_path, registry_standin):
+    client = RegistryClient(store=BlobStore(tmp_path / "blobs"))
+    with pytest.raises(InvalidImageReference) as ex:
+        client.pull(f"{registry_standin.address}/unknown", layout=tmp_path / "foo.oci")
+    assert ex.match("Unable to acquire image .+/unknown:latest. .+ failed with status 404")
+
+
+def unpack_layers(tmp_path: Path, layers: list) -> Path:
+    """
+    Write layers into an OCI image layout, and unpack it.
+    """
+    store = BlobStore(tmp_path / "blobs")
+    layout = tmp_path / "image.oci"
+    make_layout(store, layout, layers=layers)
+    store.link_layout(layout)
+    index = json.loads((layout / "index.json").read_text())
+    index["manifests"][0]["annotations"] = {"org.opencontainers.image.ref.name": "default"}
+    (layout / "index.json").write_text(json.dumps(index))
+    LayerUnpacker(max_workers=2).unpack(layout, tmp_path / "image.img")
+    return tmp_path / "image.img" / "rootfs"
+
+
+def test_unpack_layers(tmp_path):
+    rootfs = unpack_layers(
+        tmp_path,
+        layers=[
+            make_layer(
+                {
+                    "etc": None,
+                    "etc/os-release": b"ID=foo\n",
+                    "usr/lib/foo": b"foo",
+                    "lib": "usr/lib",
+                    "var/cache/foo/one": b"1",
+                    "var/cache/foo/two": b"2",
+                }
+            ),
+            make_layer(
+                {
+                    "etc/.wh.os-release": b"",
+                    "etc/os-release": b"ID=bar\n",
+                    "lib/bar": b"bar",
+                    "lib/baz": ("usr/lib/bar",),
+                    "var/cache/foo/.wh..wh..opq": b"",
+                    "var/cache/foo/three": b"3",
+                },
+                compress=False,
+            ),
+        ],
+    )
+    assert (rootfs / "etc" / "os-release").read_bytes() == b"ID=bar\n"
+    assert (rootfs / "lib").is_symlink()
+    assert (rootfs / "usr" / "lib" / "bar").read_bytes() == b"bar"
+    assert (rootfs / "usr" / "lib" / "baz").stat().st_ino == (rootfs / "usr" / "lib" / "bar").stat().st_ino
+    assert sorted(path.name for path in (rootfs / "var" / "cache" / "foo").iterdir()) == ["three"]
+    assert not (tmp_path / "image.img" / ".staging").exists()
+
+
+def test_unpack_whiteout(tmp_path):
+    rootfs = unpack_layers(
+        tmp_path,
+        layers=[
+            make_layer({"etc/os-release": b"ID=foo\n", "opt/foo/bar": b"bar"}),
+            make_layer({"opt/.wh.foo": b""}),
+        ],
+    )
+    assert (rootfs / "opt").is_dir()
+    assert not (rootfs / "opt" / "foo").exists()
+
+
+def test_unpack_symlink_escape(tmp_path):
+    """
+    Absolute symlinks are resolved relative to the root filesystem.
+    """
+    outside = tmp_path / "outside"
+    rootfs = unpack_layers(
+        tmp_path,
+        layers=[
+            make_layer({"etc/os-release": b"ID=foo\n", "var/run": str(outside), "../../escape": b"foo"}),
+            make_layer({"var/run/foo.pid": b"42"}),
+        ],
+    )
+    assert not outside.exists()
+    assert (rootfs / str(outside).lstrip("/") / "foo.pid").read_bytes() == b"42"
+    assert (rootfs / "escape").exists()
+
+
+def test_resolve_in_root(tmp_path):
+    (tmp_path / "usr" / "lib").mkdir(parents=True)
+    (tmp_path / "lib").symlink_to("/usr/lib")
+    (tmp_path / "loop").symlink_to("loop")
+    assert resolve_in_root(tmp_path, "/lib/foo") == tmp_path / "usr" / "lib" / "foo"
+    assert resolve_in_root(tmp_path, "../../lib") == tmp_path / "usr" / "lib"
+    assert resolve_in_root(tmp_path, "lib", follow_symlinks=False) == tmp_path / "lib"
+    with pytest.raises(OSError) as ex:
+        resolve_in_root(tmp_path, "loop/foo")
+    assert ex.match("Too many levels of symbolic links")
+
+
+def test_unpack_snapshots(tmp_path):
+    """
+    When the topmost layer changes, lower layers are restored from snapshots.
+    """
+    base = make_layer({"etc/os-release": b"ID=foo\n", "usr/bin/foo": b"foo"})
+    middle = make_layer({"usr/bin/bar": b"bar"})
+    store = BlobStore(tmp_path / "blobs")
+    layout = tmp_path / "image.oci"
+    bundle = tmp_path / "image.img"
+    snapshots = tmp_path / "image.snapshots"
+
+    def unpack(top: bytes):
+        shutil.rmtree(layout, ignore_errors=True)
+        make_layout(store, layout, layers=[base, middle, top])
+        store.link_layout(layout)
+        index = json.loads((layout / "index.json").read_text())
+        index["manifests"][0]["annotations"] = {"org.opencontainers.image.ref.name": "default"}
+        (layout / "index.json").write_text(json.dumps(index))
+        return LayerUnpacker().unpack(layout, bundle, snapshots=snapshots)
+
+    timings = unpack(make_layer({"etc/hostname": b"one\n"}))
+    assert [timing.reused for timing in timings] == [False, False, False]
+    assert len(list(snapshots.iterdir())) == 2
+
+    timings = unpack(make_layer({"etc/hostname": b"two\n"}))
+    assert [timing.reused for timing in timings] == [True, True, False]
+    rootfs = bundle / "rootfs"
+    assert (rootfs / "etc" / "hostname").read_bytes() == b"two\n"
+    assert (rootfs / "usr" / "bin" / "bar").read_bytes() == b"bar"
+    assert read_unpacked_descriptor(bundle) == read_descriptor(layout, "default")
+
+    # Snapshots are not modified when layers are applied on top of them.
+    snapshot = snapshots / sorted(snapshots.iterdir(), key=lambda path: path.stat().st_mtime)[-1].name
+    assert not (snapshot / "etc" / "hostname").exists()
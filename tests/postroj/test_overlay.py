@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+from postroj.overlay import OverlayMount, find_layers
+
+
+def test_overlay_mount(tmp_path):
+    lower = tmp_path / "lower"
+    lower.mkdir()
+    (lower / "foo").write_text("foo")
+    (lower / "bar").write_text("bar")
+
+    overlay = OverlayMount(lower=[lower], upper=tmp_path / "upper", work=tmp_path / "work", target=tmp_path / "merged")
+    with overlay as merged:
+        (merged / "foo").write_text("changed")
+        (merged / "bar").unlink()
+        (merged / "baz").write_text("baz")
+
+    assert not overlay.target.exists()
+    assert (lower / "foo").read_text() == "foo"
+    assert (lower / "bar").exists()
+    assert sorted(path.name for path in (tmp_path / "upper").iterdir()) == ["bar", "baz", "foo"]
+
+    # Without an upper directory, the overlay filesystem is read-only.
+    overlay = OverlayMount(lower=[tmp_path / "upper", lower], target=tmp_path / "merged")
+    with overlay as merged:
+        assert sorted(path.name for path in merged.iterdir()) == ["baz", "foo"]
+        assert (merged / "foo").read_text() == "changed"
+    assert overlay.options() == f"lowerdir={tmp_path / 'upper'}:{lower}"
+
+
+def test_find_layers(tmp_path):
+    (tmp_path / "archive" / "foo.img").mkdir(parents=True)
+    (tmp_path / "archive" / "provisioned" / "abc").mkdir(parents=True)
+    (tmp_path / "images").mkdir()
+    (tmp_path / "images" / "foo").symlink_to(tmp_path / "archive" / "foo.img")
+    assert find_layers(tmp_path / "images" / "foo") == []
+
+    (tmp_path / "archive" / "foo.layer").symlink_to(tmp_path / "archive" / "provisioned" / "abc")
+    assert find_layers(tmp_path / "images" / "foo") == [tmp_path / "archive" / "provisioned" / "abc"]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import shutil
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from postroj.exceptions import InvalidPhysicalImage
+from postroj.overlay import find_layers
+from postroj.packing import ImagePacker, LoopMount, is_packed_image
+
+
+def fake_pack(command, passthrough=True):
+    """
+    Pretend to run `mksquashfs <source> <target> ...`, recording the files within the source directory.
+    """
+    source, target = Path(command.split()[1]), Path(command.split()[2])
+    target.write_text("\n".join(sorted(path.name for path in source.iterdir())))
+
+
+@pytest.fixture
+def packer_mock():
+    with patch("postroj.packing.shutil.which", return_value="/usr/bin/mksquashfs"):
+        with patch("postroj.packing.hcmd", side_effect=fake_pack) as hcmd:
+            yield hcmd
+
+
+def test_pack_command(tmp_path):
+    assert (
+        ImagePacker("squashfs").command(Path("/foo.img"), Path("/foo.squashfs"))
+        == "mksquashfs /foo.img /foo.squashfs -comp zstd -noappend -no-progress -quiet"
+    )
+    assert (
+        ImagePacker("erofs", compression="lz4hc").command(Path("/foo.img"), Path("/foo.erofs"))
+        == "mkfs.erofs -zlz4hc --quiet /foo.erofs /foo.img"
+    )
+    with pytest.raises(ValueError) as ex:
+        ImagePacker("zip")
+    ex.match("Unknown image format: zip")
+
+
+def test_pack_program_missing(tmp_path):
+    with patch("postroj.packing.shutil.which", return_value=None):
+        with pytest.raises(InvalidPhysicalImage) as ex:
+            ImagePacker().pack(tmp_path, tmp_path / "foo.squashfs")
+    ex.match("Unable to pack image, program not found: mksquashfs")
+
+
+def test_pack_with_layers(tmp_path, packer_mock):
+    """
+    Provisioning layers are stacked over the OS root directory, and become part of the packed image.
+    """
+    (tmp_path / "rootfs").mkdir()
+    (tmp_path / "rootfs" / "etc").mkdir()
+    (tmp_path / "layer" / "usr").mkdir(parents=True)
+    target = ImagePacker().pack(tmp_path / "rootfs", tmp_path / "foo.squashfs", layers=[tmp_path / "layer"])
+    assert target.read_text() == "etc\nusr"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["foo.squashfs", "layer", "rootfs"]
+
+
+def test_activate_packed_image(fakeimage, packer_mock):
+    fakeimage.pack_format = "squashfs"
+    try:
+        image = fakeimage.activate_image()
+        packed = fakeimage.image_staging.with_suffix(".squashfs")
+        assert image.resolve() == packed
+        assert is_packed_image(image)
+        assert find_layers(image) == []
+
+        # The packed image is reused, until the OS root directory changes.
+        fakeimage.activate_image()
+        packer_mock.assert_called_once()
+        fakeimage.discard_packed_images()
+        assert not packed.exists()
+
+        # Without a pack format, the directory is activated again.
+        fakeimage.pack_format = None
+        image = fakeimage.activate_image()
+        assert image.resolve() == fakeimage.image_staging
+        assert not is_packed_image(image)
+    finally:
+        fakeimage.image.unlink(missing_ok=True)
+
+
+@pytest.mark.skipif(shutil.which("mksquashfs") is None, reason="mksquashfs not installed")
+def test_pack_and_mount(tmp_path):
+    (tmp_path / "rootfs" / "etc").mkdir(parents=True)
+    (tmp_path / "rootfs" / "etc" / "os-release").write_text("ID=debian\n")
+    packed = ImagePacker().pack(tmp_path / "rootfs", tmp_path / "foo.squashfs")
+    assert is_packed_image(packed)
+    with LoopMount(packed, target=tmp_path / "mnt") as mounted:
+        assert (mounted / "etc" / "os-release").read_text() == "ID=debian\n"
+    assert not (tmp_path / "mnt").exists()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+from unittest.mock import patch
+
+from postroj.backend.nspawn import scmd
+from postroj.pkgcache import PackageCache
+from postroj.settings import get_appsettings
+
+
+def make_program(rootfs, path: str):
+    program = rootfs / path.lstrip("/")
+    program.parent.mkdir(parents=True, exist_ok=True)
+    program.write_text("#!/bin/sh\n")
+    program.chmod(0o755)
+
+
+def test_package_cache_for_rootfs(fakeroot):
+    make_program(fakeroot, "/usr/bin/apt-get")
+    hook = fakeroot / "etc" / "apt" / "apt.conf.d" / "docker-clean"
+    hook.parent.mkdir(parents=True)
+    hook.touch()
+    cache = PackageCache.for_rootfs("debian-bookworm", fakeroot)
+    assert cache.path == get_appsettings().package_cache_directory / "debian-bookworm" / "archives"
+    assert cache.target == "/var/cache/apt/archives"
+    assert cache.purge_hooks == ["/etc/apt/apt.conf.d/docker-clean"]
+
+    make_program(fakeroot, "/usr/bin/pacman")
+    (fakeroot / "usr" / "bin" / "apt-get").unlink()
+    hook.unlink()
+    cache = PackageCache.for_rootfs("archlinux-latest", fakeroot)
+    assert cache.path.name == "pkg"
+    assert cache.target == "/var/cache/pacman/pkg"
+    assert cache.purge_hooks == []
+
+
+def test_package_cache_unknown(fakeroot):
+    assert PackageCache.for_rootfs("foo", fakeroot) is None
+
+
+def test_package_cache_attach(tmp_path):
+    """
+    A package cache is only attached to one container at a time.
+    """
+    cache = PackageCache(tmp_path / "debian-bookworm" / "archives", "/var/cache/apt/archives", purge_hooks=["/foo"])
+    other = PackageCache(tmp_path / "debian-bookworm" / "archives", "/var/cache/apt/archives")
+    try:
+        options = cache.attach()
+        assert options == [f"--bind={cache.path}:/var/cache/apt/archives", "--bind-ro=/dev/null:/foo"]
+        assert cache.path.is_dir()
+        assert other.attach() == []
+    finally:
+        cache.detach()
+    try:
+        assert other.attach() == [f"--bind={cache.path}:/var/cache/apt/archives"]
+    finally:
+        other.detach()
+
+
+def test_scmd_package_cache(tmp_path):
+    """
+    Commands run within a root filesystem bind the package cache, and release it afterwards.
+    """
+    cache = PackageCache(tmp_path / "fedora-40" / "dnf", "/var/cache/dnf")
+    with patch("postroj.backend.nspawn.cmd") as cmd:
+        scmd(directory="/foo", command="dnf install -y foo", package_cache=cache)
+    command = cmd.call_args[0][0]
+    assert f"--bind={cache.path}:/var/cache/dnf" in command
+    assert command.endswith("--pipe dnf install -y foo")
+    assert cache.attach() != []
+    cache.detach()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import http.client
+from typing import Dict, Optional
+from unittest.mock import Mock, patch
+
+import pytest
+
+from postroj.backend.nspawn import NspawnBackend, ccmd, scmd
+from postroj.pkgproxy import PackageProxy, is_package_command
+from tests.util import FileServerStandin
+
+RELEASE = "debian/dists/bookworm/InRelease"
+PACKAGE = "debian/pool/main/f/foo/foo_1.0_all.deb"
+
+
+def fetch(proxy: PackageProxy, url: str, method: str = "GET", headers: Optional[Dict[str, str]] = None):
+    connection = http.client.HTTPConnection("127.0.0.1", proxy.port)
+    try:
+        connection.request(method, url, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    server = FileServerStandin(tmp_path / "upstream")
+    (server.root / RELEASE).parent.mkdir(parents=True)
+    (server.root / RELEASE).write_bytes(b"Suite: bookworm\n")
+    (server.root / PACKAGE).parent.mkdir(parents=True)
+    (server.root / PACKAGE).write_bytes(b"foo" * 1000)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def proxy(tmp_path):
+    proxy = PackageProxy(tmp_path / "proxy").start()
+    yield proxy
+    proxy.stop()
+
+
+def test_package_proxy_cache(upstream, proxy):
+    """
+    Packages are served from the cache, repository metadata is revalidated upstream.
+    """
+    for _ in range(2):
+        assert fetch(proxy, upstream.url(PACKAGE)) == (200, b"foo" * 1000)
+        assert fetch(proxy, upstream.url(RELEASE)) == (200, b"Suite: bookworm\n")
+    assert upstream.requests == [f"GET /{PACKAGE}", f"GET /{RELEASE}", f"GET /{RELEASE}"]
+
+    # Changed metadata is refreshed.
+    (upstream.root / RELEASE).write_bytes(b"Suite: trixie\n")
+    assert fetch(proxy, upstream.url(RELEASE)) == (200, b"Suite: trixie\n")
+
+
+def test_package_proxy_conditional(upstream, proxy):
+    """
+    Clients already having the cached version are answered with `304 Not Modified`.
+    """
+    url = upstream.url(PACKAGE)
+    assert fetch(proxy, url)[0] == 200
+    metadata = proxy.load(proxy.entry_path(url))
+    assert fetch(proxy, url, headers={"If-None-Match": metadata["etag"]}) == (304, b"")
+    assert fetch(proxy, url, headers={"If-None-Match": '"other"'}) == (200, b"foo" * 1000)
+    assert fetch(proxy, url, headers={"If-Modified-Since": metadata["last_modified"]}) == (304, b"")
+    assert fetch(proxy, url, headers={"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"})[0] == 200
+
+    # Repository metadata is revalidated upstream, before answering the client.
+    assert fetch(proxy, upstream.url(RELEASE))[0] == 200
+    etag = proxy.load(proxy.entry_path(upstream.url(RELEASE)))["etag"]
+    assert fetch(proxy, upstream.url(RELEASE), headers={"If-None-Match": etag}) == (304, b"")
+    (upstream.root / RELEASE).write_bytes(b"Suite: trixie\n")
+    assert fetch(proxy, upstream.url(RELEASE), headers={"If-None-Match": etag}) == (200, b"Suite: trixie\n")
+
+
+def test_package_proxy_errors(upstream, proxy):
+    """
+    Errors are relayed without storing them, only absolute HTTP URLs are proxied.
+    """
+    url = upstream.url("debian/pool/main/b/bar/bar_1.0_all.deb")
+    assert fetch(proxy, url)[0] == 404
+    (upstream.root / "debian/pool/main/b/bar").mkdir(parents=True)
+    (upstream.root / "debian/pool/main/b/bar/bar_1.0_all.deb").write_bytes(b"bar")
+    assert fetch(proxy, url) == (200, b"bar")
+    assert fetch(proxy, f"/{PACKAGE}")[0] == 400
+
+
+def test_package_proxy_replay(tmp_path, upstream, proxy):
+    """
+    A warmed cache is replayed when upstream is not available, or when running offline.
+    """
+    assert fetch(proxy, upstream.url(RELEASE))[0] == 200
+    assert fetch(proxy, upstream.url(PACKAGE))[0] == 200
+    upstream.stop()
+    # The stopped server still serves connections kept alive by the proxy, drop them.
+    proxy.client.close()
+    assert fetch(proxy, upstream.url(RELEASE)) == (200, b"Suite: bookworm\n")
+    assert fetch(proxy, upstream.url("debian/dists/bookworm/Release"))[0] == 502
+
+    offline = PackageProxy(tmp_path / "proxy", offline=True).start()
+    try:
+        assert fetch(offline, upstream.url(RELEASE)) == (200, b"Suite: bookworm\n")
+        assert fetch(offline, upstream.url(PACKAGE), method="HEAD") == (200, b"")
+        assert fetch(offline, upstream.url("debian/dists/bookworm/Release"))[0] == 504
+    finally:
+        offline.stop()
+
+
+def test_package_proxy_options(fakeroot, proxy):
+    """
+    Package managers within containers are configured to use the proxy.
+    """
+    with patch("postroj.backend.nspawn.cmd") as cmd, patch("postroj.backend.nspawn.get_package_proxy") as get:
+        get.return_value = proxy
+        scmd(directory=fakeroot, command="apt-get install --yes foo")
+        assert f"--setenv=http_proxy={proxy.url}" in cmd.call_args[0][0]
+        assert "/etc/sysconfig/proxy" not in cmd.call_args[0][0]
+
+        (fakeroot / "etc" / "sysconfig").mkdir()
+        (fakeroot / "etc" / "sysconfig" / "proxy").touch()
+        scmd(directory=fakeroot, command="zypper install -y foo")
+        sysconfig = proxy.path / f".sysconfig-proxy-{proxy.port}"
+        assert f"--bind-ro={sysconfig}:/etc/sysconfig/proxy" in cmd.call_args[0][0]
+        assert f'HTTP_PROXY="{proxy.url}"' in sysconfig.read_text()
+
+        ccmd(machine="foo", command="apt-get install --yes foo", environment=proxy.environment)
+        assert f"--setenv=http_proxy={proxy.url}" in cmd.call_args[0][0]
+
+
+def test_package_proxy_scope(proxy):
+    """
+    On containers, only package managers use the proxy, other commands access the network directly.
+    """
+    assert is_package_command("/usr/bin/apt-get install --yes foo")
+    assert is_package_command("sh -c 'export DEBIAN_FRONTEND=noninteractive; apt-get update'")
+    assert not is_package_command("/usr/bin/curl http://localhost:8080/")
+    assert not is_package_command("/usr/bin/rpm --install --nodeps foo.rpm")
+
+    backend = NspawnBackend(container=Mock())
+    backend.environment = proxy.environment
+    with patch("postroj.backend.nspawn.cmd") as cmd:
+        backend.run("foo", "/usr/bin/dnf install -y foo")
+        assert f"--setenv=http_proxy={proxy.url}" in cmd.call_args[0][0]
+        assert "--setenv=no_proxy=localhost,127.0.0.1" in cmd.call_args[0][0]
+        backend.run("foo", "/usr/bin/wget http://localhost/")
+        assert "--setenv" not in cmd.call_args[0][0]
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import json
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from postroj.cli import cli
+from postroj.index import ImageIndex, ImageRecord
+from postroj.model import ConfigurationOptions
+from postroj.oci.store import BlobStore
+from postroj.prune import Pruner, parse_size
+from tests.util import sha256_digest
+
+
+@pytest.fixture
+def settings(tmp_path) -> ConfigurationOptions:
+    """
+    An archive with one activated image, two images not activated, provisioning layers, downloads, and leftovers.
+    """
+    settings = ConfigurationOptions(
+        archive_directory=tmp_path / "archive",
+        image_directory=tmp_path / "images",
+        cache_directory=tmp_path / "cache",
+        runtime_directory=tmp_path / "run",
+    )
+    archive = settings.archive_directory
+    for name in ["active", "stale", "old"]:
+        (archive / f"{name}.img" / "etc").mkdir(parents=True)
+        (archive / f"{name}.img" / "etc" / "os-release").write_bytes(os.urandom(8192))
+        (archive / f"{name}.oci").mkdir()
+    for key in ["k0", "k1", "k2"]:
+        (settings.provisioned_directory / key).mkdir(parents=True)
+        (settings.provisioned_directory / key / "systemd").write_bytes(os.urandom(4096))
+    (archive / "active.layer").symlink_to(settings.provisioned_directory / "k0")
+    (archive / "stale.layer").symlink_to(settings.provisioned_directory / "k1")
+    settings.image_directory.mkdir()
+    (settings.image_directory / "active").symlink_to(archive / "active.img")
+
+    settings.download_directory.mkdir(parents=True)
+    (settings.download_directory / "rootfs.tar.xz").write_bytes(os.urandom(4096))
+    (settings.download_directory / "rootfs.tar.xz.sha256").write_text("foo")
+
+    # Leftovers are only removed after some time.
+    (archive / "old.img.partial").mkdir()
+    os.utime(archive / "old.img.partial", (0, 0))
+    (archive / "new.img.partial").mkdir()
+
+    # The image `old` has been used before `stale`.
+    index = ImageIndex(settings.index_path)
+    index.put(ImageRecord(name="old", path=str(archive / "old.img")))
+    index.put(ImageRecord(name="stale", path=str(archive / "stale.img")))
+    with index.connect() as connection:
+        connection.execute("UPDATE images SET last_used = ?, updated = ? WHERE name = 'old'", (1, 1))
+    return settings
+
+
+def evicted_names(report):
+    return [candidate.name for candidate in report.evicted]
+
+
+def test_prune_all(settings):
+    archive = settings.archive_directory
+    report = Pruner(settings).prune()
+    assert sorted(evicted_names(report)) == ["k1", "k2", "old", "old.img.partial", "rootfs.tar.xz", "stale"]
+    assert report.reclaimed > 0
+    assert report.usage_after == Pruner(settings).usage()
+
+    assert sorted(path.name for path in archive.iterdir()) == [
+        "active.img",
+        "active.layer",
+        "active.oci",
+        "index.sqlite",
+        "new.img.partial",
+        "provisioned",
+    ]
+    assert (archive / "active.layer").resolve().exists()
+    assert not (archive / "stale.img").exists()
+    assert [record.name for record in ImageIndex(settings.index_path).all()] == []
+    assert list(settings.download_directory.iterdir()) == []
+
+
+def test_prune_budget(settings):
+    """
+    With a budget, least recently used artefacts are evicted first, until the disk usage fits into the budget.
+    """
+    pruner = Pruner(settings)
+    usage = pruner.usage()
+    report = pruner.prune(budget=usage - 8192)
+    assert evicted_names(report) == ["old.img.partial", "old"]
+    assert (settings.archive_directory / "stale.img").exists()
+    assert report.usage_after <= usage
+
+
+def test_prune_dry_run(settings):
+    report = Pruner(settings).prune(dry_run=True)
+    assert "stale" in evicted_names(report)
+    assert (settings.archive_directory / "stale.img").exists()
+
+
+def test_prune_blob_in_flight(settings):
+    """
+    Blobs ingested while acquiring an image, but not linked into its OCI image layout yet, are retained.
+    """
+    store = BlobStore(settings.blob_directory)
+    digest = sha256_digest(b"foo")
+    layout = settings.archive_directory / "active.oci"
+    with store.lock():
+        store.put(digest, b"foo")
+        Pruner(settings).prune()
+        store.link(digest, layout)
+    assert store.refcount(digest) == 1
+
+    # Without references, the blob is removed.
+    (layout / "blobs" / "sha256" / digest.split(":")[1]).unlink()
+    Pruner(settings).prune()
+    assert not store.has(digest)
+
+
+def test_prune_protects_running_containers(settings):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr("postroj.prune.paths_in_use", lambda: {settings.archive_directory / "stale.img"})
+        report = Pruner(settings).prune()
+    assert "stale" not in evicted_names(report)
+    assert (settings.archive_directory / "stale.img").exists()
+
+
+def test_parse_size():
+    assert parse_size("512") == 512
+    assert parse_size("2K") == 2048
+    assert parse_size("1.5G") == 1536 * 1024**2
+    assert parse_size("20GiB") == 20 * 1024**3
+    with pytest.raises(ValueError):
+        parse_size("foo")
+
+
+def test_cli_prune_dry_run(settings, monkeypatch):
+    monkeypatch.setattr("postroj.prune.get_appsettings", lambda: settings)
+    runner = CliRunner()
+    result = runner.invoke(cli, ["prune", "--dry-run", "--budget=1K"], catch_exceptions=False)
+    assert result.exit_code == 0
+    report = json.loads(result.stdout)
+    assert report["usage_before"] > report["usage_after"]
+    assert "stale" in [candidate["name"] for candidate in report["evicted"]]
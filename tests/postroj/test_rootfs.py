@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import os
+import stat
+
+import pytest
+
+from postroj.rootfs import RootfsInspector, parse_os_release
+
+OS_RELEASE = """
+PRETTY_NAME="Debian GNU/Linux 12 (bookworm)"
+NAME="Debian GNU/Linux"
+VERSION_ID="12"
+# Comment
+ID=debian
+"""
+
+
+def test_parse_os_release():
+    assert parse_os_release(OS_RELEASE) == {
+        "PRETTY_NAME": "Debian GNU/Linux 12 (bookworm)",
+        "NAME": "Debian GNU/Linux",
+        "VERSION_ID": "12",
+        "ID": "debian",
+    }
+
+
+def test_inspector_os_release_fallback(tmp_path):
+    (tmp_path / "usr" / "lib").mkdir(parents=True)
+    (tmp_path / "usr" / "lib" / "os-release").write_text('ID="rocky"\nID_LIKE="rhel centos fedora"\nVERSION_ID="9.1"\n')
+    inspector = RootfsInspector(tmp_path)
+    assert inspector.id == "rocky"
+    assert inspector.id_like == ["rhel", "centos", "fedora"]
+    assert inspector.version_id == "9.1"
+    assert inspector.is_redhat is True
+    assert inspector.is_debian is False
+    assert inspector.is_suse is False
+
+
+def test_inspector_os_release_missing(tmp_path):
+    inspector = RootfsInspector(tmp_path)
+    with pytest.raises(FileNotFoundError):
+        inspector.os_release
+    assert inspector.is_suse is False
+
+
+def test_inspector_programs(tmp_path):
+    """
+    Programs and init systems are found by following symlinks within the root directory.
+    """
+    (tmp_path / "usr" / "bin").mkdir(parents=True)
+    (tmp_path / "usr" / "lib" / "systemd").mkdir(parents=True)
+    (tmp_path / "usr" / "lib" / "systemd" / "systemd").touch()
+    (tmp_path / "usr" / "bin" / "microdnf").touch(mode=0o755)
+    (tmp_path / "usr" / "bin" / "zypper").touch(mode=0o644)
+    (tmp_path / "bin").symlink_to("usr/bin")
+    (tmp_path / "sbin").mkdir()
+    (tmp_path / "sbin" / "init").symlink_to("/usr/lib/systemd/systemd")
+
+    inspector = RootfsInspector(tmp_path)
+    assert inspector.has_os_tree is True
+    assert inspector.init_program == "/usr/lib/systemd/systemd"
+    assert inspector.has_systemd is True
+    assert inspector.find_program("microdnf") == "/usr/bin/microdnf"
+    assert inspector.find_program("zypper") is None
+    assert inspector.find_program("dnf") is None
+    assert inspector.package_manager == "microdnf"
+
+
+def test_inspector_layers(tmp_path):
+    """
+    Layers are stacked over the root directory, honoring symlinks across layers, and whiteouts.
+    """
+    base = tmp_path / "base"
+    layer = tmp_path / "layer"
+    (base / "usr" / "lib").mkdir(parents=True)
+    (base / "usr" / "lib" / "os-release").write_text("ID=debian\n")
+    (base / "lib").symlink_to("usr/lib")
+    (base / "etc").mkdir()
+    (base / "etc" / "debian_version").touch()
+    (layer / "usr" / "lib" / "systemd").mkdir(parents=True)
+    (layer / "usr" / "lib" / "systemd" / "systemd").touch()
+    (layer / "etc").mkdir()
+    os.mknod(layer / "etc" / "debian_version", mode=stat.S_IFCHR, device=os.makedev(0, 0))
+
+    inspector = RootfsInspector(base, layers=[layer])
+    assert inspector.id == "debian"
+    assert inspector.resolve("/lib/systemd/systemd") == layer / "usr" / "lib" / "systemd" / "systemd"
+    assert inspector.has_systemd is True
+    assert inspector.exists("/etc/debian_version") is False
+
+    assert RootfsInspector(base).has_systemd is False
+    assert RootfsInspector(base).exists("/etc/debian_version") is True
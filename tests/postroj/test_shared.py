@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import os
+from pathlib import Path
+
+import pytest
+
+from postroj.image import ImageProvider
+from postroj.overlay import find_layers
+from postroj.settings import get_appsettings
+from racker.babelfish import DynamicDistribution
+from tests.util import OS_RELEASE, cleanup, make_image, make_provider
+
+IMAGE = "testdrive/shared:latest"
+
+
+def listing(path: Path):
+    """
+    Record names and modification times of all files below `path`, in order to detect modifications.
+    """
+    return sorted((str(item), item.lstat().st_mtime_ns) for item in path.rglob("*"))
+
+
+@pytest.fixture
+def shared_archive(tmp_path, monkeypatch):
+    """
+    Populate an archive like a build host would, and mount it elsewhere, like a runner host would.
+    """
+    settings = get_appsettings()
+    with monkeypatch.context() as builder:
+        builder.setattr(settings, "archive_directory", tmp_path / "build" / "archive")
+        builder.setattr(settings, "image_directory", tmp_path / "build" / "images")
+        ip = make_provider(IMAGE)
+        key = make_image(ip)
+    (tmp_path / "build" / "archive").rename(tmp_path / "shared")
+    monkeypatch.setattr(settings, "shared_archive_directory", tmp_path / "shared")
+    yield tmp_path / "shared", key
+    cleanup(ImageProvider(distribution=DynamicDistribution.from_image(IMAGE), autosetup=False))
+
+
+def test_shared_archive_activate(shared_archive):
+    """
+    Images are activated from the shared archive, without acquiring them, and without modifying the archive.
+    """
+    shared, key = shared_archive
+    before = listing(shared)
+    make_provider(IMAGE)
+
+    ip = ImageProvider(distribution=DynamicDistribution.from_image(IMAGE))
+    assert ip.is_shared
+    image = ip.image.resolve()
+    assert image.parent == shared / f"{ip.distribution.fullname}.versions"
+    assert (image / "etc" / "os-release").read_bytes() == OS_RELEASE
+    assert find_layers(ip.image) == [shared / "provisioned" / key]
+    assert not ip.image_staging.exists()
+    assert listing(shared) == before
+
+
+def test_shared_archive_follow_update(shared_archive):
+    """
+    When the shared archive has a new version of an image, its activation link is pointed to it.
+    """
+    shared, key = shared_archive
+    make_provider(IMAGE)
+    ip = ImageProvider(distribution=DynamicDistribution.from_image(IMAGE))
+    previous = ip.image.resolve()
+
+    store = ip.shared_archive.store(ip.distribution.fullname)
+    incoming = store.incoming_path()
+    os.mkdir(incoming)
+    (incoming / "etc").mkdir()
+    (incoming / "etc" / "os-release").write_bytes(OS_RELEASE)
+    store.set_current(store.commit(incoming))
+
+    ip = ImageProvider(distribution=DynamicDistribution.from_image(IMAGE))
+    assert ip.image.resolve() == store.current() != previous
+
+
+def test_shared_archive_prefers_local(shared_archive):
+    """
+    Images present within the writable archive of the host take precedence.
+    """
+    ip = make_provider(IMAGE)
+    make_image(ip)
+    ip = ImageProvider(distribution=DynamicDistribution.from_image(IMAGE))
+    assert not ip.is_shared
+    assert ip.image.resolve().parent == ip.store.path
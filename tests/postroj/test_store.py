@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import os
+
+import pytest
+
+from postroj.model import ConfigurationOptions
+from postroj.prune import Pruner
+from postroj.store import ImageStore, swap_link
+
+
+def acquire(store: ImageStore, content: str, digest: str = None):
+    incoming = store.incoming_path()
+    (incoming / "etc").mkdir(parents=True)
+    (incoming / "etc" / "os-release").write_text(content)
+    version = store.commit(incoming, digest=digest)
+    store.set_current(version)
+    return version
+
+
+def test_store_versions(tmp_path):
+    store = ImageStore(tmp_path / "foo.img")
+    assert store.current() is None
+    assert store.versions() == []
+
+    first = acquire(store, "ID=foo\n", digest="sha256:0123456789abcdef")
+    second = acquire(store, "ID=bar\n")
+    assert first.name.endswith("-0123456789ab")
+    assert store.versions() == [first, second]
+    assert store.current() == second
+    assert (tmp_path / "foo.img" / "etc" / "os-release").read_text() == "ID=bar\n"
+
+    assert store.rollback() == first
+    assert (tmp_path / "foo.img" / "etc" / "os-release").read_text() == "ID=foo\n"
+    with pytest.raises(FileNotFoundError) as ex:
+        store.rollback()
+    ex.match("No previous version to roll back to")
+
+
+def test_store_retire(tmp_path):
+    store = ImageStore(tmp_path / "foo.img")
+    versions = [acquire(store, f"ID={number}\n") for number in range(4)]
+    versions[0].with_suffix(".layer").symlink_to(tmp_path)
+
+    # Versions in use are retained, as well as the most recent previous ones.
+    retired = store.retire(keep=1, protected=[versions[1] / "etc"])
+    assert retired == [versions[0]]
+    assert store.versions() == versions[1:]
+    assert not versions[0].with_suffix(".layer").is_symlink()
+
+    assert store.retire(keep=0) == versions[1:3]
+    assert store.versions() == [versions[3]]
+
+
+def test_store_migrate(tmp_path):
+    legacy = tmp_path / "foo.img"
+    (legacy / "etc").mkdir(parents=True)
+    (legacy / "etc" / "os-release").write_text("ID=foo\n")
+    (tmp_path / "foo.layer").symlink_to(tmp_path)
+
+    store = ImageStore(legacy)
+    store.migrate()
+    assert legacy.is_symlink()
+    assert store.versions() == [store.current()]
+    assert (legacy / "etc" / "os-release").read_text() == "ID=foo\n"
+    assert store.current().with_suffix(".layer").is_symlink()
+    assert not (tmp_path / "foo.layer").exists()
+
+
+def test_swap_link(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    swap_link(tmp_path / "link", tmp_path / "a")
+    swap_link(tmp_path / "link", tmp_path / "b")
+    assert os.readlink(tmp_path / "link") == str(tmp_path / "b")
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a", "b", "link"]
+
+
+def test_prune_versions(tmp_path):
+    """
+    Previous versions of activated images are evicted, the activated version is retained.
+    """
+    settings = ConfigurationOptions(
+        archive_directory=tmp_path / "archive",
+        image_directory=tmp_path / "images",
+        cache_directory=tmp_path / "cache",
+        runtime_directory=tmp_path / "run",
+    )
+    store = ImageStore(settings.archive_directory / "foo.img")
+    first = acquire(store, "ID=foo\n")
+    second = acquire(store, "ID=bar\n")
+    settings.image_directory.mkdir()
+    (settings.image_directory / "foo").symlink_to(second)
+
+    report = Pruner(settings).prune()
+    assert [candidate.kind for candidate in report.evicted] == ["version"]
+    assert report.evicted[0].name == f"foo/{first.name}"
+    assert store.versions() == [second]
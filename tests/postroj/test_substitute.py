@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@cicerops.de>
+import json
+import shutil
+
+import pytest
+
+from postroj.substitute import Substituter
+from tests.util import FileServerStandin, cleanup, make_image, make_provider
+
+
+@pytest.fixture
+def provider():
+    ip = make_provider("testdrive/substitute:latest")
+    yield ip
+    ip.settings.substituter = None
+    ip.settings.publish = False
+    cleanup(ip)
+
+
+def test_substitute_directory(provider, tmp_path):
+    """
+    A provisioning layer published to a directory is substituted when provisioning the image again.
+    """
+    key = make_image(provider)
+    substituter = Substituter(str(tmp_path / "cache"))
+    stats = substituter.publish(key, provider.provisioning_cache)
+    info = json.loads((tmp_path / "cache" / f"{key}.json").read_text())
+    assert info["digest"] == stats.digest
+    assert info["size"] == (tmp_path / "cache" / f"{key}.bundle").stat().st_size
+
+    # Start from scratch, like on another host.
+    shutil.rmtree(provider.provisioning_cache.layer_path(key))
+    provider.layer_path.unlink()
+    provider.has_systemd = False
+    provider.settings.substituter = f"file://{tmp_path / 'cache'}"
+    provider.provision_systemd()
+
+    assert provider.has_systemd
+    assert provider.layer_path.resolve() == provider.provisioning_cache.layer_path(key)
+    assert (provider.provisioning_cache.layer_path(key) / "sbin" / "init").read_text() == "init"
+    assert provider.provisioning_cache.metadata(key)["components"]["digest"] == "sha256:0123456789abcdef"
+    assert list(provider.provisioning_cache.path.glob("*.partial")) == []
+
+
+def test_substitute_miss(provider, tmp_path):
+    key = make_image(provider)
+    shutil.rmtree(provider.provisioning_cache.layer_path(key))
+    assert Substituter(str(tmp_path)).fetch(key, provider.provisioning_cache) is False
+    assert not provider.provisioning_cache.has(key)
+
+
+def test_substitute_digest_mismatch(provider, tmp_path):
+    """
+    Bundles not matching the digest recorded within their info document are discarded.
+    """
+    key = make_image(provider)
+    substituter = Substituter(str(tmp_path))
+    substituter.publish(key, provider.provisioning_cache)
+    info = json.loads((tmp_path / f"{key}.json").read_text())
+    info["digest"] = "sha256:foo"
+    (tmp_path / f"{key}.json").write_text(json.dumps(info))
+
+    shutil.rmtree(provider.provisioning_cache.layer_path(key))
+    assert substituter.fetch(key, provider.provisioning_cache) is False
+    assert not provider.provisioning_cache.has(key)
+    assert list(provider.provisioning_cache.path.glob("*.partial")) == []
+
+
+def test_substitute_http(provider, tmp_path):
+    """
+    Provisioning layers are published to, and substituted from, HTTP endpoints.
+    """
+    key = make_image(provider)
+    server = FileServerStandin(tmp_path).start()
+    try:
+        substituter = Substituter(server.url("cache"))
+        stats = substituter.publish(key, provider.provisioning_cache)
+        assert server.requests == [f"PUT /cache/{key}.bundle", f"PUT /cache/{key}.json"]
+        assert json.loads((tmp_path / "cache" / f"{key}.json").read_text())["digest"] == stats.digest
+
+        shutil.rmtree(provider.provisioning_cache.layer_path(key))
+        assert substituter.fetch(key, provider.provisioning_cache) is True
+        assert (provider.provisioning_cache.layer_path(key) / "sbin" / "init").read_text() == "init"
+
+        # Entries not available are a miss.
+        assert substituter.info("foo") is None
+        substituter.close()
+    finally:
+        server.stop()
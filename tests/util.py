@@ -1,3 +1,332 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from postroj.image import ImageProvider
+from postroj.store import swap_link
+from racker.babelfish import DynamicDistribution
+
+
 class AnyStringWith(str):
     def __eq__(self, other):
         return self in other
+
+
+def sha256_digest(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def make_layer(files: Dict[str, Union[bytes, str, Tuple[str], None]], compress: bool = True) -> bytes:
+    """
+    Create a layer tarball. Values can be file content as `bytes`, a symlink
+    target as `str`, a hardlink target as 1-tuple, or `None` for directories.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.mtime = 1234567890
+            if content is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            elif isinstance(content, tuple):
+                info.type = tarfile.LNKTYPE
+                info.linkname = content[0]
+                tar.addfile(info)
+            elif isinstance(content, str):
+                info.type = tarfile.SYMTYPE
+                info.linkname = content
+                tar.addfile(info)
+            else:
+                info.size = len(content)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(content))
+    data = buffer.getvalue()
+    if compress:
+        data = gzip.compress(data, mtime=0)
+    return data
+
+
+class RegistryStandin:
+    """
+    A local stand-in for a container registry, serving images from a directory.
+
+    Manifests are stored at `<root>/<repository>/manifests/<reference>`,
+    blobs are stored at `<root>/<repository>/blobs/<digest>`.
+    """
+
+    def __init__(self, root: Path, token: Optional[str] = None):
+        self.root = Path(root)
+        self.token = token
+        self.requests: List[str] = []
+        self.connections = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self) -> str:
+        return f"localhost:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def publish(self, repository: str, tag: str, layers: List[bytes], multiarch: bool = False) -> str:
+        """
+        Publish an image, using a Docker manifest, optionally wrapped into a multi-architecture
+        image index. Return the digest of the manifest.
+        """
+        config = json.dumps({"architecture": "amd64", "os": "linux", "rootfs": {"type": "layers"}}).encode()
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+            "config": self._descriptor(repository, "application/vnd.docker.container.image.v1+json", config),
+            "layers": [
+                self._descriptor(repository, "application/vnd.docker.image.rootfs.diff.tar.gzip", layer)
+                for layer in layers
+            ],
+        }
+        content = json.dumps(manifest).encode()
+        digest = self._write(repository, "manifests", sha256_digest(content), content)
+        if multiarch:
+            index = {
+                "schemaVersion": 2,
+                "mediaType": "application/vnd.docker.distribution.manifest.list.v2+json",
+                "manifests": [
+                    {
+                        "mediaType": manifest["mediaType"],
+                        "digest": sha256_digest(b"other"),
+                        "size": 5,
+                        "platform": {"architecture": "riscv64", "os": "linux"},
+                    },
+                    {
+                        "mediaType": manifest["mediaType"],
+                        "digest": digest,
+                        "size": len(content),
+                        "platform": {"architecture": "amd64", "os": "linux"},
+                    },
+                    {
+                        "mediaType": manifest["mediaType"],
+                        "digest": digest,
+                        "size": len(content),
+                        "platform": {"architecture": "arm64", "os": "linux"},
+                    },
+                ],
+            }
+            content = json.dumps(index).encode()
+            self._write(repository, "manifests", sha256_digest(content), content)
+        self._write(repository, "manifests", tag, content)
+        return digest
+
+    def _descriptor(self, repository: str, media_type: str, data: bytes) -> dict:
+        digest = self._write(repository, "blobs", sha256_digest(data), data)
+        return {"mediaType": media_type, "digest": digest, "size": len(data)}
+
+    def _write(self, repository: str, kind: str, name: str, data: bytes) -> str:
+        path = self.root / repository / kind / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        return sha256_digest(data)
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                standin.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.respond(body=False)
+
+            def do_GET(self):
+                self.respond(body=True)
+
+            def respond(self, body: bool):
+                standin.requests.append(f"{self.command} {self.path}")
+                if self.path.startswith("/token"):
+                    return self.send(200, json.dumps({"token": standin.token}).encode(), body=body)
+                if standin.token and self.headers.get("Authorization") != f"Bearer {standin.token}":
+                    realm = f"http://{standin.address}/token"
+                    return self.send(401, b"", headers={"WWW-Authenticate": f'Bearer realm="{realm}",service="test"'})
+                if self.path == "/v2/":
+                    return self.send(200, b"{}", body=body)
+                repository, _, remainder = self.path[len("/v2/") :].rpartition("/")
+                repository, _, kind = repository.rpartition("/")
+                path = standin.root / repository / kind / remainder
+                if kind not in ["manifests", "blobs"] or not path.is_file():
+                    return self.send(404, b'{"errors": [{"code": "NOT_FOUND"}]}', body=body)
+                data = path.read_bytes()
+                headers = {"Docker-Content-Digest": sha256_digest(data)}
+                if kind == "manifests":
+                    headers["Content-Type"] = json.loads(data)["mediaType"]
+                return self.send(200, data, headers=headers, body=body)
+
+            def send(self, status: int, data: bytes, headers: Optional[Dict[str, str]] = None, body: bool = True):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(data)
+
+        return Handler
+
+
+class FileServerStandin:
+    """
+    A local stand-in for a web server, serving files from a directory.
+
+    It supports conditional requests and byte ranges, the latter can be turned off.
+    `PUT` requests store files, also when using chunked transfer encoding.
+    """
+
+    def __init__(self, root: Path, ranges: bool = True):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.ranges = ranges
+        self.requests: List[str] = []
+        self.connections = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, name: str) -> str:
+        return f"http://localhost:{self.server.server_address[1]}/{name}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                standin.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                range_header = self.headers.get("Range")
+                standin.requests.append(f"{self.command} {self.path}" + (f" {range_header}" if range_header else ""))
+                path = standin.root / self.path.lstrip("/")
+                if not path.is_file():
+                    return self.send(404)
+                data = path.read_bytes()
+                etag = f'"{hashlib.sha256(data).hexdigest()}"'
+                headers = {"ETag": etag, "Last-Modified": self.date_time_string(int(path.stat().st_mtime))}
+                if self.headers.get("If-None-Match") == etag:
+                    return self.send(304, headers=headers)
+                if_range = self.headers.get("If-Range")
+                if standin.ranges and range_header and (if_range is None or if_range == etag):
+                    start, _, end = range_header[len("bytes=") :].partition("-")
+                    start, end = int(start), min(int(end or len(data) - 1), len(data) - 1)
+                    if start >= len(data):
+                        return self.send(416, headers={"Content-Range": f"bytes */{len(data)}"})
+                    headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+                    return self.send(206, data[start : end + 1], headers=headers)
+                return self.send(200, data, headers=headers)
+
+            def do_PUT(self):
+                standin.requests.append(f"{self.command} {self.path}")
+                if self.headers.get("Transfer-Encoding") == "chunked":
+                    data = b""
+                    while True:
+                        size = int(self.rfile.readline().split(b";")[0], 16)
+                        data += self.rfile.read(size)
+                        self.rfile.readline()
+                        if size == 0:
+                            break
+                else:
+                    data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                path = standin.root / self.path.lstrip("/")
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(data)
+                return self.send(201)
+
+            def send(self, status: int, data: bytes = b"", headers: Optional[Dict[str, str]] = None):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                if status != 304:
+                    self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+OS_RELEASE = b'NAME="Debian GNU/Linux"\nID=debian\n'
+
+
+def make_provider(image: str) -> ImageProvider:
+    """
+    Create a provider for an image, starting from scratch.
+    """
+    ip = ImageProvider(distribution=DynamicDistribution.from_image(image), autosetup=False)
+    for path in [ip.store.path, ip.oci_path, ip.snapshot_path]:
+        shutil.rmtree(path, ignore_errors=True)
+    for path in [ip.image_staging, ip.image]:
+        path.unlink(missing_ok=True)
+    ip.index.remove(ip.distribution.fullname)
+    return ip
+
+
+def cleanup(ip: ImageProvider):
+    make_provider(ip.distribution.image)
+
+
+def make_image(ip: ImageProvider):
+    """
+    Make an image with a provisioning layer, like acquiring and provisioning it would do.
+    """
+    incoming = ip.store.incoming_path()
+    (incoming / "etc").mkdir(parents=True)
+    (incoming / "usr" / "bin").mkdir(parents=True)
+    (incoming / "etc" / "os-release").write_bytes(OS_RELEASE)
+    (incoming / "usr" / "bin" / "foo").write_text("foo")
+    os.link(incoming / "usr" / "bin" / "foo", incoming / "usr" / "bin" / "bar")
+    ip.commit_version(incoming, digest="sha256:0123456789abcdef")
+    ip.source_digest = "sha256:0123456789abcdef"
+    ip.discover()
+
+    components = ip.provisioning_components()
+    key = ip.provisioning_cache.key(**components)
+    shutil.rmtree(ip.provisioning_cache.layer_path(key), ignore_errors=True)
+    partial = ip.provisioning_cache.begin(key)
+    (partial / "sbin").mkdir()
+    (partial / "sbin" / "init").write_text("init")
+    ip.provisioning_cache.commit(key, **components)
+    swap_link(ip.layer_path, ip.provisioning_cache.layer_path(key), relative=True)
+
+    ip.check_systemd()
+    ip.update_index(provisioned=True)
+    ip.activate_image()
+    return key